@@ -0,0 +1,299 @@
+# PDF rendering for receipts, invoices and reports (توليد ملفات PDF)
+#
+# Every render_* function takes plain dict/list payloads and returns PDF bytes,
+# so server.py can run them in a worker process without blocking the API.
+# Fonts are registered and paragraph styles are built once per process.
+import os
+from functools import lru_cache
+from io import BytesIO
+
+import arabic_reshaper
+from bidi.algorithm import get_display
+from reportlab.lib import colors
+from reportlab.lib.enums import TA_CENTER, TA_RIGHT
+from reportlab.lib.pagesizes import A4, landscape
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import cm
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+
+ARABIC_FONT_PATH = os.environ.get('PDF_ARABIC_FONT', "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf")
+
+def init_worker():
+    """Process pool initializer: register fonts and warm the style cache"""
+    try:
+        pdfmetrics.registerFont(TTFont('Arabic', ARABIC_FONT_PATH))
+    except Exception:
+        pass
+    get_styles()
+
+@lru_cache(maxsize=1)
+def get_styles() -> dict:
+    styles = getSampleStyleSheet()
+    return {
+        "base": styles,
+        "receipt_title": ParagraphStyle('ReceiptTitle', parent=styles['Title'], fontName='Arabic', fontSize=24, alignment=TA_CENTER, spaceAfter=20),
+        "receipt_header": ParagraphStyle('ReceiptHeader', parent=styles['Normal'], fontName='Arabic', fontSize=14, alignment=TA_CENTER, spaceAfter=10),
+        "receipt_normal": ParagraphStyle('ReceiptNormal', parent=styles['Normal'], fontName='Arabic', fontSize=12, alignment=TA_RIGHT, spaceAfter=5),
+        "receipt_footer": ParagraphStyle('ReceiptFooter', parent=styles['Normal'], fontName='Arabic', fontSize=9, alignment=TA_CENTER, textColor=colors.gray),
+        "report_title": ParagraphStyle('ReportTitle', parent=styles['Heading1'], alignment=TA_CENTER, fontSize=16),
+        "report_title_large": ParagraphStyle('ReportTitleLarge', parent=styles['Heading1'], alignment=TA_CENTER, fontSize=18),
+        "report_date": ParagraphStyle('ReportDate', parent=styles['Normal'], alignment=TA_CENTER, fontSize=10),
+        "centered": ParagraphStyle('Centered', alignment=TA_CENTER),
+    }
+
+def reshape_arabic(text) -> str:
+    try:
+        return get_display(arabic_reshaper.reshape(str(text)))
+    except Exception:
+        return str(text)
+
+def _build(elements: list, pagesize, margins: float) -> bytes:
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=pagesize, rightMargin=margins, leftMargin=margins, topMargin=margins, bottomMargin=margins)
+    doc.build(elements)
+    return buffer.getvalue()
+
+def _key_value_table(rows: list, header_color: str, body_color: str, grid_color: str) -> Table:
+    table = Table(rows, colWidths=[10*cm, 5*cm])
+    table.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor(header_color)),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('FONTNAME', (0, 0), (-1, -1), 'Arabic'),
+        ('FONTSIZE', (0, 0), (-1, 0), 12),
+        ('FONTSIZE', (0, 1), (-1, -1), 11),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+        ('TOPPADDING', (0, 0), (-1, -1), 8),
+        ('BACKGROUND', (0, 1), (-1, -1), colors.HexColor(body_color)),
+        ('GRID', (0, 0), (-1, -1), 1, colors.HexColor(grid_color)),
+    ]))
+    return table
+
+def _signature_table(left: str, right: str) -> Table:
+    sig_table = Table([
+        [reshape_arabic(left), "", reshape_arabic(right)],
+        ["________________", "", "________________"],
+    ], colWidths=[5*cm, 5*cm, 5*cm])
+    sig_table.setStyle(TableStyle([
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('FONTNAME', (0, 0), (-1, -1), 'Arabic'),
+        ('FONTSIZE', (0, 0), (-1, -1), 10),
+        ('TOPPADDING', (0, 0), (-1, -1), 20),
+    ]))
+    return sig_table
+
+def _grid_table(data: list, header_color: str, body_size: int = 9, **kwargs) -> Table:
+    table = Table(data, repeatRows=1, **kwargs)
+    table.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor(header_color)),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('FONTSIZE', (0, 0), (-1, 0), 10),
+        ('FONTSIZE', (0, 1), (-1, -1), body_size),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+        ('GRID', (0, 0), (-1, -1), 1, colors.black),
+        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#F2F2F2')]),
+    ]))
+    return table
+
+def render_payment_receipt(payment: dict, supplier: dict) -> bytes:
+    styles = get_styles()
+    elements = []
+
+    # Company Header
+    elements.append(Paragraph(reshape_arabic("المروج للألبان"), styles["receipt_title"]))
+    elements.append(Paragraph(reshape_arabic("Al-Morooj Dairy"), styles["receipt_header"]))
+    elements.append(Spacer(1, 20))
+
+    # Receipt Title
+    elements.append(Paragraph(reshape_arabic("إيصال دفع"), styles["receipt_title"]))
+    elements.append(Spacer(1, 20))
+
+    payment_date = payment.get("payment_date", "")[:10]
+    elements.append(Paragraph(reshape_arabic(f"التاريخ: {payment_date}"), styles["receipt_normal"]))
+    elements.append(Spacer(1, 10))
+
+    # Supplier Information Table
+    elements.append(_key_value_table([
+        [reshape_arabic("القيمة"), reshape_arabic("البيان")],
+        [reshape_arabic(supplier.get("name", "")), reshape_arabic("اسم المورد")],
+        [reshape_arabic(supplier.get("supplier_code", "-")), reshape_arabic("كود المورد")],
+        [reshape_arabic(supplier.get("phone", "-")), reshape_arabic("رقم الهاتف")],
+        [reshape_arabic(supplier.get("address", "-")), reshape_arabic("العنوان")],
+        [reshape_arabic(supplier.get("bank_account", "-")), reshape_arabic("الحساب البنكي")],
+        [reshape_arabic(supplier.get("national_id", "-")), reshape_arabic("رقم الهوية")],
+    ], "#2563eb", "#f8fafc", "#e2e8f0"))
+    elements.append(Spacer(1, 20))
+
+    # Payment Details Table
+    payment_method_map = {
+        "cash": "نقداً",
+        "bank_transfer": "تحويل بنكي",
+        "check": "شيك"
+    }
+    payment_method = payment_method_map.get(payment.get("payment_method", "cash"), payment.get("payment_method", ""))
+    elements.append(_key_value_table([
+        [reshape_arabic("القيمة"), reshape_arabic("تفاصيل الدفع")],
+        [reshape_arabic(f"{payment.get('amount', 0):,.2f} ر.ع"), reshape_arabic("المبلغ المدفوع")],
+        [reshape_arabic(payment_method), reshape_arabic("طريقة الدفع")],
+        [reshape_arabic(payment.get("notes", "-") or "-"), reshape_arabic("ملاحظات")],
+    ], "#059669", "#f0fdf4", "#d1fae5"))
+    elements.append(Spacer(1, 30))
+
+    elements.append(_signature_table("توقيع المستلم", "توقيع المسؤول"))
+
+    # Footer
+    elements.append(Spacer(1, 40))
+    elements.append(Paragraph(reshape_arabic(f"رقم الإيصال: {payment['id'][:8].upper()}"), styles["receipt_footer"]))
+
+    return _build(elements, A4, 2*cm)
+
+def render_feed_invoice(purchase: dict, supplier: dict, company: dict) -> bytes:
+    styles = get_styles()
+    elements = []
+
+    elements.append(Paragraph(reshape_arabic(company["name"]), styles["receipt_title"]))
+    elements.append(Paragraph(reshape_arabic(company["name_en"]), styles["receipt_header"]))
+    elements.append(Paragraph(reshape_arabic(f"{company['address']} - {company['phone']}"), styles["receipt_header"]))
+    elements.append(Spacer(1, 20))
+
+    elements.append(Paragraph(reshape_arabic("فاتورة شراء أعلاف"), styles["receipt_title"]))
+    elements.append(Paragraph(reshape_arabic(f"رقم الفاتورة: {purchase.get('invoice_number') or '-'}"), styles["receipt_normal"]))
+    elements.append(Paragraph(reshape_arabic(f"التاريخ: {purchase.get('purchase_date', '')[:10]}"), styles["receipt_normal"]))
+    elements.append(Spacer(1, 10))
+
+    supplier = supplier or {}
+    elements.append(_key_value_table([
+        [reshape_arabic("القيمة"), reshape_arabic("البيان")],
+        [reshape_arabic(purchase.get("supplier_name", "")), reshape_arabic("اسم المورد")],
+        [reshape_arabic(supplier.get("supplier_code") or "-"), reshape_arabic("كود المورد")],
+        [reshape_arabic(purchase.get("supplier_phone") or supplier.get("phone") or "-"), reshape_arabic("رقم الهاتف")],
+    ], "#2563eb", "#f8fafc", "#e2e8f0"))
+    elements.append(Spacer(1, 20))
+
+    elements.append(_key_value_table([
+        [reshape_arabic("القيمة"), reshape_arabic("تفاصيل الفاتورة")],
+        [reshape_arabic(purchase.get("company_name", "")), reshape_arabic("شركة الأعلاف")],
+        [reshape_arabic(purchase.get("feed_type_name", "")), reshape_arabic("نوع العلف")],
+        [reshape_arabic(f"{purchase.get('quantity', 0):,.2f} {purchase.get('unit', '')}"), reshape_arabic("الكمية")],
+        [reshape_arabic(f"{purchase.get('price_per_unit', 0):,.3f} ر.ع"), reshape_arabic("سعر الوحدة")],
+        [reshape_arabic(f"{purchase.get('total_amount', 0):,.3f} ر.ع"), reshape_arabic("الإجمالي")],
+        [reshape_arabic(purchase.get("notes") or "-"), reshape_arabic("ملاحظات")],
+    ], "#059669", "#f0fdf4", "#d1fae5"))
+    elements.append(Spacer(1, 30))
+
+    elements.append(_signature_table("توقيع المورد", "توقيع المسؤول"))
+
+    if purchase.get("signature_code"):
+        elements.append(Spacer(1, 40))
+        elements.append(Paragraph(
+            reshape_arabic(f"كود التصديق: {purchase['signature_code']} - {purchase.get('approved_by_name') or ''}"),
+            styles["receipt_footer"]
+        ))
+
+    return _build(elements, A4, 2*cm)
+
+def render_attendance_report(attendance: list, year: int, month: int) -> bytes:
+    styles = get_styles()
+    elements = []
+
+    elements.append(Paragraph("تقرير الحضور والانصراف - Attendance Report", styles["report_title"]))
+    elements.append(Spacer(1, 10))
+    elements.append(Paragraph(f"الشهر: {month}/{year}", styles["centered"]))
+    elements.append(Spacer(1, 20))
+
+    data = [['Date', 'Employee', 'Check In', 'Check Out', 'Source']]
+    for record in attendance:
+        data.append([
+            record.get('date', ''),
+            record.get('employee_name', ''),
+            record.get('check_in', '-'),
+            record.get('check_out', '-'),
+            record.get('source', 'manual')
+        ])
+    if len(data) == 1:
+        data.append(['', 'No attendance records', '', '', ''])
+
+    elements.append(_grid_table(data, '#4472C4'))
+    return _build(elements, landscape(A4), 30)
+
+def render_suppliers_report(suppliers: list, report_date: str) -> bytes:
+    styles = get_styles()
+    elements = []
+
+    elements.append(Paragraph("تقرير الموردين - Suppliers Report", styles["report_title_large"]))
+    elements.append(Spacer(1, 20))
+    elements.append(Paragraph(f"التاريخ: {report_date}", styles["report_date"]))
+    elements.append(Spacer(1, 20))
+
+    data = [['Code', 'Name', 'Phone', 'Bank Account', 'Balance', 'Total Supplied', 'Center']]
+    for s in suppliers:
+        data.append([
+            s.get('code', ''),
+            s.get('name', ''),
+            s.get('phone', ''),
+            s.get('bank_account', ''),
+            f"{s.get('balance', 0):.3f}",
+            f"{s.get('total_supplied', 0):.2f}",
+            s.get('center_name', '')
+        ])
+
+    elements.append(_grid_table(data, '#4472C4'))
+    return _build(elements, landscape(A4), 30)
+
+def render_daily_report(date: str, receptions: list, sales: list) -> bytes:
+    styles = get_styles()
+    elements = []
+
+    elements.append(Paragraph("التقرير اليومي - Daily Report", styles["report_title"]))
+    elements.append(Spacer(1, 10))
+    elements.append(Paragraph(f"التاريخ: {date}", styles["centered"]))
+    elements.append(Spacer(1, 20))
+
+    # Summary
+    total_milk = sum(r.get('quantity_liters', 0) for r in receptions)
+    total_sales = sum(s.get('total_amount', 0) for s in sales)
+    summary_table = Table([
+        ['الوصف', 'القيمة'],
+        ['إجمالي الحليب المستلم (لتر)', f'{total_milk:.2f}'],
+        ['عدد عمليات الاستلام', str(len(receptions))],
+        ['إجمالي المبيعات (ر.ع)', f'{total_sales:.3f}'],
+        ['عدد عمليات البيع', str(len(sales))],
+    ], colWidths=[200, 150])
+    summary_table.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#4472C4')),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('GRID', (0, 0), (-1, -1), 1, colors.black),
+        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#F2F2F2')]),
+    ]))
+    elements.append(summary_table)
+    elements.append(Spacer(1, 30))
+
+    # Receptions detail
+    if receptions:
+        elements.append(Paragraph("تفاصيل استلام الحليب - Milk Receptions", styles["base"]['Heading2']))
+        elements.append(Spacer(1, 10))
+
+        rec_data = [['Supplier', 'Quantity (L)', 'Price/L', 'Total', 'Fat %']]
+        for r in receptions:
+            rec_data.append([
+                r.get('supplier_name', ''),
+                f"{r.get('quantity_liters', 0):.2f}",
+                f"{r.get('price_per_liter', 0):.3f}",
+                f"{r.get('total_amount', 0):.3f}",
+                f"{(r.get('quality_test') or {}).get('fat_percentage', 0):.1f}"
+            ])
+        rec_table = Table(rec_data, repeatRows=1)
+        rec_table.setStyle(TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#70AD47')),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('FONTSIZE', (0, 0), (-1, -1), 9),
+            ('GRID', (0, 0), (-1, -1), 1, colors.black),
+        ]))
+        elements.append(rec_table)
+
+    return _build(elements, A4, 30)
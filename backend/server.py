@@ -1,24 +1,43 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, Query
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, Query, Response, Request, Header
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
+from starlette.background import BackgroundTask
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
+import asyncio
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
+from pydantic import BaseModel, Field, ConfigDict, ValidationError
 from typing import List, Optional
+from collections import OrderedDict
+from contextlib import asynccontextmanager, nullcontext
 import uuid
+import time
+import json
+import re
+import base64
 from datetime import datetime, timezone, timedelta
+from zoneinfo import ZoneInfo
 import jwt
 import bcrypt
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
 import io
 import secrets
+import tempfile
+import hashlib
+import csv
+import zlib
 import aiosmtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from emergentintegrations.llm.chat import LlmChat, UserMessage
+import pdf_renderer
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -55,9 +74,314 @@ DEFAULT_CENTERS = [
     {"name": "غدو", "code": "GHADU", "address": "عُمان", "is_active": True},
 ]
 
+# ==================== DATABASE INDEXES (فهارس قاعدة البيانات) ====================
+
+# Collections looked up by their string `id` on almost every route
+ID_INDEXED_COLLECTIONS = [
+    "users", "suppliers", "customers", "milk_receptions", "sales", "payments",
+    "treasury_transactions", "collection_centers", "employees", "hr_employees",
+    "hr_attendance", "hr_leave_requests", "hr_expense_requests", "hr_car_contracts",
+    "hr_official_letters", "hr_fingerprint_devices", "hr_shifts", "hr_employee_shifts",
+    "hr_overtime", "hr_loans", "hr_loan_payments", "hr_documents", "hr_warnings",
+    "feed_companies", "feed_types", "feed_purchases", "payroll_periods", "payroll_records",
+    "activity_logs", "legal_contracts", "legal_cases", "legal_consultations", "legal_documents",
+    "projects", "project_tasks", "project_team_members", "project_milestones",
+    "daily_operations", "equipment", "maintenance_records", "incident_reports", "vehicles",
+    "marketing_campaigns", "marketing_leads", "social_media_posts", "sales_offers",
+    "market_returns", "market_sales_summaries", "zkteco_devices",
+]
+
+ACTIVE_ONLY = {"is_active": True}
+
+# Activity logs stay in the hot collection for this many days (TTL on logged_at);
+# older entries are served from monthly archive collections
+ACTIVITY_LOG_RETENTION_DAYS = max(2, int(os.environ.get('ACTIVITY_LOG_RETENTION_DAYS', 90)))
+
+# Stored responses for Idempotency-Key retries expire after this many hours
+IDEMPOTENCY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_TTL_HOURS', 24))
+# A claim whose handler has not finished within this many seconds (crashed or
+# restarted worker) can be taken over by a retry
+IDEMPOTENCY_LEASE_SECONDS = int(os.environ.get('IDEMPOTENCY_LEASE_SECONDS', 60))
+
+# Declarative index registry reconciled by ensure_indexes() at startup.
+# Each entry is passed to create_index(); "name" is the reconciliation key.
+MONGO_INDEXES = {
+    **{
+        collection: [{"keys": [("id", 1)], "name": "id_unique", "unique": True}]
+        for collection in ID_INDEXED_COLLECTIONS
+    },
+    "inventory": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True,
+         "partialFilterExpression": {"id": {"$exists": True}}},
+        {"keys": [("product_type", 1)], "name": "product_type"},
+    ],
+    "treasury": [
+        {"keys": [("type", 1)], "name": "type_unique", "unique": True},
+    ],
+    "users": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("username", 1)], "name": "username"},
+        {"keys": [("email", 1)], "name": "email"},
+    ],
+    "password_reset_tokens": [
+        {"keys": [("token", 1), ("used", 1)], "name": "token_used"},
+        {"keys": [("user_id", 1), ("used", 1)], "name": "user_used"},
+    ],
+    "user_settings": [
+        {"keys": [("user_id", 1)], "name": "user_id"},
+    ],
+    "collection_centers": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("code", 1)], "name": "code"},
+        {"keys": [("updated_at", 1), ("id", 1)], "name": "updated_at_id"},
+    ],
+    "suppliers": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("center_id", 1)], "name": "center_active", "partialFilterExpression": ACTIVE_ONLY},
+        {"keys": [("is_active", 1)], "name": "active_only", "partialFilterExpression": ACTIVE_ONLY},
+        {"keys": [("updated_at", 1), ("id", 1)], "name": "updated_at_id"},
+    ],
+    "customers": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("is_active", 1)], "name": "active_only", "partialFilterExpression": ACTIVE_ONLY},
+        {"keys": [("updated_at", 1), ("id", 1)], "name": "updated_at_id"},
+    ],
+    "feed_types": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("updated_at", 1), ("id", 1)], "name": "updated_at_id"},
+    ],
+    "milk_receptions": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("reception_date", -1)], "name": "reception_date"},
+        {"keys": [("supplier_id", 1), ("reception_date", -1)], "name": "supplier_reception_date"},
+        {"keys": [("center_id", 1), ("reception_date", -1)], "name": "center_reception_date"},
+    ],
+    "sales": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("sale_date", -1)], "name": "sale_date"},
+        {"keys": [("customer_id", 1), ("sale_date", -1)], "name": "customer_sale_date"},
+    ],
+    "payments": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("payment_date", -1)], "name": "payment_date"},
+        {"keys": [("payment_type", 1), ("status", 1), ("payment_date", -1)], "name": "type_status_payment_date"},
+        {"keys": [("status", 1), ("payment_date", -1)], "name": "status_payment_date"},
+        {"keys": [("related_id", 1), ("payment_type", 1), ("payment_date", -1)], "name": "related_type_payment_date"},
+    ],
+    "treasury_transactions": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("created_at", -1)], "name": "created_at"},
+        {"keys": [("transaction_type", 1), ("created_at", -1)], "name": "type_created_at"},
+    ],
+    "activity_logs": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("timestamp", -1)], "name": "timestamp"},
+        {"keys": [("user_id", 1), ("timestamp", -1)], "name": "user_timestamp"},
+        {"keys": [("action", 1), ("timestamp", -1)], "name": "action_timestamp"},
+        {"keys": [("logged_at", 1)], "name": "logged_at_ttl", "expireAfterSeconds": ACTIVITY_LOG_RETENTION_DAYS * 86400},
+    ],
+    "hr_employees": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("department", 1)], "name": "department_active", "partialFilterExpression": ACTIVE_ONLY},
+        {"keys": [("is_active", 1)], "name": "active_only", "partialFilterExpression": ACTIVE_ONLY},
+        {"keys": [("employee_code", 1)], "name": "employee_code"},
+        {"keys": [("name", 1)], "name": "name"},
+        {"keys": [("updated_at", 1), ("id", 1)], "name": "updated_at_id"},
+    ],
+    "hr_attendance": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("employee_id", 1), ("date", 1)], "name": "employee_date_unique", "unique": True},
+        {"keys": [("date", 1)], "name": "date"},
+    ],
+    "hr_leave_requests": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("status", 1), ("created_at", -1)], "name": "status_created_at"},
+        {"keys": [("employee_id", 1), ("created_at", -1)], "name": "employee_created_at"},
+    ],
+    "hr_expense_requests": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("status", 1), ("created_at", -1)], "name": "status_created_at"},
+        {"keys": [("employee_id", 1), ("created_at", -1)], "name": "employee_created_at"},
+    ],
+    "hr_official_letters": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("status", 1), ("created_at", -1)], "name": "status_created_at"},
+        {"keys": [("employee_id", 1), ("created_at", -1)], "name": "employee_created_at"},
+    ],
+    "hr_overtime": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("employee_id", 1), ("status", 1), ("date", -1)], "name": "employee_status_date"},
+    ],
+    "hr_loans": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("employee_id", 1), ("status", 1)], "name": "employee_status"},
+    ],
+    "hr_loan_payments": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("loan_id", 1)], "name": "loan_id"},
+    ],
+    "feed_purchases": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("purchase_date", -1)], "name": "purchase_date"},
+        {"keys": [("supplier_id", 1), ("purchase_date", -1)], "name": "supplier_purchase_date"},
+    ],
+    "idempotency_keys": [
+        {"keys": [("key", 1), ("user_id", 1)], "name": "key_user_unique", "unique": True},
+        {"keys": [("created_at", 1)], "name": "created_at_ttl", "expireAfterSeconds": IDEMPOTENCY_TTL_HOURS * 3600},
+    ],
+    "counters": [
+        {"keys": [("prefix", 1), ("year", 1)], "name": "prefix_year", "unique": True},
+    ],
+    "payroll_records": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("period_id", 1), ("employee_id", 1)], "name": "period_employee"},
+    ],
+    "payroll_dirty": [
+        {"keys": [("key", 1)], "name": "key_unique", "unique": True},
+        {"keys": [("changed_at", 1)], "name": "changed_at"},
+    ],
+    "treasury_daily_closings": [
+        {"keys": [("date", 1)], "name": "date_unique", "unique": True},
+    ],
+    "locks": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+    ],
+    "totals_writers": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("expires_at", 1)], "name": "expires_at_ttl", "expireAfterSeconds": 0},
+    ],
+    "inventory_movements": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("center_id", 1), ("product_type", 1), ("ts", 1)], "name": "center_product_ts"},
+        {"keys": [("ts", 1)], "name": "ts"},
+    ],
+    "inventory_stock": [
+        {"keys": [("center_id", 1), ("product_type", 1)], "name": "center_product_unique", "unique": True},
+    ],
+    "inventory_snapshots": [
+        {"keys": [("center_id", 1), ("product_type", 1), ("as_of", -1)], "name": "center_product_as_of", "unique": True},
+    ],
+    "daily_rollups": [
+        {"keys": [("center_id", 1), ("date", 1), ("shift", 1)], "name": "center_date_shift", "unique": True},
+        {"keys": [("date", 1)], "name": "date"},
+    ],
+}
+
+INDEX_OPTIONS = ("unique", "expireAfterSeconds", "partialFilterExpression")
+
+def index_definition(keys, options: dict) -> tuple:
+    """Comparable key spec and options of a registered or existing index"""
+    key_spec = tuple((field, int(order) if isinstance(order, (int, float)) else order) for field, order in keys)
+    return key_spec, tuple((option, options.get(option)) for option in INDEX_OPTIONS if options.get(option))
+
+async def ensure_indexes() -> dict:
+    """Create every registered index that does not exist yet, replacing indexes whose
+    name or definition changed"""
+    report = {"created": [], "replaced": [], "failed": []}
+    for collection_name, specs in MONGO_INDEXES.items():
+        collection = db[collection_name]
+        existing = {}
+        async for index in collection.list_indexes():
+            existing[index["name"]] = index
+        for spec in specs:
+            options = {k: v for k, v in spec.items() if k != "keys"}
+            definition = index_definition(spec["keys"], options)
+            current = existing.get(spec["name"])
+            if current is not None and index_definition(current["key"].items(), current) == definition:
+                continue
+            # An index with the same keys under another name (or this name with another
+            # definition) blocks create_index, so it has to go first
+            stale = [
+                index for name, index in existing.items()
+                if name != "_id_" and (name == spec["name"] or index_definition(index["key"].items(), {})[0] == definition[0])
+            ]
+            try:
+                for index in stale:
+                    await collection.drop_index(index["name"])
+                    existing.pop(index["name"], None)
+                await collection.create_index(spec["keys"], **options)
+                existing[spec["name"]] = {"name": spec["name"], "key": dict(spec["keys"]), **options}
+                if stale:
+                    report["replaced"].append(f"{collection_name}.{spec['name']}")
+                else:
+                    report["created"].append(f"{collection_name}.{spec['name']}")
+            except Exception as e:
+                logging.error(f"Error creating index {collection_name}.{spec['name']}: {e}")
+                report["failed"].append({"collection": collection_name, "index": spec["name"], "error": str(e)})
+                # Put back what was dropped so a failed unique build does not leave the collection unindexed
+                for index in stale:
+                    restore = {option: index[option] for option in INDEX_OPTIONS if index.get(option)}
+                    try:
+                        await collection.create_index(list(index["key"].items()), name=index["name"], **restore)
+                        existing[index["name"]] = index
+                    except Exception as restore_error:
+                        logging.error(f"Error restoring index {collection_name}.{index['name']}: {restore_error}")
+    return report
+
+async def get_index_report() -> dict:
+    """Report registered indexes that are missing and indexes that were never used"""
+    missing = []
+    unused = []
+    for collection_name, specs in MONGO_INDEXES.items():
+        collection = db[collection_name]
+        existing = set()
+        async for index in collection.list_indexes():
+            existing.add(index["name"])
+        for spec in specs:
+            if spec["name"] not in existing:
+                missing.append({"collection": collection_name, "index": spec["name"], "keys": spec["keys"]})
+        if not existing:
+            continue
+        try:
+            # $indexStats counters reset on mongod restart; "since" tells how long they cover
+            async for stats in collection.aggregate([{"$indexStats": {}}]):
+                if stats["name"] == "_id_":
+                    continue
+                accesses = stats.get("accesses", {})
+                if accesses.get("ops", 0) == 0:
+                    since = accesses.get("since")
+                    unused.append({
+                        "collection": collection_name,
+                        "index": stats["name"],
+                        "since": since.isoformat() if since else None
+                    })
+        except Exception as e:
+            logging.warning(f"Could not read index stats for {collection_name}: {e}")
+    return {"missing": missing, "unused": unused}
+
+background_tasks = []
+
 @app.on_event("startup")
 async def startup_event():
-    """Initialize default collection centers on startup"""
+    """Initialize default collection centers and database indexes on startup"""
+    try:
+        index_report = await ensure_indexes()
+        if index_report["created"]:
+            logging.info(f"Created indexes: {', '.join(index_report['created'])}")
+        if index_report["replaced"]:
+            logging.info(f"Replaced indexes: {', '.join(index_report['replaced'])}")
+        for failure in index_report["failed"]:
+            logging.warning(f"Missing index {failure['collection']}.{failure['index']}: {failure['error']}")
+    except Exception as e:
+        logging.error(f"Error reconciling database indexes: {e}")
+
+    try:
+        await backfill_updated_at()
+    except Exception as e:
+        logging.error(f"Error backfilling updated_at for delta sync: {e}")
+
+    try:
+        await seed_inventory_ledger()
+    except Exception as e:
+        logging.error(f"Error seeding inventory ledger: {e}")
+
+    activity_log_buffer.start()
+    # Also retries deferred side effects of bulk receptions when batching is off
+    group_commit.start()
+    background_tasks.append(asyncio.create_task(run_activity_log_archiver()))
+    background_tasks.append(asyncio.create_task(run_inventory_snapshots()))
+    background_tasks.append(asyncio.create_task(run_treasury_closings()))
+
     try:
         for center_data in DEFAULT_CENTERS:
             # Check if center already exists by code
@@ -71,6 +395,181 @@ async def startup_event():
     except Exception as e:
         logging.error(f"Error initializing default centers: {e}")
 
+# ==================== PAGINATION (تقسيم الصفحات) ====================
+
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 1000
+
+def encode_cursor(sort_value, doc_id: str) -> str:
+    """Encode the last (sort value, id) pair of a page as an opaque cursor"""
+    raw = json.dumps([sort_value, doc_id], default=str).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        sort_value, doc_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return sort_value, doc_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="مؤشر الصفحة غير صالح")
+
+def _after_cursor(sort_field: str, direction: int, sort_value, doc_id: str) -> dict:
+    """Build the keyset condition selecting rows strictly after the cursor"""
+    op = "$lt" if direction < 0 else "$gt"
+    if sort_field == "id":
+        return {"id": {op: doc_id}}
+    # MongoDB sorts null before any value, so nulls come last when descending
+    tie = {sort_field: sort_value, "id": {op: doc_id}}
+    if sort_value is None:
+        if direction < 0:
+            return tie
+        return {"$or": [{sort_field: {"$ne": None}}, tie]}
+    conditions = [{sort_field: {op: sort_value}}, tie]
+    if direction < 0:
+        conditions.append({sort_field: None})
+    return {"$or": conditions}
+
+async def paginate(response: Response, collection, query: dict, sort_field: str = "id",
+                   direction: int = -1, page_size: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None,
+                   projection: Optional[dict] = None) -> list:
+    """Return one keyset page of documents; the next cursor is sent in the X-Next-Cursor header"""
+    page_size = clamp_page_size(page_size)
+    docs = await fetch_page(collection, query, sort_field, direction, page_size + 1, cursor, projection)
+    return finish_page(response, docs, sort_field, page_size)
+
+def clamp_page_size(page_size: int) -> int:
+    return max(1, min(page_size, MAX_PAGE_SIZE))
+
+async def fetch_page(collection, query: dict, sort_field: str, direction: int, limit: int,
+                     cursor: Optional[str] = None, projection: Optional[dict] = None) -> list:
+    """Fetch up to `limit` documents that sort after the cursor"""
+    if cursor:
+        sort_value, doc_id = decode_cursor(cursor)
+        after = _after_cursor(sort_field, direction, sort_value, doc_id)
+        query = {"$and": [query, after]} if query else after
+
+    sort = [("id", direction)] if sort_field == "id" else [(sort_field, direction), ("id", direction)]
+    fields = {"_id": 0, **projection} if projection else {"_id": 0}
+    return await collection.find(query, fields).sort(sort).limit(limit).to_list(limit)
+
+def finish_page(response: Response, docs: list, sort_field: str, page_size: int) -> list:
+    """Trim a page fetched with one extra row and emit the next cursor if there is more"""
+    if len(docs) > page_size:
+        docs = docs[:page_size]
+        last = docs[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor(last.get(sort_field), last.get("id"))
+    return docs
+
+# ==================== PDF RENDERING (توليد ملفات PDF) ====================
+
+# ReportLab layout is CPU-bound; renderers run in worker processes so a large
+# report does not stall other requests. Workers are spawned lazily on first use.
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', 2))
+
+pdf_executor: Optional[ProcessPoolExecutor] = None
+pdf_stats = {"in_flight": 0, "rendered": 0, "failed": 0}
+
+def get_pdf_executor() -> ProcessPoolExecutor:
+    global pdf_executor
+    if pdf_executor is None:
+        pdf_executor = ProcessPoolExecutor(
+            max_workers=PDF_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=pdf_renderer.init_worker
+        )
+    return pdf_executor
+
+async def render_pdf(renderer, *payload) -> bytes:
+    """Run a pdf_renderer function with plain data payloads in the process pool"""
+    pdf_stats["in_flight"] += 1
+    try:
+        pdf_bytes = await asyncio.get_running_loop().run_in_executor(get_pdf_executor(), renderer, *payload)
+        pdf_stats["rendered"] += 1
+        return pdf_bytes
+    except Exception as e:
+        pdf_stats["failed"] += 1
+        logging.error(f"PDF rendering failed in {renderer.__name__}: {e}")
+        raise HTTPException(status_code=500, detail="تعذر إنشاء ملف PDF")
+    finally:
+        pdf_stats["in_flight"] -= 1
+
+# ==================== SEQUENCES (الترقيم التسلسلي) ====================
+
+# Document numbers come from per-(prefix, year) counters in the `counters`
+# collection. Each counter is seeded once from the highest number already
+# issued, so switching from count-based numbering cannot reuse a number.
+SEQUENCES = {
+    # prefix: (collection, number field, leading text before the sequence)
+    "FP": ("feed_purchases", "invoice_number", "FP-{year}-"),
+    "EMP": ("hr_employees", "employee_code", "EMP"),
+    "LTR": ("hr_official_letters", "letter_number", "LTR-{year}-"),
+    "CTR": ("legal_contracts", "contract_number", "CTR-{year}-"),
+    "CASE": ("legal_cases", "case_number", "CASE-{year}-"),
+    "PRJ": ("projects", "project_code", "PRJ-{year}-"),
+    "EQP": ("equipment", "equipment_code", "EQP-"),
+    "INC": ("incident_reports", "incident_number", "INC-{year}-"),
+    "VEH": ("vehicles", "vehicle_code", "VEH-"),
+    "CMP": ("marketing_campaigns", "campaign_code", "CMP-{year}-"),
+    "LEAD": ("marketing_leads", "lead_code", "LEAD-"),
+    "OFFER": ("sales_offers", "offer_code", "OFFER-"),
+    "RTN": ("market_returns", "return_code", "RTN-{year}-"),
+}
+
+# Numbers reserved per round trip; above 1 each worker hands out a private block,
+# trading gap-free numbering for fewer writes under heavy insert load.
+SEQUENCE_BLOCK_SIZE = max(1, int(os.environ.get('SEQUENCE_BLOCK_SIZE', 1)))
+
+sequence_blocks = {}  # (prefix, year) -> [next, last]
+sequence_locks = {}
+seeded_sequences = set()
+
+async def _seed_sequence(prefix: str, year: Optional[int]):
+    collection_name, field, lead_template = SEQUENCES[prefix]
+    lead = lead_template.format(year=year)
+    # Compare numerically: once numbers outgrow the pad width, "EMP10000" sorts below "EMP9999"
+    latest = await db[collection_name].aggregate([
+        {"$match": {field: {"$regex": f"^{re.escape(lead)}\\d+$"}}},
+        {"$group": {"_id": None, "highest": {"$max": {"$toLong": {"$substrCP": [f"${field}", len(lead), {"$strLenCP": f"${field}"}]}}}}}
+    ]).to_list(1)
+    highest = latest[0]["highest"] if latest else 0
+    # $max keeps a counter that is already ahead untouched
+    await db.counters.update_one(
+        {"prefix": prefix, "year": year},
+        {"$max": {"seq": highest}},
+        upsert=True
+    )
+
+async def _reserve_sequence(prefix: str, year: Optional[int], count: int) -> int:
+    """Atomically reserve `count` numbers and return the last one"""
+    key = (prefix, year)
+    if key not in seeded_sequences:
+        await _seed_sequence(prefix, year)
+        seeded_sequences.add(key)
+    counter = await db.counters.find_one_and_update(
+        {"prefix": prefix, "year": year},
+        {"$inc": {"seq": count}},
+        projection={"_id": 0, "seq": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return counter["seq"]
+
+async def next_sequence(prefix: str, year: Optional[int] = None) -> int:
+    """Next collision-free number for a document prefix (optionally per year)"""
+    if SEQUENCE_BLOCK_SIZE == 1:
+        return await _reserve_sequence(prefix, year, 1)
+    
+    key = (prefix, year)
+    lock = sequence_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        block = sequence_blocks.get(key)
+        if not block or block[0] > block[1]:
+            last = await _reserve_sequence(prefix, year, SEQUENCE_BLOCK_SIZE)
+            block = sequence_blocks[key] = [last - SEQUENCE_BLOCK_SIZE + 1, last]
+        number = block[0]
+        block[0] += 1
+        return number
+
 # ==================== MODELS ====================
 
 class UserBase(BaseModel):
@@ -131,6 +630,7 @@ class SupplierCreate(SupplierBase):
 class Supplier(SupplierBase):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
     is_active: bool = True
     total_supplied: float = 0.0
     balance: float = 0.0
@@ -163,6 +663,7 @@ class MilkReception(MilkReceptionBase):
     total_amount: float = 0.0
     is_paid: bool = False
     created_by: Optional[str] = None
+    center_id: Optional[str] = None  # مركز التجميع
 
 # Customer Models
 class CustomerBase(BaseModel):
@@ -179,6 +680,7 @@ class CustomerCreate(CustomerBase):
 class Customer(CustomerBase):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
     is_active: bool = True
     total_purchases: float = 0.0
     balance: float = 0.0
@@ -201,6 +703,7 @@ class Sale(SaleBase):
     total_amount: float = 0.0
     is_paid: bool = False
     created_by: Optional[str] = None
+    center_id: Optional[str] = None  # مركز التجميع
 
 # Inventory Models
 class InventoryBase(BaseModel):
@@ -297,6 +800,7 @@ class Employee(EmployeeBase):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     is_active: bool = True
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
 # Attendance Models (نماذج الحضور والانصراف)
 class AttendanceBase(BaseModel):
@@ -636,6 +1140,7 @@ class CollectionCenter(CollectionCenterBase):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     is_active: bool = True
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
 # Activity Log Models (سجل النشاط)
 class ActivityLog(BaseModel):
@@ -1234,6 +1739,7 @@ class FeedType(FeedTypeBase):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     is_active: bool = True
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    updated_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
 # Feed Purchase Models (مشتريات الأعلاف من رصيد المورد)
 class FeedPurchaseBase(BaseModel):
@@ -1269,18 +1775,109 @@ class FeedPurchase(FeedPurchaseBase):
 
 # ==================== AUTHENTICATION ====================
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+# bcrypt is CPU-bound (hundreds of ms per call), so it runs on a bounded thread
+# pool instead of the event loop; bcrypt releases the GIL while hashing.
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+BCRYPT_MAX_CONCURRENCY = int(os.environ.get('BCRYPT_MAX_CONCURRENCY', 4))
+
+password_executor = ThreadPoolExecutor(max_workers=BCRYPT_MAX_CONCURRENCY, thread_name_prefix="bcrypt")
+password_slots = asyncio.Semaphore(BCRYPT_MAX_CONCURRENCY)
+password_stats = {"in_flight": 0, "queued": 0, "completed": 0, "rehashed": 0}
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
+def _hash_password_sync(password: str) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
+
+def _verify_password_sync(plain_password: str, hashed_password: str) -> bool:
     return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
 
+async def _run_password_job(func, *args):
+    password_stats["queued"] += 1
+    try:
+        await password_slots.acquire()
+    finally:
+        password_stats["queued"] -= 1
+    password_stats["in_flight"] += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_executor, func, *args)
+    finally:
+        password_stats["in_flight"] -= 1
+        password_stats["completed"] += 1
+        password_slots.release()
+
+async def hash_password(password: str) -> str:
+    return await _run_password_job(_hash_password_sync, password)
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await _run_password_job(_verify_password_sync, plain_password, hashed_password)
+
+def password_needs_rehash(hashed_password: str) -> bool:
+    """True when a stored bcrypt hash was made with a different cost factor"""
+    try:
+        return int(hashed_password.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
+
+def password_metrics() -> dict:
+    return {"max_concurrency": BCRYPT_MAX_CONCURRENCY, "rounds": BCRYPT_ROUNDS, **password_stats}
+
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + timedelta(hours=ACCESS_TOKEN_EXPIRE_HOURS)
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
+# Authenticated-user cache (ذاكرة مؤقتة للمستخدمين)
+# Entries are dropped explicitly when a user changes in this process; other
+# uvicorn workers fall back to the short TTL, so keep it to seconds.
+USER_CACHE_TTL_SECONDS = float(os.environ.get('USER_CACHE_TTL_SECONDS', 30))
+USER_CACHE_MAX_SIZE = int(os.environ.get('USER_CACHE_MAX_SIZE', 1024))
+
+class UserCache:
+    """Small in-process TTL + LRU cache of user documents keyed by user id"""
+    
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+    
+    def get(self, user_id: str) -> Optional[dict]:
+        entry = self.entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[user_id]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(user_id)
+        self.hits += 1
+        return dict(entry[1])
+    
+    def put(self, user_id: str, user: dict):
+        if self.ttl <= 0:
+            return
+        self.entries[user_id] = (time.monotonic() + self.ttl, dict(user))
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+    
+    def invalidate(self, user_id: str):
+        if self.entries.pop(user_id, None) is not None:
+            self.invalidations += 1
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0
+        }
+
+user_cache = UserCache(USER_CACHE_TTL_SECONDS, USER_CACHE_MAX_SIZE)
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
         token = credentials.credentials
@@ -1288,9 +1885,12 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         user_id = payload.get("sub")
         if user_id is None:
             raise HTTPException(status_code=401, detail="Invalid token")
-        user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
+        user = user_cache.get(user_id)
         if user is None:
-            raise HTTPException(status_code=401, detail="User not found")
+            user = await db.users.find_one({"id": user_id}, {"_id": 0, "password": 0})
+            if user is None:
+                raise HTTPException(status_code=401, detail="User not found")
+            user_cache.put(user_id, user)
         return user
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
@@ -1304,6 +1904,192 @@ def require_role(allowed_roles: List[str]):
         return current_user
     return role_checker
 
+# Idempotency keys (منع تكرار العمليات المالية)
+# Money-moving POSTs accept an Idempotency-Key header. The first request claims the
+# key and stores its response; a retry with the same key gets the stored response
+# without running the handler again. Keys are per user and expire via TTL index.
+# An in-progress claim is a lease: once locked_until passes, a retry takes it over.
+
+class IdempotentRequest:
+    def __init__(self, claim: Optional[dict] = None, replay=None):
+        self.claim = claim
+        self.replay = replay
+        self.saved = False
+    
+    async def save(self, result):
+        """Store the handler's result for replays and return it unchanged"""
+        if self.claim is not None:
+            await db.idempotency_keys.update_one(
+                self.claim,
+                {"$set": {"status": "completed", "response": jsonable_encoder(result)}}
+            )
+            self.saved = True
+        return result
+    
+    def item_id(self, index: int) -> Optional[str]:
+        """Stable id for the index-th document a keyed request creates; None without a key"""
+        if self.claim is None:
+            return None
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, f"idempotency:{self.claim['user_id']}:{self.claim['key']}:{index}"))
+
+async def idempotency(
+    request: Request,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    current_user: dict = Depends(get_current_user)
+):
+    if not idempotency_key:
+        yield IdempotentRequest()
+        return
+    if len(idempotency_key) > 255:
+        raise HTTPException(status_code=400, detail="مفتاح التكرار طويل جداً")
+    
+    body = await request.body()
+    fingerprint = hashlib.sha256(
+        f"{request.method} {request.url.path}?{request.url.query}\n".encode() + body
+    ).hexdigest()
+    key = {"key": idempotency_key, "user_id": current_user["id"]}
+    # The lease id scopes save/release to this claim, so a handler that outlived its
+    # lease cannot overwrite or delete the claim of the retry that took over
+    claim = {**key, "lease_id": str(uuid.uuid4())}
+    now = datetime.now(timezone.utc)
+    locked_until = now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)
+    try:
+        await db.idempotency_keys.insert_one({
+            **claim,
+            "fingerprint": fingerprint,
+            "status": "in_progress",
+            "locked_until": locked_until,
+            "created_at": now
+        })
+    except DuplicateKeyError:
+        stored = await db.idempotency_keys.find_one(key, {"_id": 0})
+        if stored is not None and stored["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="مفتاح التكرار مستخدم لطلب مختلف")
+        if stored is not None and stored["status"] == "completed":
+            response.headers["Idempotent-Replay"] = "true"
+            yield IdempotentRequest(replay=stored["response"])
+            return
+        taken = None
+        if stored is not None:
+            taken = await db.idempotency_keys.find_one_and_update(
+                {**key, "status": "in_progress", "$or": [
+                    {"locked_until": {"$lt": now}},
+                    {"locked_until": {"$exists": False}}
+                ]},
+                {"$set": {"lease_id": claim["lease_id"], "locked_until": locked_until}}
+            )
+        if taken is None:
+            raise HTTPException(status_code=409, detail="الطلب الأصلي قيد المعالجة، أعد المحاولة لاحقاً")
+    
+    handle = IdempotentRequest(claim)
+    try:
+        yield handle
+    except Exception:
+        # Failed requests release the key so the client can retry them
+        await db.idempotency_keys.delete_one(claim)
+        raise
+    if not handle.saved:
+        await db.idempotency_keys.delete_one(claim)
+
+# Write-behind activity log buffer (سجل النشاط المؤجل)
+# Entries are queued in memory and written with insert_many by size or interval,
+# so write endpoints do not wait on the audit insert. When the buffer is full,
+# entries are written directly instead of being dropped.
+ACTIVITY_LOG_BATCH_SIZE = int(os.environ.get('ACTIVITY_LOG_BATCH_SIZE', 200))
+ACTIVITY_LOG_FLUSH_SECONDS = float(os.environ.get('ACTIVITY_LOG_FLUSH_SECONDS', 1.0))
+ACTIVITY_LOG_BUFFER_MAX = int(os.environ.get('ACTIVITY_LOG_BUFFER_MAX', 10000))
+
+class ActivityLogBuffer:
+    def __init__(self, batch_size: int, flush_seconds: float, max_size: int):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_size = max_size
+        self.entries = []
+        self.wakeup = asyncio.Event()
+        self.stopping = False
+        self.task = None
+        self.stats = {
+            "flushes": 0,
+            "written": 0,
+            "direct_writes": 0,
+            "failed_flushes": 0,
+            "dropped": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0
+        }
+    
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+    
+    def start(self):
+        if not self.running:
+            self.stopping = False
+            self.task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Stop the background flusher and write whatever is still queued"""
+        if self.task is not None:
+            # Let the loop finish its current flush and drain; cancelling it mid-flush
+            # would lose the batch already taken off the buffer
+            self.stopping = True
+            self.wakeup.set()
+            await self.task
+            self.task = None
+        while self.entries:
+            if not await self.flush():
+                break
+    
+    async def add(self, entry: dict):
+        if not self.running or len(self.entries) >= self.max_size:
+            self.stats["direct_writes"] += 1
+            await db.activity_logs.insert_one(entry)
+            return
+        self.entries.append(entry)
+        if len(self.entries) >= self.batch_size:
+            self.wakeup.set()
+    
+    async def flush(self) -> bool:
+        if not self.entries:
+            return True
+        batch, self.entries = self.entries[:self.batch_size], self.entries[self.batch_size:]
+        started = time.perf_counter()
+        try:
+            await db.activity_logs.insert_many(batch, ordered=False)
+        except Exception as e:
+            self.stats["failed_flushes"] += 1
+            logging.error(f"Activity log flush failed ({len(batch)} entries): {e}")
+            # Put the batch back while there is room; anything beyond the cap is lost
+            room = max(0, self.max_size - len(self.entries))
+            self.stats["dropped"] += max(0, len(batch) - room)
+            self.entries = batch[:room] + self.entries
+            return False
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.stats["flushes"] += 1
+        self.stats["written"] += len(batch)
+        self.stats["last_flush_ms"] = round(elapsed_ms, 2)
+        self.stats["max_flush_ms"] = round(max(self.stats["max_flush_ms"], elapsed_ms), 2)
+        return True
+    
+    async def _run(self):
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            while self.entries:
+                if not await self.flush():
+                    break
+                if len(self.entries) < self.batch_size and not self.stopping:
+                    break
+    
+    def metrics(self) -> dict:
+        return {"depth": len(self.entries), "capacity": self.max_size, "running": self.running, **self.stats}
+
+activity_log_buffer = ActivityLogBuffer(ACTIVITY_LOG_BATCH_SIZE, ACTIVITY_LOG_FLUSH_SECONDS, ACTIVITY_LOG_BUFFER_MAX)
+
 # Activity logging helper
 async def log_activity(user_id: str, user_name: str, action: str, entity_type: str = None, 
                        entity_id: str = None, entity_name: str = None, details: str = None,
@@ -1319,7 +2105,9 @@ async def log_activity(user_id: str, user_name: str, action: str, entity_type: s
         center_id=center_id,
         center_name=center_name
     )
-    await db.activity_logs.insert_one(activity.model_dump())
+    entry = activity.model_dump()
+    entry["logged_at"] = datetime.now(timezone.utc)  # BSON date for the TTL index
+    await activity_log_buffer.add(entry)
 
 # Email sending helper
 SMTP_USE_SSL = os.environ.get('SMTP_USE_SSL', 'false').lower() == 'true'
@@ -1412,7 +2200,7 @@ async def register(user_data: UserCreate):
     
     user = User(**user_data.model_dump(exclude={"password"}))
     user_dict = user.model_dump()
-    user_dict["password"] = hash_password(user_data.password)
+    user_dict["password"] = await hash_password(user_data.password)
     
     await db.users.insert_one(user_dict)
     
@@ -1428,9 +2216,19 @@ async def login(credentials: UserLogin):
     user = await db.users.find_one({"username": credentials.username})
     # Check for both password and password_hash fields for compatibility
     password_field = user.get("password_hash") or user.get("password") if user else None
-    if not user or not password_field or not verify_password(credentials.password, password_field):
+    if not user or not password_field or not await verify_password(credentials.password, password_field):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
+    # Upgrade hashes made with an older cost factor while the plain password is at hand
+    if password_needs_rehash(password_field):
+        new_hash = await hash_password(credentials.password)
+        await db.users.update_one(
+            {"id": user["id"]},
+            {"$set": {"password_hash": new_hash, "password": new_hash}}
+        )
+        user_cache.invalidate(user["id"])
+        password_stats["rehashed"] += 1
+    
     token = create_access_token({"sub": user["id"], "role": user["role"]})
     
     # Log login activity
@@ -1469,6 +2267,7 @@ async def update_profile(profile_data: UserUpdate, current_user: dict = Depends(
             {"id": current_user["id"]},
             {"$set": update_data}
         )
+        user_cache.invalidate(current_user["id"])
     user = await db.users.find_one({"id": current_user["id"]}, {"_id": 0, "password": 0})
     return user
 
@@ -1476,14 +2275,15 @@ async def update_profile(profile_data: UserUpdate, current_user: dict = Depends(
 async def change_password(password_data: PasswordChange, current_user: dict = Depends(get_current_user)):
     user = await db.users.find_one({"id": current_user["id"]})
     password_field = user.get("password_hash") or user.get("password") if user else None
-    if not password_field or not verify_password(password_data.current_password, password_field):
+    if not password_field or not await verify_password(password_data.current_password, password_field):
         raise HTTPException(status_code=400, detail="Current password is incorrect")
     
-    new_hash = hash_password(password_data.new_password)
+    new_hash = await hash_password(password_data.new_password)
     await db.users.update_one(
         {"id": current_user["id"]},
         {"$set": {"password_hash": new_hash, "password": new_hash}}
     )
+    user_cache.invalidate(current_user["id"])
     
     await log_activity(
         user_id=current_user["id"],
@@ -1553,11 +2353,12 @@ async def reset_password(token: str = Form(...), new_password: str = Form(...)):
         raise HTTPException(status_code=400, detail="Reset token has expired")
     
     # Update password
-    new_hash = hash_password(new_password)
+    new_hash = await hash_password(new_password)
     await db.users.update_one(
         {"id": reset_token["user_id"]},
         {"$set": {"password": new_hash}}
     )
+    user_cache.invalidate(reset_token["user_id"])
     
     # Mark token as used
     await db.password_reset_tokens.update_one(
@@ -1621,7 +2422,7 @@ async def create_center(center_data: CollectionCenterCreate, current_user: dict
 async def update_center(center_id: str, center_data: CollectionCenterCreate, current_user: dict = Depends(require_role(["admin"]))):
     result = await db.collection_centers.update_one(
         {"id": center_id},
-        {"$set": center_data.model_dump()}
+        touch({"$set": center_data.model_dump()})
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Center not found")
@@ -1647,7 +2448,7 @@ async def delete_center(center_id: str, current_user: dict = Depends(require_rol
     
     result = await db.collection_centers.update_one(
         {"id": center_id},
-        {"$set": {"is_active": False}}
+        touch({"$set": {"is_active": False}})
     )
     
     await log_activity(
@@ -1664,13 +2465,110 @@ async def delete_center(center_id: str, current_user: dict = Depends(require_rol
 
 # ==================== ACTIVITY LOG ROUTES (سجل النشاط) ====================
 
+ACTIVITY_LOG_ARCHIVE_INTERVAL_HOURS = float(os.environ.get('ACTIVITY_LOG_ARCHIVE_INTERVAL_HOURS', 24))
+ACTIVITY_ARCHIVE_PATTERN = r"^activity_logs_\d{4}_\d{2}$"
+
+def activity_archive_name(month: str) -> str:
+    """Archive collection for a YYYY-MM month, e.g. activity_logs_2025_03"""
+    return f"activity_logs_{month[:4]}_{month[5:7]}"
+
+def hot_activity_floor() -> str:
+    """Entries newer than this are always read from the hot collection.
+    
+    One day short of the TTL, so entries are read from the archive before
+    they can expire from the hot collection.
+    """
+    return (datetime.now(timezone.utc) - timedelta(days=ACTIVITY_LOG_RETENTION_DAYS - 1)).isoformat()
+
+async def archive_activity_logs() -> dict:
+    """Copy activity logs up to the start of today into monthly archive collections.
+    
+    Progress is kept as a watermark in system_state and $merge skips entries that
+    are already archived, so the job is safe to rerun or run from several workers.
+    """
+    state = await db.system_state.find_one({"id": "activity_log_archive"}, {"_id": 0}) or {}
+    cutoff = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
+    
+    start = state.get("archived_until")
+    if start is None:
+        oldest = await db.activity_logs.find({}, {"_id": 0, "timestamp": 1}).sort("timestamp", 1).limit(1).to_list(1)
+        start = oldest[0]["timestamp"] if oldest else cutoff
+    
+    months = []
+    while start < cutoff:
+        year, month = int(start[:4]), int(start[5:7])
+        next_month = f"{year + month // 12}-{month % 12 + 1:02d}-01T00:00:00+00:00"
+        end = min(next_month, cutoff)
+        target = activity_archive_name(start[:7])
+        for spec in MONGO_INDEXES["activity_logs"]:
+            if "expireAfterSeconds" not in spec:
+                await db[target].create_index(spec["keys"], **{k: v for k, v in spec.items() if k != "keys"})
+        await db.activity_logs.aggregate([
+            {"$match": {"timestamp": {"$gte": start, "$lt": end}}},
+            {"$project": {"_id": 0, "logged_at": 0}},
+            {"$merge": {"into": target, "on": "id", "whenMatched": "keepExisting", "whenNotMatched": "insert"}}
+        ]).to_list(None)
+        months.append(target)
+        start = end
+    
+    # Entries written before the TTL field existed would otherwise never expire. Only
+    # entries that are archived by now get one, so the TTL monitor cannot remove
+    # history that has not been copied yet; an unparseable timestamp keeps the entry
+    # for a full retention period from now instead of failing the job.
+    await db.activity_logs.update_many(
+        {"logged_at": {"$exists": False}, "timestamp": {"$lt": cutoff}},
+        [{"$set": {"logged_at": {"$dateFromString": {"dateString": "$timestamp", "onError": "$$NOW", "onNull": "$$NOW"}}}}]
+    )
+    
+    await db.system_state.update_one(
+        {"id": "activity_log_archive"},
+        {
+            "$max": {"archived_until": cutoff},
+            "$set": {"last_run": datetime.now(timezone.utc).isoformat()}
+        },
+        upsert=True
+    )
+    return {"archived_until": cutoff, "collections": months}
+
+async def run_activity_log_archiver():
+    while True:
+        try:
+            result = await archive_activity_logs()
+            if result["collections"]:
+                logging.info(f"Archived activity logs into {', '.join(result['collections'])}")
+        except Exception as e:
+            logging.error(f"Error archiving activity logs: {e}")
+        await asyncio.sleep(ACTIVITY_LOG_ARCHIVE_INTERVAL_HOURS * 3600)
+
+async def activity_log_partitions(start_date: Optional[str], end_date: Optional[str]) -> list:
+    """(collection, timestamp bounds) pairs, newest first, that cover the requested range"""
+    floor = hot_activity_floor()
+    partitions = []
+    if not end_date or end_date >= floor:
+        partitions.append((db.activity_logs, {"$gte": floor}))
+    if start_date and start_date >= floor:
+        return partitions
+    
+    archives = await db.list_collection_names(filter={"name": {"$regex": ACTIVITY_ARCHIVE_PATTERN}})
+    for name in sorted(archives, reverse=True):
+        month = f"{name[14:18]}-{name[19:21]}"
+        if start_date and month < start_date[:7]:
+            continue
+        if end_date and month > end_date[:7]:
+            continue
+        partitions.append((db[name], {"$lt": floor}))
+    return partitions
+
 @api_router.get("/activity-logs")
 async def get_activity_logs(
+    response: Response,
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
     user_id: Optional[str] = None,
     action: Optional[str] = None,
     limit: int = 100,
+    page_size: Optional[int] = None,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -1686,8 +2584,15 @@ async def get_activity_logs(
         else:
             query["timestamp"] = {"$lte": end_date}
     
-    logs = await db.activity_logs.find(query, {"_id": 0}).sort("timestamp", -1).to_list(limit)
-    return logs
+    # Walk the hot collection, then monthly archives, only until the page is full
+    page_size = clamp_page_size(page_size or limit)
+    logs = []
+    for collection, bounds in await activity_log_partitions(start_date, end_date):
+        partition_query = {"$and": [query, {"timestamp": bounds}]} if query else {"timestamp": bounds}
+        logs += await fetch_page(collection, partition_query, "timestamp", -1, page_size + 1 - len(logs), cursor, {"logged_at": 0})
+        if len(logs) > page_size:
+            break
+    return finish_page(response, logs, "timestamp", page_size)
 
 # ==================== SUPPLIER ROUTES ====================
 
@@ -1711,11 +2616,11 @@ async def create_supplier(supplier_data: SupplierCreate, current_user: dict = De
     return supplier
 
 @api_router.get("/suppliers", response_model=List[Supplier])
-async def get_suppliers(center_id: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+async def get_suppliers(response: Response, center_id: Optional[str] = None, page_size: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, current_user: dict = Depends(get_current_user)):
     query = {"is_active": True}
     if center_id:
         query["center_id"] = center_id
-    suppliers = await db.suppliers.find(query, {"_id": 0}).to_list(1000)
+    suppliers = await paginate(response, db.suppliers, query, page_size=page_size, cursor=cursor)
     return suppliers
 
 @api_router.get("/suppliers/{supplier_id}", response_model=Supplier)
@@ -1729,7 +2634,7 @@ async def get_supplier(supplier_id: str, current_user: dict = Depends(get_curren
 async def update_supplier(supplier_id: str, supplier_data: SupplierCreate, current_user: dict = Depends(get_current_user)):
     result = await db.suppliers.update_one(
         {"id": supplier_id},
-        {"$set": supplier_data.model_dump()}
+        touch({"$set": supplier_data.model_dump()})
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Supplier not found")
@@ -1755,7 +2660,7 @@ async def delete_supplier(supplier_id: str, current_user: dict = Depends(require
     
     result = await db.suppliers.update_one(
         {"id": supplier_id},
-        {"$set": {"is_active": False}}
+        touch({"$set": {"is_active": False}})
     )
     
     await log_activity(
@@ -1770,28 +2675,704 @@ async def delete_supplier(supplier_id: str, current_user: dict = Depends(require
     
     return {"message": "Supplier deleted successfully"}
 
+# ==================== DAILY ROLLUPS (الملخصات اليومية) ====================
+
+LOCAL_TIMEZONE = os.environ.get('LOCAL_TIMEZONE', 'Asia/Muscat')
+LOCAL_TZ = ZoneInfo(LOCAL_TIMEZONE)
+EVENING_SHIFT_HOUR = 12  # receptions and sales from noon onward belong to the evening shift
+
+def rollup_key(timestamp: str, center_id: Optional[str]) -> dict:
+    """Map an ISO timestamp to its (center, local date, shift) rollup bucket"""
+    moment = datetime.fromisoformat(timestamp)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    local = moment.astimezone(LOCAL_TZ)
+    return {
+        "center_id": center_id,
+        "date": local.date().isoformat(),
+        "shift": "evening" if local.hour >= EVENING_SHIFT_HOUR else "morning"
+    }
+
+def checked_rollup_key(timestamp: str, center_id: Optional[str]) -> dict:
+    """rollup_key for a document about to be written; rejects unparseable dates up front"""
+    try:
+        return rollup_key(timestamp, center_id)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="صيغة التاريخ غير صحيحة")
+
+def reception_rollup_inc(reception: MilkReception) -> dict:
+    quality = reception.quality_test
+    return {
+        "reception_liters": reception.quantity_liters,
+        "reception_amount": reception.total_amount,
+        "reception_count": 1,
+        "fat_sum": quality.fat_percentage,
+        "protein_sum": quality.protein_percentage
+    }
+
+def sale_rollup_inc(sale: Sale) -> dict:
+    return {
+        "sales_liters": sale.quantity_liters,
+        "sales_amount": sale.total_amount,
+        "sales_count": 1
+    }
+
+def merge_inc(target: dict, inc: dict) -> dict:
+    """Add one $inc document into an accumulated one"""
+    for field, amount in inc.items():
+        target[field] = target.get(field, 0) + amount
+    return target
+
+async def record_reception_rollup(reception: MilkReception, key: dict):
+    await db.daily_rollups.update_one(
+        key,
+        {"$inc": reception_rollup_inc(reception), "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}},
+        upsert=True
+    )
+
+async def record_sale_rollup(sale: Sale, key: dict):
+    await db.daily_rollups.update_one(
+        key,
+        {"$inc": sale_rollup_inc(sale), "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}},
+        upsert=True
+    )
+
+def _rollup_pipeline(date_field: str, center_lookup: dict, center_field: str, sums: dict) -> list:
+    """Aggregate raw documents into (center, local date, shift) buckets"""
+    return [
+        {"$lookup": center_lookup},
+        {"$project": {
+            "center_id": {"$ifNull": ["$center_id", {"$first": f"$_center.{center_field}"}]},
+            "moment": {"$dateFromString": {"dateString": f"${date_field}"}},
+            "quantity_liters": 1,
+            "total_amount": 1,
+            "quality_test": 1
+        }},
+        {"$group": {
+            "_id": {
+                "center_id": "$center_id",
+                "date": {"$dateToString": {"format": "%Y-%m-%d", "date": "$moment", "timezone": LOCAL_TIMEZONE}},
+                "shift": {"$cond": [
+                    {"$gte": [{"$hour": {"date": "$moment", "timezone": LOCAL_TIMEZONE}}, EVENING_SHIFT_HOUR]},
+                    "evening", "morning"
+                ]}
+            },
+            **sums
+        }}
+    ]
+
+# Rebuild gate (بوابة إعادة البناء)
+# daily_rollups and inventory_stock are $inc'ed by live writes and recomputed from
+# their source documents by the rebuilds. A source document inserted before a
+# rebuild reads the sources but $inc'ed after it replaces the totals would be
+# counted twice (lost, the other way round), so live writers register for the
+# span from insert to $inc, and a rebuild closes the gate and waits for the
+# registered writers before it reads anything.
+TOTALS_WRITER_LEASE_SECONDS = int(os.environ.get('TOTALS_WRITER_LEASE_SECONDS', 60))
+TOTALS_WRITER_WAIT_SECONDS = float(os.environ.get('TOTALS_WRITER_WAIT_SECONDS', 30))
+TOTALS_REBUILD_LEASE_SECONDS = int(os.environ.get('TOTALS_REBUILD_LEASE_SECONDS', 1800))
+
+@asynccontextmanager
+async def totals_writer():
+    """Hold off rebuilds while source documents and their $inc'ed totals are written.
+
+    Yields the rebuild generation the write runs under; it cannot change until the
+    block exits. Waits while a rebuild is running and gives up with a 503.
+    """
+    registration = str(uuid.uuid4())
+    deadline = time.monotonic() + TOTALS_WRITER_WAIT_SECONDS
+    while True:
+        now = datetime.now(timezone.utc)
+        # Register first and look at the gate second; a rebuild does the opposite,
+        # so at least one of the two sees the other
+        await db.totals_writers.insert_one({
+            "id": registration,
+            "expires_at": now + timedelta(seconds=TOTALS_WRITER_LEASE_SECONDS)
+        })
+        gate = await db.locks.find_one({"id": "totals_rebuild"}, {"_id": 0}) or {}
+        locked_until = gate.get("locked_until")
+        if locked_until is None or locked_until.replace(tzinfo=timezone.utc) < now:
+            break
+        await db.totals_writers.delete_one({"id": registration})
+        if time.monotonic() >= deadline:
+            raise HTTPException(status_code=503, detail="إعادة بناء الإجماليات قيد التنفيذ، أعد المحاولة لاحقاً")
+        await asyncio.sleep(0.2)
+    try:
+        yield gate.get("generation", 0)
+    finally:
+        await db.totals_writers.delete_one({"id": registration})
+
+@asynccontextmanager
+async def totals_rebuild():
+    """Close the gate for live totals writers and wait until the registered ones are done"""
+    owner = str(uuid.uuid4())
+    now = datetime.now(timezone.utc)
+    try:
+        await db.locks.find_one_and_update(
+            {"id": "totals_rebuild", "$or": [{"locked_until": {"$lt": now}}, {"locked_until": {"$exists": False}}]},
+            {
+                "$set": {"owner": owner, "locked_until": now + timedelta(seconds=TOTALS_REBUILD_LEASE_SECONDS)},
+                "$inc": {"generation": 1}
+            },
+            upsert=True
+        )
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="إعادة بناء الإجماليات قيد التنفيذ")
+    try:
+        # A writer that died without deregistering stops counting once its lease expires
+        while await db.totals_writers.count_documents({"expires_at": {"$gt": datetime.now(timezone.utc)}}, limit=1):
+            await asyncio.sleep(0.2)
+        yield
+    finally:
+        await db.locks.update_one({"id": "totals_rebuild", "owner": owner}, {"$unset": {"owner": "", "locked_until": ""}})
+
+async def replace_rebuilt(collection, key_fields: tuple, documents, started: str):
+    """Swap rebuilt documents in one key at a time, then drop keys the rebuild no longer
+    produced. Runs inside totals_rebuild(), so no live $inc lands in between."""
+    operations = [
+        ReplaceOne({field: document.get(field) for field in key_fields}, document, upsert=True)
+        for document in documents
+    ]
+    if operations:
+        await collection.bulk_write(operations, ordered=False)
+    await collection.delete_many({"updated_at": {"$lt": started}})
+
+async def rebuild_daily_rollups() -> dict:
+    """Recompute daily_rollups from the full reception and sales history"""
+    reception_pipeline = _rollup_pipeline(
+        "reception_date",
+        {"from": "suppliers", "localField": "supplier_id", "foreignField": "id", "as": "_center"},
+        "center_id",
+        {
+            "reception_liters": {"$sum": "$quantity_liters"},
+            "reception_amount": {"$sum": "$total_amount"},
+            "reception_count": {"$sum": 1},
+            "fat_sum": {"$sum": "$quality_test.fat_percentage"},
+            "protein_sum": {"$sum": "$quality_test.protein_percentage"}
+        }
+    )
+    sales_pipeline = _rollup_pipeline(
+        "sale_date",
+        {"from": "users", "localField": "created_by", "foreignField": "id", "as": "_center"},
+        "center_id",
+        {
+            "sales_liters": {"$sum": "$quantity_liters"},
+            "sales_amount": {"$sum": "$total_amount"},
+            "sales_count": {"$sum": 1}
+        }
+    )
+    async with totals_rebuild():
+        started = datetime.now(timezone.utc).isoformat()
+        reception_groups, sales_groups = await asyncio.gather(
+            db.milk_receptions.aggregate(reception_pipeline, allowDiskUse=True).to_list(None),
+            db.sales.aggregate(sales_pipeline, allowDiskUse=True).to_list(None)
+        )
+        
+        rollups = {}
+        for group in reception_groups + sales_groups:
+            key = group.pop("_id")
+            bucket = (key.get("center_id"), key["date"], key["shift"])
+            rollups.setdefault(bucket, {**key, "updated_at": started}).update(group)
+        
+        await replace_rebuilt(db.daily_rollups, ("center_id", "date", "shift"), rollups.values(), started)
+    return {"rollups": len(rollups), "receptions_groups": len(reception_groups), "sales_groups": len(sales_groups)}
+
+async def read_rollups(start_date: str, end_date: str, center_id: Optional[str] = None) -> list:
+    """Fetch rollup buckets for an inclusive range of local dates (YYYY-MM-DD)"""
+    query = {"date": {"$gte": start_date, "$lte": end_date}}
+    if center_id:
+        query["center_id"] = center_id
+    return await db.daily_rollups.find(query, {"_id": 0}).to_list(None)
+
+def sum_rollups(rollups: list) -> dict:
+    fields = ("reception_liters", "reception_amount", "reception_count", "fat_sum", "protein_sum",
+              "sales_liters", "sales_amount", "sales_count")
+    return {field: sum(r.get(field, 0) for r in rollups) for field in fields}
+
+def local_today() -> str:
+    return datetime.now(LOCAL_TZ).date().isoformat()
+
+def local_date(timestamp: str) -> str:
+    """Local calendar date of an ISO timestamp"""
+    moment = datetime.fromisoformat(timestamp)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(LOCAL_TZ).date().isoformat()
+
+def utc_timestamp(value: str) -> str:
+    """Normalize an ISO timestamp to the UTC form stored in the database, so it compares
+    correctly as text (a Z suffix or a local offset would not)"""
+    try:
+        moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        raise HTTPException(status_code=400, detail="صيغة التاريخ غير صحيحة")
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc).isoformat()
+
+def local_day_bounds(date: str):
+    """UTC ISO bounds [start, end) of a local calendar day, for querying raw timestamps"""
+    start = datetime.fromisoformat(date).replace(tzinfo=LOCAL_TZ)
+    return start.astimezone(timezone.utc).isoformat(), (start + timedelta(days=1)).astimezone(timezone.utc).isoformat()
+
+# ==================== INVENTORY LEDGER (سجل حركة المخزون) ====================
+# Every stock change is appended to inventory_movements; per-(center, product)
+# documents in inventory_stock hold the running quantity and are $inc'ed from
+# the same movements, so regions do not contend on one document. Daily snapshots
+# in inventory_snapshots let stock-at-time queries replay only a short tail.
+INVENTORY_SNAPSHOT_INTERVAL_HOURS = float(os.environ.get('INVENTORY_SNAPSHOT_INTERVAL_HOURS', 24))
+
+def stock_movement(center_id: Optional[str], quantity: float, kind: str, source_id: Optional[str] = None,
+                   product_type: str = "raw_milk", ts: Optional[str] = None, **details) -> dict:
+    """Build one ledger entry; quantity is signed (receipts positive, issues negative)"""
+    return {
+        "id": str(uuid.uuid4()),
+        "center_id": center_id,
+        "product_type": product_type,
+        "quantity": quantity,
+        "kind": kind,
+        "source_id": source_id,
+        "ts": ts or datetime.now(timezone.utc).isoformat(),
+        **details
+    }
+
+async def record_stock_movements(movements: List[dict]):
+    """Append movements to the ledger and apply them to the stock documents"""
+    if not movements:
+        return
+    await insert_stock_movements(movements)
+    await apply_stock_movements(movements)
+
+async def insert_stock_movements(movements: List[dict]) -> List[dict]:
+    """Append movements to the ledger and return the ones it did not have yet; ids already
+    there are skipped, so a retry is safe"""
+    try:
+        await db.inventory_movements.insert_many([dict(movement) for movement in movements], ordered=False)
+    except BulkWriteError as e:
+        if e.details.get("writeConcernErrors") or any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+            raise
+        duplicates = {error["index"] for error in e.details.get("writeErrors", [])}
+        return [movement for i, movement in enumerate(movements) if i not in duplicates]
+    return movements
+
+async def apply_stock_movements(movements: List[dict]):
+    """Add movements to the per-(center, product) stock documents"""
+    deltas = {}
+    for movement in movements:
+        key = (movement["center_id"], movement["product_type"])
+        delta = deltas.setdefault(key, {"quantity": 0.0, "ts": movement["ts"]})
+        delta["quantity"] += movement["quantity"]
+        delta["ts"] = max(delta["ts"], movement["ts"])
+    if not deltas:
+        return
+    now = datetime.now(timezone.utc).isoformat()
+    await db.inventory_stock.bulk_write([
+        UpdateOne(
+            {"center_id": center_id, "product_type": product_type},
+            {"$inc": {"quantity": delta["quantity"]}, "$max": {"last_movement_at": delta["ts"]}, "$set": {"updated_at": now}},
+            upsert=True
+        )
+        for (center_id, product_type), delta in deltas.items()
+    ], ordered=False)
+
+async def rebuild_inventory_stock() -> dict:
+    """Recompute every stock document from the full ledger"""
+    pipeline = [
+        {"$group": {
+            "_id": {"center_id": "$center_id", "product_type": "$product_type"},
+            "quantity": {"$sum": "$quantity"},
+            "last_movement_at": {"$max": "$ts"}
+        }}
+    ]
+    async with totals_rebuild():
+        started = datetime.now(timezone.utc).isoformat()
+        stock = [
+            {**group["_id"], "quantity": group["quantity"], "last_movement_at": group["last_movement_at"], "updated_at": started}
+            async for group in db.inventory_movements.aggregate(pipeline, allowDiskUse=True)
+        ]
+        await replace_rebuilt(db.inventory_stock, ("center_id", "product_type"), stock, started)
+    return {"stock_documents": len(stock)}
+
+async def seed_inventory_ledger():
+    """Open the ledger with the legacy global raw_milk quantity the first time it runs"""
+    if await db.inventory_movements.count_documents({}, limit=1):
+        return
+    legacy = await db.inventory.find_one({"product_type": "raw_milk", "id": {"$exists": False}}, {"_id": 0})
+    if legacy and legacy.get("quantity_liters"):
+        # Every worker seeds at startup: the fixed id lets only one insert it, and
+        # only that one applies it to the stock
+        opening = {**stock_movement(None, legacy["quantity_liters"], "opening_balance"), "id": "opening_balance:raw_milk"}
+        async with totals_writer():
+            await apply_stock_movements(await insert_stock_movements([opening]))
+
+async def take_inventory_snapshots(as_of: Optional[str] = None) -> dict:
+    """Store the stock of every (center, product) as of a moment (default: start of today, local time)"""
+    as_of = utc_timestamp(as_of) if as_of else local_day_bounds(local_today())[0]
+    # Summed from the ledger itself: inventory_stock trails the ledger while a
+    # movement is being recorded, and a snapshot must not capture that gap
+    taken_at = datetime.now(timezone.utc).isoformat()
+    operations = [
+        UpdateOne(
+            {**group["_id"], "as_of": as_of},
+            {"$set": {"quantity": group["quantity"], "taken_at": taken_at}},
+            upsert=True
+        )
+        async for group in db.inventory_movements.aggregate([
+            {"$match": {"ts": {"$lt": as_of}}},
+            {"$group": {"_id": {"center_id": "$center_id", "product_type": "$product_type"}, "quantity": {"$sum": "$quantity"}}}
+        ], allowDiskUse=True)
+    ]
+    if operations:
+        await db.inventory_snapshots.bulk_write(operations, ordered=False)
+    return {"as_of": as_of, "snapshots": len(operations)}
+
+async def run_inventory_snapshots():
+    while True:
+        try:
+            await take_inventory_snapshots()
+        except Exception as e:
+            logging.error(f"Error taking inventory snapshots: {e}")
+        await asyncio.sleep(INVENTORY_SNAPSHOT_INTERVAL_HOURS * 3600)
+
+async def stock_at(center_id: Optional[str], product_type: str, at: str) -> float:
+    """Stock of one (center, product) at a moment: latest snapshot before it plus the movements since"""
+    at = utc_timestamp(at)
+    key = {"center_id": center_id, "product_type": product_type}
+    snapshot = await db.inventory_snapshots.find_one(
+        {**key, "as_of": {"$lte": at}}, {"_id": 0}, sort=[("as_of", -1)]
+    )
+    ts = {"$lt": at}
+    base = 0.0
+    if snapshot:
+        ts["$gte"] = snapshot["as_of"]
+        base = snapshot["quantity"]
+    replay = await sum_fields(db.inventory_movements, {**key, "ts": ts}, ["quantity"])
+    return base + replay["quantity"]
+
+async def raw_milk_stock(center_id: Optional[str] = None) -> float:
+    match = {"product_type": "raw_milk"}
+    if center_id:
+        match["center_id"] = center_id
+    return (await sum_fields(db.inventory_stock, match, ["quantity"]))["quantity"]
+
+# ==================== BALANCE GUARDS (حماية الأرصدة) ====================
+# The balance check and the $inc are one conditional update, so concurrent
+# purchases or credit sales cannot overdraw between a read and a write.
+
+async def debit_supplier_balance(supplier_id: str, amount: float) -> dict:
+    """Deduct from a supplier's balance only while it covers the amount; returns the updated supplier"""
+    supplier = await db.suppliers.find_one_and_update(
+        {"id": supplier_id, "balance": {"$gte": amount}},
+        touch({"$inc": {"balance": -amount}}),
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if supplier is None:
+        current = await db.suppliers.find_one({"id": supplier_id}, {"_id": 0, "balance": 1})
+        if current is None:
+            raise HTTPException(status_code=404, detail="Supplier not found")
+        raise HTTPException(
+            status_code=400,
+            detail=f"رصيد المورد غير كافٍ. الرصيد الحالي: {current.get('balance', 0)} ر.ع، المطلوب: {amount} ر.ع"
+        )
+    return supplier
+
+async def charge_customer_credit(customer_id: str, amount: float) -> dict:
+    """Add a credit sale to a customer's balance only while it stays within credit_limit.
+
+    A credit_limit of zero or less means no limit. Returns the updated customer.
+    """
+    customer = await db.customers.find_one_and_update(
+        {"id": customer_id, "$or": [
+            {"credit_limit": {"$not": {"$gt": 0}}},
+            {"$expr": {"$lte": [{"$add": [{"$ifNull": ["$balance", 0]}, amount]}, "$credit_limit"]}}
+        ]},
+        touch({"$inc": {"total_purchases": amount, "balance": amount}}),
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if customer is None:
+        current = await db.customers.find_one({"id": customer_id}, {"_id": 0, "balance": 1, "credit_limit": 1})
+        if current is None:
+            raise HTTPException(status_code=404, detail="العميل غير موجود")
+        available = current.get("credit_limit", 0) - current.get("balance", 0)
+        raise HTTPException(
+            status_code=400,
+            detail=f"تجاوز حد الائتمان للعميل. المتاح: {round(available, 3)} ر.ع، المطلوب: {amount} ر.ع"
+        )
+    return customer
+
+# ==================== GROUP COMMIT (تجميع عمليات الكتابة) ====================
+# When enabled, single reception and sale posts are queued and a background writer
+# merges everything that arrives within a short window into one insert_many per
+# collection plus coalesced $incs on suppliers, customers, inventory and rollups.
+# Each request still waits for its own batch to be written before it responds.
+GROUP_COMMIT_ENABLED = os.environ.get('GROUP_COMMIT_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+GROUP_COMMIT_WINDOW_MS = float(os.environ.get('GROUP_COMMIT_WINDOW_MS', 5))
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get('GROUP_COMMIT_MAX_BATCH', 500))
+GROUP_COMMIT_RETRY_SECONDS = float(os.environ.get('GROUP_COMMIT_RETRY_SECONDS', 5))
+
+class GroupCommitWriter:
+    def __init__(self, window_seconds: float, max_batch: int):
+        self.window_seconds = window_seconds
+        self.max_batch = max_batch
+        self.pending = []
+        self.unapplied = []  # (rebuild generation, name, write, args) of inserted documents still to be retried
+        self.wakeup = asyncio.Event()
+        self.stopping = False
+        self.task = None
+        self.stats = {
+            "batches": 0,
+            "committed": 0,
+            "failed": 0,
+            "side_effect_retries": 0,
+            "largest_batch": 0,
+            "last_commit_ms": 0.0,
+            "max_commit_ms": 0.0
+        }
+    
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+    
+    def start(self):
+        if not self.running:
+            self.stopping = False
+            self.task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Stop the background writer and commit whatever is still queued"""
+        if self.task is not None:
+            # Cancelling mid-commit would leave inserted documents without their
+            # side effects and callers waiting forever; let the loop finish instead
+            self.stopping = True
+            self.wakeup.set()
+            await self.task
+            self.task = None
+        await self._drain()
+        for _, name, _, _ in self.unapplied:
+            logging.error(f"Group commit side effect on {name} was never applied")
+    
+    async def submit(self, kind: str, document):
+        """Queue a MilkReception ("reception") or Sale ("sale") and wait until its batch is written.
+        
+        Raises only when the document itself was not inserted; once it is, side-effect
+        failures are retried in the background and never reported to the caller.
+        """
+        date = document.reception_date if kind == "reception" else document.sale_date
+        key = checked_rollup_key(date, document.center_id)
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((kind, document, key, future))
+        self.wakeup.set()
+        # Shield so a client disconnect does not cancel a write that is already queued
+        await asyncio.shield(future)
+    
+    async def _run(self):
+        while not self.stopping:
+            try:
+                # Wake up on our own while side effects are waiting for a retry
+                await asyncio.wait_for(self.wakeup.wait(), timeout=GROUP_COMMIT_RETRY_SECONDS if self.unapplied else None)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if not self.stopping:
+                await asyncio.sleep(self.window_seconds)
+            await self._drain()
+    
+    async def _drain(self):
+        if self.unapplied:
+            writes, self.unapplied = self.unapplied, []
+            self.stats["side_effect_retries"] += len(writes)
+            retried = None
+            try:
+                async with totals_writer() as generation:
+                    retried = await self._retry(writes, generation)
+            except Exception as e:
+                logging.error(f"Group commit side-effect retry failed: {e}")
+            self.unapplied[:0] = writes if retried is None else retried
+        while self.pending:
+            batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            try:
+                await self._commit(batch)
+            except Exception as e:
+                # _commit settles every inserted item itself; whatever is left was not written
+                logging.error(f"Group commit of {len(batch)} documents failed: {e}")
+                self._fail(batch, e if isinstance(e, HTTPException) else HTTPException(status_code=500, detail="فشل حفظ العملية"))
+    
+    async def _retry(self, writes, generation: int) -> list:
+        """Retry side effects; those deferred before a rebuild are reconciled with it first.
+        
+        The rebuild recomputed rollups and stock from every document and movement it
+        found, so their $incs are dropped. Movements it did not find are inserted now
+        and only those are added to the stock.
+        """
+        current, movements, stale = [], [], None
+        for tag, name, write, args in writes:
+            if tag == generation:
+                current.append((name, write, args))
+            elif name == "inventory_movements":
+                movements.extend(args[0])
+                stale = tag
+            elif name not in ("daily_rollups", "inventory_stock"):
+                current.append((name, write, args))
+        failed = [(generation, *write) for write in await self._apply(current)]
+        if movements:
+            try:
+                inserted = await insert_stock_movements(movements)
+            except Exception as e:
+                logging.error(f"Group commit side effect on inventory_movements failed, will retry: {e}")
+                # Still not in the ledger, so the next attempt reconciles them the same way
+                return failed + [(stale, "inventory_movements", insert_stock_movements, (movements,))]
+            failed.extend((generation, *write) for write in await self._apply([("inventory_stock", apply_stock_movements, (inserted,))]))
+        return failed
+    
+    def defer(self, writes, generation: int):
+        """Queue failed side effects of documents inserted outside the writer for retry"""
+        if writes:
+            self.unapplied.extend((generation, *write) for write in writes)
+            self.wakeup.set()
+    
+    @staticmethod
+    def _fail(items, error: Exception):
+        for *_, future in items:
+            if not future.done():
+                future.set_exception(error)
+    
+    @staticmethod
+    async def _apply(writes) -> list:
+        """Run side-effect writes independently; return the ones that failed"""
+        results = await asyncio.gather(*(write(*args) for _, write, args in writes), return_exceptions=True)
+        failed = []
+        for (name, write, args), result in zip(writes, results):
+            if isinstance(result, Exception):
+                logging.error(f"Group commit side effect on {name} failed, will retry: {result}")
+                failed.append((name, write, args))
+        return failed
+    
+    @staticmethod
+    def _side_effects(committed) -> list:
+        """Coalesced (name, write, args) side effects of a set of inserted documents"""
+        supplier_incs, customer_incs, rollups = {}, {}, {}
+        for kind, document, key, _ in committed:
+            if kind == "reception":
+                merge_inc(supplier_incs.setdefault(document.supplier_id, {}), {
+                    "total_supplied": document.quantity_liters,
+                    "balance": document.total_amount
+                })
+                merge_inc(rollups.setdefault((key["center_id"], key["date"], key["shift"]), {}), reception_rollup_inc(document))
+            else:
+                # Credit sales were already charged by charge_customer_credit
+                if document.is_paid:
+                    merge_inc(customer_incs.setdefault(document.customer_id, {}), {"total_purchases": document.total_amount})
+                merge_inc(rollups.setdefault((key["center_id"], key["date"], key["shift"]), {}), sale_rollup_inc(document))
+        
+        now = datetime.now(timezone.utc).isoformat()
+        movements = [
+            stock_movement(document.center_id, document.quantity_liters if kind == "reception" else -document.quantity_liters,
+                           kind, document.id)
+            for kind, document, _, _ in committed
+        ]
+        writes = [
+            ("inventory_movements", insert_stock_movements, (movements,)),
+            ("inventory_stock", apply_stock_movements, (movements,)),
+            ("daily_rollups", db.daily_rollups.bulk_write, ([
+                UpdateOne(
+                    {"center_id": center_id, "date": date, "shift": shift},
+                    {"$inc": inc, "$set": {"updated_at": now}},
+                    upsert=True
+                )
+                for (center_id, date, shift), inc in rollups.items()
+            ],))
+        ]
+        if supplier_incs:
+            writes.append(("suppliers", db.suppliers.bulk_write, ([
+                UpdateOne({"id": supplier_id}, touch({"$inc": inc})) for supplier_id, inc in supplier_incs.items()
+            ],)))
+        if customer_incs:
+            writes.append(("customers", db.customers.bulk_write, ([
+                UpdateOne({"id": customer_id}, touch({"$inc": inc})) for customer_id, inc in customer_incs.items()
+            ],)))
+        return writes
+    
+    async def _commit(self, batch):
+        async with totals_writer() as generation:
+            await self._commit_batch(batch, generation)
+    
+    async def _commit_batch(self, batch, generation: int):
+        started = time.perf_counter()
+        committed = []
+        for kind, collection in (("reception", db.milk_receptions), ("sale", db.sales)):
+            items = [item for item in batch if item[0] == kind]
+            if not items:
+                continue
+            try:
+                await collection.insert_many([document.model_dump() for _, document, _, _ in items], ordered=False)
+                committed.extend(items)
+            except BulkWriteError as e:
+                failed = {error["index"] for error in e.details.get("writeErrors", [])}
+                self._fail([item for i, item in enumerate(items) if i in failed], HTTPException(status_code=500, detail="فشل حفظ العملية"))
+                committed.extend(item for i, item in enumerate(items) if i not in failed)
+            except Exception as e:
+                logging.error(f"Group commit insert into {collection.name} failed: {e}")
+                self._fail(items, HTTPException(status_code=500, detail="فشل حفظ العملية"))
+        
+        if committed:
+            # From here on every document is written: callers get success whatever
+            # happens to the side effects, which are retried on the next drain
+            try:
+                failed = await self._apply(self._side_effects(committed))
+                self.unapplied.extend((generation, *write) for write in failed)
+            except Exception as e:
+                logging.error(f"Group commit side effects failed for {len(committed)} documents: {e}")
+            for *_, future in committed:
+                if not future.done():
+                    future.set_result(None)
+        
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.stats["batches"] += 1
+        self.stats["committed"] += len(committed)
+        self.stats["failed"] += len(batch) - len(committed)
+        self.stats["largest_batch"] = max(self.stats["largest_batch"], len(batch))
+        self.stats["last_commit_ms"] = round(elapsed_ms, 2)
+        self.stats["max_commit_ms"] = round(max(self.stats["max_commit_ms"], elapsed_ms), 2)
+    
+    def metrics(self) -> dict:
+        return {"enabled": GROUP_COMMIT_ENABLED, "depth": len(self.pending), "unapplied": len(self.unapplied),
+                "running": self.running, **self.stats}
+
+group_commit = GroupCommitWriter(GROUP_COMMIT_WINDOW_MS / 1000, GROUP_COMMIT_MAX_BATCH)
+
 # ==================== MILK RECEPTION ROUTES ====================
 
 @api_router.post("/milk-receptions", response_model=MilkReception)
-async def create_milk_reception(reception_data: MilkReceptionCreate, current_user: dict = Depends(get_current_user)):
+async def create_milk_reception(reception_data: MilkReceptionCreate, current_user: dict = Depends(get_current_user), idempotent: IdempotentRequest = Depends(idempotency)):
+    if idempotent.replay is not None:
+        return idempotent.replay
+    
     reception = MilkReception(**reception_data.model_dump())
     reception.total_amount = reception.quantity_liters * reception.price_per_liter
     reception.created_by = current_user["id"]
     
-    await db.milk_receptions.insert_one(reception.model_dump())
+    supplier = await db.suppliers.find_one({"id": reception.supplier_id}, {"_id": 0, "center_id": 1})
+    reception.center_id = supplier.get("center_id") if supplier else current_user.get("center_id")
+    rollup = checked_rollup_key(reception.reception_date, reception.center_id)
     
-    # Update supplier's total supplied
-    await db.suppliers.update_one(
-        {"id": reception.supplier_id},
-        {"$inc": {"total_supplied": reception.quantity_liters, "balance": reception.total_amount}}
-    )
-    
-    # Update inventory
-    await db.inventory.update_one(
-        {"product_type": "raw_milk"},
-        {"$inc": {"quantity_liters": reception.quantity_liters}, "$set": {"last_updated": datetime.now(timezone.utc).isoformat()}},
-        upsert=True
-    )
+    if GROUP_COMMIT_ENABLED and group_commit.running:
+        await group_commit.submit("reception", reception)
+    else:
+        async with totals_writer():
+            await db.milk_receptions.insert_one(reception.model_dump())
+            
+            # Update supplier's total supplied
+            await db.suppliers.update_one(
+                {"id": reception.supplier_id},
+                touch({"$inc": {"total_supplied": reception.quantity_liters, "balance": reception.total_amount}})
+            )
+            
+            # Update inventory
+            await record_stock_movements([stock_movement(reception.center_id, reception.quantity_liters, "reception", reception.id)])
+            
+            await record_reception_rollup(reception, rollup)
     
     await log_activity(
         user_id=current_user["id"],
@@ -1803,13 +3384,107 @@ async def create_milk_reception(reception_data: MilkReceptionCreate, current_use
         details=f"استلام حليب: {reception.quantity_liters} لتر من {reception.supplier_name}"
     )
     
-    return reception
+    return await idempotent.save(reception)
+
+# Largest batch accepted by the bulk reception endpoint
+MILK_RECEPTION_BULK_MAX = int(os.environ.get('MILK_RECEPTION_BULK_MAX', 1000))
+
+@api_router.post("/milk-receptions/bulk")
+async def create_milk_receptions_bulk(items: List[dict], current_user: dict = Depends(get_current_user), idempotent: IdempotentRequest = Depends(idempotency)):
+    """Record a burst of receptions with batched writes; invalid items are reported and skipped"""
+    if idempotent.replay is not None:
+        return idempotent.replay
+    
+    if len(items) > MILK_RECEPTION_BULK_MAX:
+        raise HTTPException(status_code=400, detail=f"الحد الأقصى للدفعة الواحدة {MILK_RECEPTION_BULK_MAX} استلام")
+    
+    errors = []
+    receptions = []
+    positions = []
+    rollup_keys = {}
+    parsed = []
+    for index, item in enumerate(items):
+        try:
+            parsed.append((index, MilkReceptionCreate.model_validate(item)))
+        except ValidationError as e:
+            errors.append({"index": index, "error": str(e)})
+    
+    supplier_ids = list({data.supplier_id for _, data in parsed})
+    suppliers = {
+        supplier["id"]: supplier
+        async for supplier in db.suppliers.find({"id": {"$in": supplier_ids}}, {"_id": 0, "id": 1, "center_id": 1})
+    }
+    
+    for index, data in parsed:
+        supplier = suppliers.get(data.supplier_id)
+        if not supplier:
+            errors.append({"index": index, "error": "المورد غير موجود"})
+            continue
+        reception = MilkReception(**data.model_dump())
+        # A retry under the same Idempotency-Key reuses these ids, so receptions an
+        # earlier attempt already inserted collide instead of being recorded twice
+        reception.id = idempotent.item_id(index) or reception.id
+        reception.total_amount = reception.quantity_liters * reception.price_per_liter
+        reception.created_by = current_user["id"]
+        reception.center_id = supplier.get("center_id")
+        try:
+            rollup_keys[reception.id] = rollup_key(reception.reception_date, reception.center_id)
+        except (TypeError, ValueError):
+            errors.append({"index": index, "error": "صيغة التاريخ غير صحيحة"})
+            continue
+        receptions.append(reception)
+        positions.append(index)
+    
+    if receptions:
+        async with totals_writer() as generation:
+            inserted = receptions
+            try:
+                await db.milk_receptions.insert_many([reception.model_dump() for reception in receptions], ordered=False)
+            except BulkWriteError as e:
+                failed, recorded = {}, set()
+                for error in e.details.get("writeErrors", []):
+                    if error.get("code") == 11000 and idempotent.claim is not None:
+                        recorded.add(error["index"])
+                    else:
+                        failed[error["index"]] = error.get("errmsg", "")
+                errors.extend({"index": positions[i], "error": message} for i, message in failed.items())
+                inserted = [reception for i, reception in enumerate(receptions) if i not in failed and i not in recorded]
+                receptions = [reception for i, reception in enumerate(receptions) if i not in failed]
+            
+            if inserted:
+                # Same coalesced writes as a group commit; once the receptions are in, a
+                # failed side effect is retried in the background instead of failing the
+                # request, which the client would retry into the collisions above
+                writes = GroupCommitWriter._side_effects([
+                    ("reception", reception, rollup_keys[reception.id], None) for reception in inserted
+                ])
+                group_commit.defer(await GroupCommitWriter._apply(writes), generation)
+    
+    if receptions:
+        await log_activity(
+            user_id=current_user["id"],
+            user_name=current_user["full_name"],
+            action="bulk_create_milk_reception",
+            entity_type="milk_reception",
+            details=f"استلام حليب دفعة واحدة: {len(receptions)} استلام بإجمالي {round(sum(reception.quantity_liters for reception in receptions), 2)} لتر من {len({reception.supplier_id for reception in receptions})} مورد"
+        )
+    
+    return await idempotent.save({
+        "message": f"تم تسجيل {len(receptions)} استلام",
+        "created": len(receptions),
+        "failed": len(errors),
+        "ids": [reception.id for reception in receptions],
+        "errors": sorted(errors, key=lambda error: error["index"])
+    })
 
 @api_router.get("/milk-receptions", response_model=List[MilkReception])
 async def get_milk_receptions(
+    response: Response,
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
     supplier_id: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -1823,7 +3498,7 @@ async def get_milk_receptions(
         else:
             query["reception_date"] = {"$lte": end_date}
     
-    receptions = await db.milk_receptions.find(query, {"_id": 0}).sort("reception_date", -1).to_list(1000)
+    receptions = await paginate(response, db.milk_receptions, query, sort_field="reception_date", page_size=page_size, cursor=cursor)
     return receptions
 
 @api_router.get("/milk-receptions/{reception_id}", response_model=MilkReception)
@@ -1853,8 +3528,8 @@ async def create_customer(customer_data: CustomerCreate, current_user: dict = De
     return customer
 
 @api_router.get("/customers", response_model=List[Customer])
-async def get_customers(current_user: dict = Depends(get_current_user)):
-    customers = await db.customers.find({"is_active": True}, {"_id": 0}).to_list(1000)
+async def get_customers(response: Response, page_size: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    customers = await paginate(response, db.customers, {"is_active": True}, page_size=page_size, cursor=cursor)
     return customers
 
 @api_router.get("/customers/{customer_id}", response_model=Customer)
@@ -1868,7 +3543,7 @@ async def get_customer(customer_id: str, current_user: dict = Depends(get_curren
 async def update_customer(customer_id: str, customer_data: CustomerCreate, current_user: dict = Depends(get_current_user)):
     result = await db.customers.update_one(
         {"id": customer_id},
-        {"$set": customer_data.model_dump()}
+        touch({"$set": customer_data.model_dump()})
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Customer not found")
@@ -1894,7 +3569,7 @@ async def delete_customer(customer_id: str, current_user: dict = Depends(require
     
     result = await db.customers.update_one(
         {"id": customer_id},
-        {"$set": {"is_active": False}}
+        touch({"$set": {"is_active": False}})
     )
     
     await log_activity(
@@ -1912,26 +3587,51 @@ async def delete_customer(customer_id: str, current_user: dict = Depends(require
 # ==================== SALES ROUTES ====================
 
 @api_router.post("/sales", response_model=Sale)
-async def create_sale(sale_data: SaleCreate, current_user: dict = Depends(get_current_user)):
+async def create_sale(sale_data: SaleCreate, current_user: dict = Depends(get_current_user), idempotent: IdempotentRequest = Depends(idempotency)):
+    if idempotent.replay is not None:
+        return idempotent.replay
+    
     sale = Sale(**sale_data.model_dump())
     sale.total_amount = sale.quantity_liters * sale.price_per_liter
     sale.created_by = current_user["id"]
     sale.is_paid = sale.sale_type == "cash"
-    
-    await db.sales.insert_one(sale.model_dump())
-    
-    # Update customer's total purchases
-    balance_change = 0 if sale.is_paid else sale.total_amount
-    await db.customers.update_one(
-        {"id": sale.customer_id},
-        {"$inc": {"total_purchases": sale.total_amount, "balance": balance_change}}
-    )
-    
-    # Update inventory
-    await db.inventory.update_one(
-        {"product_type": "raw_milk"},
-        {"$inc": {"quantity_liters": -sale.quantity_liters}, "$set": {"last_updated": datetime.now(timezone.utc).isoformat()}}
-    )
+    sale.center_id = current_user.get("center_id")
+    rollup = checked_rollup_key(sale.sale_date, sale.center_id)
+    
+    batched = GROUP_COMMIT_ENABLED and group_commit.running
+    # Group commit registers its own batches with the rebuild gate
+    async with nullcontext() if batched else totals_writer():
+        # Credit sales reserve the customer's exposure first, against credit_limit
+        if not sale.is_paid:
+            await charge_customer_credit(sale.customer_id, sale.total_amount)
+        
+        try:
+            if batched:
+                await group_commit.submit("sale", sale)
+            else:
+                await db.sales.insert_one(sale.model_dump())
+        except Exception:
+            # Release the credit charge only if the sale row really was not written; an
+            # insert can fail on the client side after the server applied it
+            if not sale.is_paid and not await db.sales.count_documents({"id": sale.id}, limit=1):
+                await db.customers.update_one(
+                    {"id": sale.customer_id},
+                    touch({"$inc": {"total_purchases": -sale.total_amount, "balance": -sale.total_amount}})
+                )
+            raise
+        
+        if not batched:
+            # Update customer's total purchases
+            if sale.is_paid:
+                await db.customers.update_one(
+                    {"id": sale.customer_id},
+                    touch({"$inc": {"total_purchases": sale.total_amount}})
+                )
+        
+            # Update inventory
+            await record_stock_movements([stock_movement(sale.center_id, -sale.quantity_liters, "sale", sale.id)])
+        
+            await record_sale_rollup(sale, rollup)
     
     await log_activity(
         user_id=current_user["id"],
@@ -1943,13 +3643,16 @@ async def create_sale(sale_data: SaleCreate, current_user: dict = Depends(get_cu
         details=f"عملية بيع: {sale.quantity_liters} لتر إلى {sale.customer_name} - {sale.total_amount} ر.ع"
     )
     
-    return sale
+    return await idempotent.save(sale)
 
 @api_router.get("/sales", response_model=List[Sale])
 async def get_sales(
+    response: Response,
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
     customer_id: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -1963,30 +3666,121 @@ async def get_sales(
         else:
             query["sale_date"] = {"$lte": end_date}
     
-    sales = await db.sales.find(query, {"_id": 0}).sort("sale_date", -1).to_list(1000)
+    sales = await paginate(response, db.sales, query, sort_field="sale_date", page_size=page_size, cursor=cursor)
     return sales
 
 # ==================== INVENTORY ROUTES ====================
 
 @api_router.get("/inventory")
 async def get_inventory(current_user: dict = Depends(get_current_user)):
-    inventory = await db.inventory.find({}, {"_id": 0}).to_list(100)
-    return inventory
-
-@api_router.post("/inventory", response_model=Inventory)
-async def create_inventory(inventory_data: InventoryBase, current_user: dict = Depends(require_role(["admin", "employee"]))):
-    inventory = Inventory(**inventory_data.model_dump())
-    await db.inventory.insert_one(inventory.model_dump())
-    return inventory
-
-@api_router.put("/inventory/{inventory_id}")
-async def update_inventory(inventory_id: str, inventory_data: InventoryUpdate, current_user: dict = Depends(get_current_user)):
-    update_data = {k: v for k, v in inventory_data.model_dump().items() if v is not None}
-    update_data["last_updated"] = datetime.now(timezone.utc).isoformat()
+    """Storage tank records, plus the live total of every product from the ledger.
     
-    result = await db.inventory.update_one(
-        {"id": inventory_id},
-        {"$set": update_data}
+    The legacy id-less stock document is no longer updated by any write path, so
+    it is replaced by the inventory_stock totals rather than returned frozen.
+    """
+    tanks, totals = await asyncio.gather(
+        db.inventory.find({"id": {"$exists": True}}, {"_id": 0}).to_list(100),
+        db.inventory_stock.aggregate([
+            {"$group": {"_id": "$product_type", "quantity": {"$sum": "$quantity"}, "last_movement_at": {"$max": "$last_movement_at"}}},
+            {"$sort": {"_id": 1}}
+        ]).to_list(None)
+    )
+    live = [
+        {"product_type": total["_id"], "quantity_liters": total["quantity"], "last_updated": total["last_movement_at"], "source": "inventory_stock"}
+        for total in totals
+    ]
+    return live + tanks
+
+@api_router.get("/inventory/stock")
+async def get_inventory_stock(
+    center_id: Optional[str] = None,
+    product_type: Optional[str] = None,
+    at: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Stock per (center, product), now or as of the `at` timestamp"""
+    query = {}
+    if center_id:
+        query["center_id"] = center_id
+    if product_type:
+        query["product_type"] = product_type
+    stock = await db.inventory_stock.find(query, {"_id": 0}).to_list(None)
+    if at:
+        at = utc_timestamp(at)
+        quantities = await asyncio.gather(*(stock_at(s["center_id"], s["product_type"], at) for s in stock))
+        stock = [
+            {"center_id": s["center_id"], "product_type": s["product_type"], "quantity": quantity, "as_of": at}
+            for s, quantity in zip(stock, quantities)
+        ]
+    return stock
+
+@api_router.get("/inventory/movements")
+async def get_inventory_movements(
+    response: Response,
+    center_id: Optional[str] = None,
+    product_type: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    query = {}
+    if center_id:
+        query["center_id"] = center_id
+    if product_type:
+        query["product_type"] = product_type
+    if start_date:
+        query["ts"] = {"$gte": start_date}
+    if end_date:
+        query.setdefault("ts", {})["$lte"] = end_date
+    
+    movements = await paginate(response, db.inventory_movements, query, sort_field="ts", page_size=page_size, cursor=cursor)
+    return movements
+
+@api_router.post("/inventory/adjustments")
+async def create_inventory_adjustment(
+    center_id: str,
+    quantity: float,
+    product_type: str = "raw_milk",
+    notes: Optional[str] = None,
+    current_user: dict = Depends(require_role(["admin"]))
+):
+    """Record a stock count correction as a signed ledger movement"""
+    movement = stock_movement(center_id, quantity, "adjustment", product_type=product_type,
+                              notes=notes, created_by=current_user["id"])
+    await record_stock_movements([movement])
+    
+    await log_activity(
+        user_id=current_user["id"],
+        user_name=current_user["full_name"],
+        action="inventory_adjustment",
+        entity_type="inventory",
+        entity_id=movement["id"],
+        details=f"تسوية مخزون: {quantity} لتر ({product_type})"
+    )
+    
+    return movement
+
+@api_router.post("/inventory/snapshots")
+async def create_inventory_snapshots(as_of: Optional[str] = None, current_user: dict = Depends(require_role(["admin"]))):
+    """Snapshot every stock document as of a moment (defaults to start of today)"""
+    return await take_inventory_snapshots(as_of)
+
+@api_router.post("/inventory", response_model=Inventory)
+async def create_inventory(inventory_data: InventoryBase, current_user: dict = Depends(require_role(["admin", "employee"]))):
+    inventory = Inventory(**inventory_data.model_dump())
+    await db.inventory.insert_one(inventory.model_dump())
+    return inventory
+
+@api_router.put("/inventory/{inventory_id}")
+async def update_inventory(inventory_id: str, inventory_data: InventoryUpdate, current_user: dict = Depends(get_current_user)):
+    update_data = {k: v for k, v in inventory_data.model_dump().items() if v is not None}
+    update_data["last_updated"] = datetime.now(timezone.utc).isoformat()
+    
+    result = await db.inventory.update_one(
+        {"id": inventory_id},
+        {"$set": update_data}
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Inventory item not found")
@@ -2026,11 +3820,125 @@ async def delete_inventory(inventory_id: str, current_user: dict = Depends(requi
     
     return {"message": "تم حذف المخزون بنجاح"}
 
+# ==================== APPROVAL WORKFLOWS (سير الموافقات) ====================
+# Allowed state transitions for every approvable entity. A transition is one
+# conditional find_one_and_update, so two admins deciding the same item at once
+# cannot both apply its side effects.
+WORKFLOWS = {
+    # entity: collection, how the approver is recorded, action -> (required state, new state)
+    "payment": {
+        "collection": "payments",
+        "actor": "id",
+        "transitions": {
+            "approve": ({"status": "pending"}, {"status": "approved"}),
+            "reject": ({"status": "pending"}, {"status": "rejected"}),
+        },
+    },
+    "leave_request": {
+        "collection": "hr_leave_requests",
+        "actor": "name",
+        "transitions": {
+            "approve": ({"status": "pending"}, {"status": "approved"}),
+            "reject": ({"status": "pending"}, {"status": "rejected"}),
+        },
+    },
+    "expense_request": {
+        "collection": "hr_expense_requests",
+        "actor": "name",
+        "transitions": {
+            "approve": ({"status": "pending"}, {"status": "approved"}),
+            "reject": ({"status": "pending"}, {"status": "rejected"}),
+        },
+    },
+    "loan": {
+        "collection": "hr_loans",
+        "actor": "name",
+        "transitions": {
+            # Active means approved and deduction can start
+            "approve": ({"status": "pending"}, {"status": "active"}),
+            "reject": ({"status": "pending"}, {"status": "rejected"}),
+        },
+    },
+    "official_letter": {
+        "collection": "hr_official_letters",
+        "actor": "id",
+        "transitions": {
+            "approve": ({"is_approved": {"$ne": True}}, {"status": "approved", "is_approved": True}),
+            "reject": ({"is_approved": {"$ne": True}}, {"status": "rejected"}),
+        },
+    },
+    "feed_purchase": {
+        "collection": "feed_purchases",
+        "actor": "id",
+        "transitions": {
+            "approve": ({"is_approved": {"$ne": True}}, {"is_approved": True}),
+        },
+    },
+    "payroll": {
+        "collection": "payroll_periods",
+        "actor": "name",
+        "transitions": {
+            "approve": ({"status": {"$in": ["draft", "calculated"]}}, {"status": "approved"}),
+        },
+    },
+}
+
+def workflow_transition(entity: str, action: str):
+    workflow = WORKFLOWS[entity]
+    if action not in workflow["transitions"]:
+        raise HTTPException(status_code=400, detail="الإجراء غير صالح")
+    required, target = workflow["transitions"][action]
+    return workflow, required, target
+
+def decision_fields(entity: str, action: str, current_user: dict, reason: Optional[str] = None) -> dict:
+    """Approver stamp written with a transition"""
+    fields = {"approved_at": datetime.now(timezone.utc).isoformat()}
+    if WORKFLOWS[entity]["actor"] == "id":
+        fields["approved_by"] = current_user["id"]
+        fields["approved_by_name"] = current_user.get("full_name", "")
+    else:
+        fields["approved_by"] = current_user["full_name"]
+    if action == "reject" and reason is not None:
+        fields["rejection_reason"] = reason
+    return fields
+
+async def transition_status(entity: str, doc_id: str, action: str, current_user: dict,
+                            reason: Optional[str] = None, extra: Optional[dict] = None) -> dict:
+    """Move one document along its workflow; returns it after the change"""
+    workflow, required, target = workflow_transition(entity, action)
+    collection = db[workflow["collection"]]
+    updated = await collection.find_one_and_update(
+        {"id": doc_id, **required},
+        {"$set": {**target, **decision_fields(entity, action, current_user, reason), **(extra or {})}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if updated is None:
+        if await collection.count_documents({"id": doc_id}, limit=1) == 0:
+            raise HTTPException(status_code=404, detail="العنصر غير موجود")
+        raise HTTPException(status_code=400, detail="تمت معالجة هذا الطلب مسبقاً")
+    return updated
+
+async def transition_many(entity: str, doc_ids: List[str], action: str, current_user: dict,
+                          reason: Optional[str] = None) -> List[dict]:
+    """Move every eligible document in one update_many; returns the ones this call changed"""
+    workflow, required, target = workflow_transition(entity, action)
+    collection = db[workflow["collection"]]
+    batch_id = str(uuid.uuid4())
+    await collection.update_many(
+        {"id": {"$in": doc_ids}, **required},
+        {"$set": {**target, **decision_fields(entity, action, current_user, reason), "transition_batch": batch_id}}
+    )
+    return await collection.find({"transition_batch": batch_id}, {"_id": 0}).to_list(len(doc_ids))
+
 # ==================== PAYMENT ROUTES ====================
 
 @api_router.post("/payments", response_model=Payment)
-async def create_payment(payment_data: PaymentCreate, current_user: dict = Depends(require_role(["admin", "accountant"]))):
+async def create_payment(payment_data: PaymentCreate, current_user: dict = Depends(require_role(["admin", "accountant"])), idempotent: IdempotentRequest = Depends(idempotency)):
     """Create a payment request (requires approval from admin/IT)"""
+    if idempotent.replay is not None:
+        return idempotent.replay
+    
     payment = Payment(**payment_data.model_dump())
     payment.created_by = current_user["id"]
     payment.created_by_name = current_user.get("full_name", "")
@@ -2057,55 +3965,35 @@ async def create_payment(payment_data: PaymentCreate, current_user: dict = Depen
         details=f"طلب دفعة مالية: {payment.amount} ر.ع - {entity_name} (في انتظار الموافقة)"
     )
     
-    return payment
+    return await idempotent.save(payment)
 
-@api_router.post("/payments/{payment_id}/approve")
-async def approve_payment(payment_id: str, approval: PaymentApproval, current_user: dict = Depends(require_role(["admin"]))):
-    """Approve or reject a payment request (admin/IT only)"""
-    
-    # Get the payment
-    payment = await db.payments.find_one({"id": payment_id}, {"_id": 0})
-    if not payment:
-        raise HTTPException(status_code=404, detail="الدفعة غير موجودة")
-    
-    if payment.get("status") != "pending":
-        raise HTTPException(status_code=400, detail="هذه الدفعة تمت معالجتها مسبقاً")
+async def decide_payment(payment_id: str, action: str, reason: Optional[str], current_user: dict) -> dict:
+    """Approve or reject one payment and apply its balance and treasury effects"""
+    if action == "reject":
+        payment = await transition_status("payment", payment_id, "reject", current_user, reason=reason or "لم يتم تحديد السبب")
+        entity_name = payment.get("related_name", "")
+        amount = payment.get("amount", 0)
+        
+        await log_activity(
+            user_id=current_user["id"],
+            user_name=current_user["full_name"],
+            action="reject_payment",
+            entity_type="payment",
+            entity_id=payment_id,
+            entity_name=entity_name,
+            details=f"تم رفض دفعة: {amount} ر.ع - {entity_name} - السبب: {reason or 'غير محدد'}"
+        )
+        
+        return {"message": "تم رفض الدفعة", "status": "rejected"}
     
+    payment = await transition_status("payment", payment_id, action, current_user)
     entity_name = payment.get("related_name", "")
     amount = payment.get("amount", 0)
     
-    if approval.action == "approve":
-        # For supplier payment, check treasury balance
-        if payment.get("payment_type") == "supplier_payment":
-            treasury = await db.treasury.find_one({"type": "main"}, {"_id": 0})
-            treasury_balance = treasury.get("current_balance", 0) if treasury else 0
-            if amount > treasury_balance:
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"رصيد الخزينة غير كافٍ. الرصيد الحالي: {treasury_balance} ر.ع، المطلوب: {amount} ر.ع"
-                )
-        
-        # Update payment status
-        await db.payments.update_one(
-            {"id": payment_id},
-            {
-                "$set": {
-                    "status": "approved",
-                    "approved_by": current_user["id"],
-                    "approved_by_name": current_user.get("full_name", ""),
-                    "approved_at": datetime.now(timezone.utc).isoformat()
-                }
-            }
-        )
-        
-        # Update balances and treasury after approval
-        if payment.get("payment_type") == "supplier_payment":
-            # Deduct from supplier balance
-            await db.suppliers.update_one(
-                {"id": payment.get("related_id")},
-                {"$inc": {"balance": -amount}}
-            )
-            # Deduct from treasury (withdrawal)
+    # Update balances and treasury after approval
+    if payment.get("payment_type") == "supplier_payment":
+        # The guarded withdrawal rejects the approval if the treasury does not cover it
+        try:
             await update_treasury(
                 transaction_type="withdrawal",
                 amount=amount,
@@ -2113,78 +4001,77 @@ async def approve_payment(payment_id: str, approval: PaymentApproval, current_us
                 description=f"دفعة للمورد: {entity_name}",
                 source_id=payment_id,
                 user_id=current_user["id"],
-                user_name=current_user.get("full_name", "")
-            )
-            
-        elif payment.get("payment_type") == "customer_receipt":
-            # Deduct from customer balance (receivables)
-            await db.customers.update_one(
-                {"id": payment.get("related_id")},
-                {"$inc": {"balance": -amount}}
+                user_name=current_user.get("full_name", ""),
+                require_funds=True
             )
-            # Add to treasury (deposit)
-            await update_treasury(
-                transaction_type="deposit",
-                amount=amount,
-                source_type="customer_receipt",
-                description=f"استلام من العميل: {entity_name}",
-                source_id=payment_id,
-                user_id=current_user["id"],
-                user_name=current_user.get("full_name", "")
+        except HTTPException:
+            await db.payments.update_one(
+                {"id": payment_id, "status": "approved"},
+                {"$set": {"status": "pending"}, "$unset": {"approved_by": "", "approved_by_name": "", "approved_at": ""}}
             )
+            raise
         
-        await log_activity(
-            user_id=current_user["id"],
-            user_name=current_user["full_name"],
-            action="approve_payment",
-            entity_type="payment",
-            entity_id=payment_id,
-            entity_name=entity_name,
-            details=f"تمت الموافقة على دفعة: {amount} ر.ع - {entity_name}"
+        # Deduct from supplier balance
+        await db.suppliers.update_one(
+            {"id": payment.get("related_id")},
+            touch({"$inc": {"balance": -amount}})
         )
         
-        return {"message": "تمت الموافقة على الدفعة بنجاح", "status": "approved"}
-    
-    elif approval.action == "reject":
-        await db.payments.update_one(
-            {"id": payment_id},
-            {
-                "$set": {
-                    "status": "rejected",
-                    "approved_by": current_user["id"],
-                    "approved_by_name": current_user.get("full_name", ""),
-                    "approved_at": datetime.now(timezone.utc).isoformat(),
-                    "rejection_reason": approval.reason or "لم يتم تحديد السبب"
-                }
-            }
+    elif payment.get("payment_type") == "customer_receipt":
+        # Deduct from customer balance (receivables)
+        await db.customers.update_one(
+            {"id": payment.get("related_id")},
+            touch({"$inc": {"balance": -amount}})
         )
-        
-        await log_activity(
+        # Add to treasury (deposit)
+        await update_treasury(
+            transaction_type="deposit",
+            amount=amount,
+            source_type="customer_receipt",
+            description=f"استلام من العميل: {entity_name}",
+            source_id=payment_id,
             user_id=current_user["id"],
-            user_name=current_user["full_name"],
-            action="reject_payment",
-            entity_type="payment",
-            entity_id=payment_id,
-            entity_name=entity_name,
-            details=f"تم رفض دفعة: {amount} ر.ع - {entity_name} - السبب: {approval.reason or 'غير محدد'}"
+            user_name=current_user.get("full_name", "")
         )
-        
-        return {"message": "تم رفض الدفعة", "status": "rejected"}
     
-    raise HTTPException(status_code=400, detail="الإجراء غير صالح")
+    await log_activity(
+        user_id=current_user["id"],
+        user_name=current_user["full_name"],
+        action="approve_payment",
+        entity_type="payment",
+        entity_id=payment_id,
+        entity_name=entity_name,
+        details=f"تمت الموافقة على دفعة: {amount} ر.ع - {entity_name}"
+    )
+    
+    return {"message": "تمت الموافقة على الدفعة بنجاح", "status": "approved"}
+
+@api_router.post("/payments/{payment_id}/approve")
+async def approve_payment(payment_id: str, approval: PaymentApproval, current_user: dict = Depends(require_role(["admin"])), idempotent: IdempotentRequest = Depends(idempotency)):
+    """Approve or reject a payment request (admin/IT only)"""
+    if idempotent.replay is not None:
+        return idempotent.replay
+    
+    if approval.action not in ("approve", "reject"):
+        raise HTTPException(status_code=400, detail="الإجراء غير صالح")
+    
+    return await idempotent.save(await decide_payment(payment_id, approval.action, approval.reason, current_user))
 
 @api_router.get("/payments/pending", response_model=List[Payment])
-async def get_pending_payments(current_user: dict = Depends(require_role(["admin"]))):
+async def get_pending_payments(response: Response, page_size: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, current_user: dict = Depends(require_role(["admin"]))):
     """Get all pending payments awaiting approval (admin only)"""
-    payments = await db.payments.find({"status": "pending"}, {"_id": 0}).sort("payment_date", -1).to_list(1000)
+    payments = await paginate(response, db.payments, {"status": "pending"}, sort_field="payment_date", page_size=page_size, cursor=cursor)
     return payments
 
 @api_router.get("/payments", response_model=List[Payment])
 async def get_payments(
+    response: Response,
     payment_type: Optional[str] = None,
     status: Optional[str] = None,
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -2200,32 +4087,13 @@ async def get_payments(
         else:
             query["payment_date"] = {"$lte": end_date}
     
-    payments = await db.payments.find(query, {"_id": 0}).sort("payment_date", -1).to_list(1000)
+    payments = await paginate(response, db.payments, query, sort_field="payment_date", page_size=page_size, cursor=cursor)
     return payments
 
 # Payment Receipt PDF Generation
 @api_router.get("/payments/{payment_id}/receipt")
 async def get_payment_receipt_pdf(payment_id: str, current_user: dict = Depends(get_current_user)):
     """Generate PDF receipt for a supplier payment"""
-    from reportlab.lib import colors
-    from reportlab.lib.pagesizes import A4
-    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
-    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-    from reportlab.lib.enums import TA_CENTER, TA_RIGHT
-    from reportlab.pdfbase import pdfmetrics
-    from reportlab.pdfbase.ttfonts import TTFont
-    from reportlab.lib.units import cm
-    from io import BytesIO
-    import arabic_reshaper
-    from bidi.algorithm import get_display
-    
-    # Register Arabic font
-    font_path = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
-    try:
-        pdfmetrics.registerFont(TTFont('Arabic', font_path))
-    except:
-        pass
-    
     # Get payment details
     payment = await db.payments.find_one({"id": payment_id}, {"_id": 0})
     if not payment:
@@ -2236,147 +4104,7 @@ async def get_payment_receipt_pdf(payment_id: str, current_user: dict = Depends(
     if not supplier:
         raise HTTPException(status_code=404, detail="Supplier not found")
     
-    # Create PDF
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=2*cm, leftMargin=2*cm, topMargin=2*cm, bottomMargin=2*cm)
-    
-    def reshape_arabic(text):
-        try:
-            reshaped = arabic_reshaper.reshape(str(text))
-            return get_display(reshaped)
-        except:
-            return str(text)
-    
-    # Styles
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle(
-        'Title',
-        parent=styles['Title'],
-        fontName='Arabic',
-        fontSize=24,
-        alignment=TA_CENTER,
-        spaceAfter=20
-    )
-    header_style = ParagraphStyle(
-        'Header',
-        parent=styles['Normal'],
-        fontName='Arabic',
-        fontSize=14,
-        alignment=TA_CENTER,
-        spaceAfter=10
-    )
-    normal_style = ParagraphStyle(
-        'Normal',
-        parent=styles['Normal'],
-        fontName='Arabic',
-        fontSize=12,
-        alignment=TA_RIGHT,
-        spaceAfter=5
-    )
-    
-    elements = []
-    
-    # Company Header
-    elements.append(Paragraph(reshape_arabic("المروج للألبان"), title_style))
-    elements.append(Paragraph(reshape_arabic("Al-Morooj Dairy"), header_style))
-    elements.append(Spacer(1, 20))
-    
-    # Receipt Title
-    elements.append(Paragraph(reshape_arabic("إيصال دفع"), title_style))
-    elements.append(Spacer(1, 20))
-    
-    # Payment Date
-    payment_date = payment.get("payment_date", "")[:10]
-    elements.append(Paragraph(reshape_arabic(f"التاريخ: {payment_date}"), normal_style))
-    elements.append(Spacer(1, 10))
-    
-    # Supplier Information Table
-    supplier_data = [
-        [reshape_arabic("القيمة"), reshape_arabic("البيان")],
-        [reshape_arabic(supplier.get("name", "")), reshape_arabic("اسم المورد")],
-        [reshape_arabic(supplier.get("supplier_code", "-")), reshape_arabic("كود المورد")],
-        [reshape_arabic(supplier.get("phone", "-")), reshape_arabic("رقم الهاتف")],
-        [reshape_arabic(supplier.get("address", "-")), reshape_arabic("العنوان")],
-        [reshape_arabic(supplier.get("bank_account", "-")), reshape_arabic("الحساب البنكي")],
-        [reshape_arabic(supplier.get("national_id", "-")), reshape_arabic("رقم الهوية")],
-    ]
-    
-    supplier_table = Table(supplier_data, colWidths=[10*cm, 5*cm])
-    supplier_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor("#2563eb")),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, -1), 'Arabic'),
-        ('FONTSIZE', (0, 0), (-1, 0), 12),
-        ('FONTSIZE', (0, 1), (-1, -1), 11),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('TOPPADDING', (0, 0), (-1, -1), 8),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.HexColor("#f8fafc")),
-        ('GRID', (0, 0), (-1, -1), 1, colors.HexColor("#e2e8f0")),
-    ]))
-    elements.append(supplier_table)
-    elements.append(Spacer(1, 20))
-    
-    # Payment Details Table
-    payment_method_map = {
-        "cash": "نقداً",
-        "bank_transfer": "تحويل بنكي",
-        "check": "شيك"
-    }
-    payment_method = payment_method_map.get(payment.get("payment_method", "cash"), payment.get("payment_method", ""))
-    
-    payment_data = [
-        [reshape_arabic("القيمة"), reshape_arabic("تفاصيل الدفع")],
-        [reshape_arabic(f"{payment.get('amount', 0):,.2f} ر.ع"), reshape_arabic("المبلغ المدفوع")],
-        [reshape_arabic(payment_method), reshape_arabic("طريقة الدفع")],
-        [reshape_arabic(payment.get("notes", "-") or "-"), reshape_arabic("ملاحظات")],
-    ]
-    
-    payment_table = Table(payment_data, colWidths=[10*cm, 5*cm])
-    payment_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor("#059669")),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, -1), 'Arabic'),
-        ('FONTSIZE', (0, 0), (-1, 0), 12),
-        ('FONTSIZE', (0, 1), (-1, -1), 11),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('TOPPADDING', (0, 0), (-1, -1), 8),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.HexColor("#f0fdf4")),
-        ('GRID', (0, 0), (-1, -1), 1, colors.HexColor("#d1fae5")),
-    ]))
-    elements.append(payment_table)
-    elements.append(Spacer(1, 30))
-    
-    # Signature Section
-    sig_data = [
-        [reshape_arabic("توقيع المستلم"), reshape_arabic(""), reshape_arabic("توقيع المسؤول")],
-        ["________________", "", "________________"],
-    ]
-    sig_table = Table(sig_data, colWidths=[5*cm, 5*cm, 5*cm])
-    sig_table.setStyle(TableStyle([
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, -1), 'Arabic'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('TOPPADDING', (0, 0), (-1, -1), 20),
-    ]))
-    elements.append(sig_table)
-    
-    # Footer
-    elements.append(Spacer(1, 40))
-    footer_style = ParagraphStyle(
-        'Footer',
-        parent=styles['Normal'],
-        fontName='Arabic',
-        fontSize=9,
-        alignment=TA_CENTER,
-        textColor=colors.gray
-    )
-    elements.append(Paragraph(reshape_arabic(f"رقم الإيصال: {payment_id[:8].upper()}"), footer_style))
-    
-    # Build PDF
-    doc.build(elements)
-    buffer.seek(0)
+    pdf_bytes = await render_pdf(pdf_renderer.render_payment_receipt, payment, supplier)
     
     # Log activity
     await log_activity(
@@ -2390,7 +4118,7 @@ async def get_payment_receipt_pdf(payment_id: str, current_user: dict = Depends(
     )
     
     return StreamingResponse(
-        buffer,
+        io.BytesIO(pdf_bytes),
         media_type="application/pdf",
         headers={"Content-Disposition": f"attachment; filename=payment_receipt_{payment_id[:8]}.pdf"}
     )
@@ -2404,8 +4132,8 @@ async def create_employee(employee_data: EmployeeCreate, current_user: dict = De
     return employee
 
 @api_router.get("/employees", response_model=List[Employee])
-async def get_employees(current_user: dict = Depends(require_role(["admin"]))):
-    employees = await db.employees.find({"is_active": True}, {"_id": 0}).to_list(1000)
+async def get_employees(response: Response, page_size: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, current_user: dict = Depends(require_role(["admin"]))):
+    employees = await paginate(response, db.employees, {"is_active": True}, page_size=page_size, cursor=cursor)
     return employees
 
 @api_router.put("/employees/{employee_id}", response_model=Employee)
@@ -2445,8 +4173,8 @@ async def create_feed_company(company_data: FeedCompanyCreate, current_user: dic
     return company
 
 @api_router.get("/feed-companies", response_model=List[FeedCompany])
-async def get_feed_companies(current_user: dict = Depends(get_current_user)):
-    companies = await db.feed_companies.find({"is_active": True}, {"_id": 0}).to_list(1000)
+async def get_feed_companies(response: Response, page_size: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    companies = await paginate(response, db.feed_companies, {"is_active": True}, page_size=page_size, cursor=cursor)
     return companies
 
 @api_router.put("/feed-companies/{company_id}", response_model=FeedCompany)
@@ -2479,18 +4207,18 @@ async def create_feed_type(feed_type_data: FeedTypeCreate, current_user: dict =
     return feed_type
 
 @api_router.get("/feed-types", response_model=List[FeedType])
-async def get_feed_types(company_id: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+async def get_feed_types(response: Response, company_id: Optional[str] = None, page_size: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, current_user: dict = Depends(get_current_user)):
     query = {"is_active": True}
     if company_id:
         query["company_id"] = company_id
-    feed_types = await db.feed_types.find(query, {"_id": 0}).to_list(1000)
+    feed_types = await paginate(response, db.feed_types, query, page_size=page_size, cursor=cursor)
     return feed_types
 
 @api_router.put("/feed-types/{feed_type_id}", response_model=FeedType)
 async def update_feed_type(feed_type_id: str, feed_type_data: FeedTypeCreate, current_user: dict = Depends(get_current_user)):
     result = await db.feed_types.update_one(
         {"id": feed_type_id},
-        {"$set": feed_type_data.model_dump()}
+        touch({"$set": feed_type_data.model_dump()})
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Feed type not found")
@@ -2501,7 +4229,7 @@ async def update_feed_type(feed_type_id: str, feed_type_data: FeedTypeCreate, cu
 async def delete_feed_type(feed_type_id: str, current_user: dict = Depends(require_role(["admin"]))):
     result = await db.feed_types.update_one(
         {"id": feed_type_id},
-        {"$set": {"is_active": False}}
+        touch({"$set": {"is_active": False}})
     )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Feed type not found")
@@ -2511,20 +4239,14 @@ async def delete_feed_type(feed_type_id: str, current_user: dict = Depends(requi
 
 @api_router.post("/feed-purchases", response_model=FeedPurchase)
 async def create_feed_purchase(purchase_data: FeedPurchaseCreate, current_user: dict = Depends(get_current_user)):
-    # Check supplier balance
-    supplier = await db.suppliers.find_one({"id": purchase_data.supplier_id}, {"_id": 0})
-    if not supplier:
-        raise HTTPException(status_code=404, detail="Supplier not found")
-    
     total_amount = purchase_data.quantity * purchase_data.price_per_unit
     
-    if supplier.get("balance", 0) < total_amount:
-        raise HTTPException(status_code=400, detail="Insufficient supplier balance")
+    # Deduct from supplier balance; the guarded update rejects the purchase if it does not cover it
+    supplier = await debit_supplier_balance(purchase_data.supplier_id, total_amount)
     
     # Generate invoice number
-    count = await db.feed_purchases.count_documents({})
     year = datetime.now().year
-    invoice_number = f"FP-{year}-{count + 1:05d}"
+    invoice_number = f"FP-{year}-{await next_sequence('FP', year):05d}"
     
     purchase = FeedPurchase(**purchase_data.model_dump())
     purchase.invoice_number = invoice_number
@@ -2535,13 +4257,14 @@ async def create_feed_purchase(purchase_data: FeedPurchaseCreate, current_user:
     purchase.supplier_phone = supplier.get("phone", "")
     purchase.supplier_address = supplier.get("address", "")
     
-    await db.feed_purchases.insert_one(purchase.model_dump())
-    
-    # Deduct from supplier balance
-    await db.suppliers.update_one(
-        {"id": purchase.supplier_id},
-        {"$inc": {"balance": -total_amount}}
-    )
+    try:
+        await db.feed_purchases.insert_one(purchase.model_dump())
+    except Exception:
+        await db.suppliers.update_one(
+            {"id": purchase.supplier_id},
+            touch({"$inc": {"balance": total_amount}})
+        )
+        raise
     
     await log_activity(
         user_id=current_user["id"],
@@ -2558,27 +4281,16 @@ async def create_feed_purchase(purchase_data: FeedPurchaseCreate, current_user:
 # Approve feed purchase invoice (electronic signature)
 @api_router.post("/feed-purchases/{purchase_id}/approve")
 async def approve_feed_purchase(purchase_id: str, current_user: dict = Depends(require_role(["admin"]))):
-    purchase = await db.feed_purchases.find_one({"id": purchase_id}, {"_id": 0})
-    if not purchase:
-        raise HTTPException(status_code=404, detail="Invoice not found")
-    
-    if purchase.get("is_approved"):
-        raise HTTPException(status_code=400, detail="Invoice already approved")
-    
+    return await sign_feed_purchase(purchase_id, current_user)
+
+async def sign_feed_purchase(purchase_id: str, current_user: dict) -> dict:
     # Generate signature code
-    import hashlib
     signature_data = f"{purchase_id}-{current_user['id']}-{datetime.now().isoformat()}"
     signature_code = hashlib.sha256(signature_data.encode()).hexdigest()[:16].upper()
     
-    await db.feed_purchases.update_one(
-        {"id": purchase_id},
-        {"$set": {
-            "is_approved": True,
-            "approved_by": current_user["id"],
-            "approved_by_name": current_user.get("full_name", ""),
-            "approved_at": datetime.now(timezone.utc).isoformat(),
-            "signature_code": signature_code
-        }}
+    purchase = await transition_status(
+        "feed_purchase", purchase_id, "approve", current_user,
+        extra={"signature_code": signature_code}
     )
     
     await log_activity(
@@ -2594,9 +4306,12 @@ async def approve_feed_purchase(purchase_id: str, current_user: dict = Depends(r
 
 @api_router.get("/feed-purchases", response_model=List[FeedPurchase])
 async def get_feed_purchases(
+    response: Response,
     supplier_id: Optional[str] = None,
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -2610,13 +4325,13 @@ async def get_feed_purchases(
         else:
             query["purchase_date"] = {"$lte": end_date}
     
-    purchases = await db.feed_purchases.find(query, {"_id": 0}).sort("purchase_date", -1).to_list(1000)
+    purchases = await paginate(response, db.feed_purchases, query, sort_field="purchase_date", page_size=page_size, cursor=cursor)
     return purchases
 
 # Get feed purchase invoice for printing
 @api_router.get("/feed-purchases/{purchase_id}/invoice")
-async def get_feed_purchase_invoice(purchase_id: str, current_user: dict = Depends(get_current_user)):
-    """Get feed purchase invoice details for printing"""
+async def get_feed_purchase_invoice(purchase_id: str, format: str = "json", current_user: dict = Depends(get_current_user)):
+    """Get feed purchase invoice details for printing (format=pdf returns a rendered invoice)"""
     purchase = await db.feed_purchases.find_one({"id": purchase_id}, {"_id": 0})
     if not purchase:
         raise HTTPException(status_code=404, detail="Invoice not found")
@@ -2633,6 +4348,15 @@ async def get_feed_purchase_invoice(purchase_id: str, current_user: dict = Depen
         "cr_number": "XXXXXXXX"
     }
     
+    if format == "pdf":
+        pdf_bytes = await render_pdf(pdf_renderer.render_feed_invoice, purchase, supplier, company_info)
+        filename = purchase.get("invoice_number") or purchase_id[:8]
+        return StreamingResponse(
+            io.BytesIO(pdf_bytes),
+            media_type="application/pdf",
+            headers={"Content-Disposition": f"attachment; filename=feed_invoice_{filename}.pdf"}
+        )
+    
     return {
         "invoice": purchase,
         "supplier": supplier,
@@ -2662,19 +4386,21 @@ async def update_feed_purchase(purchase_id: str, purchase_data: FeedPurchaseCrea
     if not existing:
         raise HTTPException(status_code=404, detail="Feed purchase not found")
     
-    # Get supplier
-    supplier = await db.suppliers.find_one({"id": purchase_data.supplier_id}, {"_id": 0})
-    if not supplier:
-        raise HTTPException(status_code=404, detail="Supplier not found")
-    
     # Calculate new total
     new_total = purchase_data.quantity * purchase_data.price_per_unit
     old_total = existing.get("total_amount", 0)
     difference = new_total - old_total
     
-    # Check if supplier has enough balance for the difference
-    if difference > 0 and supplier.get("balance", 0) < difference:
-        raise HTTPException(status_code=400, detail="Insufficient supplier balance")
+    # Update supplier balance; an increase must be covered by the balance
+    if difference > 0:
+        await debit_supplier_balance(purchase_data.supplier_id, difference)
+    else:
+        result = await db.suppliers.update_one(
+            {"id": purchase_data.supplier_id},
+            touch({"$inc": {"balance": -difference}})
+        )
+        if result.matched_count == 0:
+            raise HTTPException(status_code=404, detail="Supplier not found")
     
     # Update purchase
     update_data = purchase_data.model_dump()
@@ -2685,13 +4411,6 @@ async def update_feed_purchase(purchase_id: str, purchase_data: FeedPurchaseCrea
         {"$set": update_data}
     )
     
-    # Update supplier balance
-    if difference != 0:
-        await db.suppliers.update_one(
-            {"id": purchase_data.supplier_id},
-            {"$inc": {"balance": -difference}}
-        )
-    
     purchase = await db.feed_purchases.find_one({"id": purchase_id}, {"_id": 0})
     return purchase
 
@@ -2709,7 +4428,7 @@ async def delete_feed_purchase(purchase_id: str, current_user: dict = Depends(ge
     # Refund supplier balance
     await db.suppliers.update_one(
         {"id": existing["supplier_id"]},
-        {"$inc": {"balance": existing.get("total_amount", 0)}}
+        touch({"$inc": {"balance": existing.get("total_amount", 0)}})
     )
     
     # Delete purchase
@@ -2733,25 +4452,30 @@ async def delete_feed_purchase(purchase_id: str, current_user: dict = Depends(ge
 async def get_treasury_balance(current_user: dict = Depends(get_current_user)):
     """Get current treasury balance and summary"""
     # Get or create treasury record
-    treasury = await db.treasury.find_one({"type": "main"}, {"_id": 0})
-    if not treasury:
-        treasury = {
-            "type": "main",
+    treasury = await db.treasury.find_one_and_update(
+        {"type": "main"},
+        {"$setOnInsert": {
             "current_balance": 0.0,
             "total_deposits": 0.0,
             "total_withdrawals": 0.0,
             "last_updated": datetime.now(timezone.utc).isoformat()
-        }
-        await db.treasury.insert_one(treasury)
+        }},
+        projection={"_id": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
     
     return treasury
 
 @api_router.get("/treasury/transactions")
 async def get_treasury_transactions(
+    response: Response,
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
     transaction_type: Optional[str] = None,
     limit: int = 100,
+    page_size: Optional[int] = None,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """Get treasury transactions with filters"""
@@ -2766,7 +4490,17 @@ async def get_treasury_transactions(
     if transaction_type:
         query["transaction_type"] = transaction_type
     
-    transactions = await db.treasury_transactions.find(query, {"_id": 0}).sort("created_at", -1).to_list(limit)
+    transactions = await paginate(response, db.treasury_transactions, query, sort_field="created_at", page_size=page_size or limit,
+                                  cursor=cursor, projection=TREASURY_CLOSING_FIELDS)
+    
+    # balance_after is stored at posting time; derive the current running balance
+    # for an unfiltered page from the closings so later edits are reflected
+    if transactions and not transaction_type:
+        first = transactions[0]
+        running = (await treasury_balance_at(first["created_at"], first["id"]))["balance"]
+        for transaction in transactions:
+            transaction["balance_after"] = running
+            running -= signed_amount(transaction)
     return transactions
 
 @api_router.post("/treasury/transaction")
@@ -2779,46 +4513,17 @@ async def create_treasury_transaction(
     current_user: dict = Depends(require_role(["admin", "accountant"]))
 ):
     """Create a manual treasury transaction"""
-    # Get current balance
-    treasury = await db.treasury.find_one({"type": "main"}, {"_id": 0})
-    current_balance = treasury.get("current_balance", 0) if treasury else 0
-    
-    # Calculate new balance
-    if transaction_type == "deposit":
-        new_balance = current_balance + amount
-    else:  # withdrawal
-        if amount > current_balance:
-            raise HTTPException(status_code=400, detail="رصيد الخزينة غير كافٍ")
-        new_balance = current_balance - amount
-    
-    # Create transaction record
-    transaction = TreasuryTransaction(
+    # A manual withdrawal has always been refused when the treasury cannot cover it;
+    # the guard makes that check part of the $inc
+    transaction = await update_treasury(
         transaction_type=transaction_type,
         amount=amount,
         source_type=source_type,
-        source_id=source_id,
         description=description,
-        balance_after=new_balance,
-        created_by=current_user["id"],
-        created_by_name=current_user.get("full_name", "")
-    )
-    
-    await db.treasury_transactions.insert_one(transaction.model_dump())
-    
-    # Update treasury balance
-    update_data = {
-        "current_balance": new_balance,
-        "last_updated": datetime.now(timezone.utc).isoformat()
-    }
-    if transaction_type == "deposit":
-        update_data["total_deposits"] = treasury.get("total_deposits", 0) + amount if treasury else amount
-    else:
-        update_data["total_withdrawals"] = treasury.get("total_withdrawals", 0) + amount if treasury else amount
-    
-    await db.treasury.update_one(
-        {"type": "main"},
-        {"$set": update_data},
-        upsert=True
+        source_id=source_id,
+        user_id=current_user["id"],
+        user_name=current_user.get("full_name", ""),
+        require_funds=True
     )
     
     await log_activity(
@@ -2829,7 +4534,7 @@ async def create_treasury_transaction(
         details=f"{'إيداع' if transaction_type == 'deposit' else 'سحب'}: {amount} ر.ع - {description}"
     )
     
-    return transaction.model_dump()
+    return transaction
 
 @api_router.put("/treasury/transaction/{transaction_id}")
 async def update_treasury_transaction(
@@ -2839,54 +4544,39 @@ async def update_treasury_transaction(
     current_user: dict = Depends(require_role(["admin"]))
 ):
     """Update a treasury transaction (admin only)"""
-    # Get existing transaction
-    existing = await db.treasury_transactions.find_one({"id": transaction_id}, {"_id": 0})
-    if not existing:
-        raise HTTPException(status_code=404, detail="العملية غير موجودة")
-    
-    # Calculate balance adjustment
-    old_amount = existing.get("amount", 0)
-    new_amount = amount if amount is not None else old_amount
-    amount_diff = new_amount - old_amount
-    
-    # Update transaction
-    update_data = {}
-    if amount is not None:
-        update_data["amount"] = amount
-    if description is not None:
-        update_data["description"] = description
-    
-    if update_data:
-        await db.treasury_transactions.update_one(
-            {"id": transaction_id},
-            {"$set": update_data}
-        )
-    
-    # Update treasury balance if amount changed
-    if amount_diff != 0:
-        treasury = await db.treasury.find_one({"type": "main"}, {"_id": 0})
-        current_balance = treasury.get("current_balance", 0) if treasury else 0
+    # The new amount and the closings it shifts are written under the closing lock,
+    # so a closing run sees either both or neither; the read is inside it too so
+    # concurrent edits each shift from the amount the previous one left
+    async with treasury_closing_lock():
+        # Get existing transaction
+        existing = await db.treasury_transactions.find_one({"id": transaction_id}, {"_id": 0})
+        if not existing:
+            raise HTTPException(status_code=404, detail="العملية غير موجودة")
+        # Count it into its closing first if it is still pending there, so the
+        # shift below starts from the amount the closings already hold
+        await settle_late_treasury_transactions({"id": transaction_id})
         
-        if existing.get("transaction_type") == "deposit":
-            new_balance = current_balance + amount_diff
-            new_deposits = treasury.get("total_deposits", 0) + amount_diff
-            await db.treasury.update_one(
-                {"type": "main"},
-                {"$set": {"current_balance": new_balance, "total_deposits": new_deposits, "last_updated": datetime.now(timezone.utc).isoformat()}}
-            )
-        else:
-            new_balance = current_balance - amount_diff
-            new_withdrawals = treasury.get("total_withdrawals", 0) + amount_diff
-            await db.treasury.update_one(
-                {"type": "main"},
-                {"$set": {"current_balance": new_balance, "total_withdrawals": new_withdrawals, "last_updated": datetime.now(timezone.utc).isoformat()}}
+        # Calculate balance adjustment
+        old_amount = existing.get("amount", 0)
+        new_amount = amount if amount is not None else old_amount
+        amount_diff = new_amount - old_amount
+        
+        # Update transaction
+        update_data = {}
+        if amount is not None:
+            update_data["amount"] = amount
+        if description is not None:
+            update_data["description"] = description
+        
+        if update_data:
+            await db.treasury_transactions.update_one(
+                {"id": transaction_id},
+                {"$set": update_data}
             )
         
-        # Update balance_after for this and subsequent transactions
-        await db.treasury_transactions.update_one(
-            {"id": transaction_id},
-            {"$set": {"balance_after": new_balance if existing.get("transaction_type") == "deposit" else current_balance - amount_diff}}
-        )
+        # Update treasury balance if amount changed
+        if amount_diff != 0:
+            await shift_treasury_transaction(existing, amount_diff)
     
     await log_activity(
         user_id=current_user["id"],
@@ -2897,7 +4587,7 @@ async def update_treasury_transaction(
         details=f"تعديل عملية خزينة: {new_amount} ر.ع"
     )
     
-    updated = await db.treasury_transactions.find_one({"id": transaction_id}, {"_id": 0})
+    updated = await db.treasury_transactions.find_one({"id": transaction_id}, {"_id": 0, **TREASURY_CLOSING_FIELDS})
     return updated
 
 @api_router.delete("/treasury/transaction/{transaction_id}")
@@ -2906,35 +4596,21 @@ async def delete_treasury_transaction(
     current_user: dict = Depends(require_role(["admin"]))
 ):
     """Delete a treasury transaction and reverse its effect (admin only)"""
-    # Get existing transaction
-    existing = await db.treasury_transactions.find_one({"id": transaction_id}, {"_id": 0})
-    if not existing:
-        raise HTTPException(status_code=404, detail="العملية غير موجودة")
-    
-    amount = existing.get("amount", 0)
-    transaction_type = existing.get("transaction_type")
-    
-    # Reverse the transaction effect on treasury
-    treasury = await db.treasury.find_one({"type": "main"}, {"_id": 0})
-    current_balance = treasury.get("current_balance", 0) if treasury else 0
-    
-    if transaction_type == "deposit":
-        new_balance = current_balance - amount
-        new_deposits = max(0, treasury.get("total_deposits", 0) - amount)
-        await db.treasury.update_one(
-            {"type": "main"},
-            {"$set": {"current_balance": new_balance, "total_deposits": new_deposits, "last_updated": datetime.now(timezone.utc).isoformat()}}
-        )
-    else:
-        new_balance = current_balance + amount
-        new_withdrawals = max(0, treasury.get("total_withdrawals", 0) - amount)
-        await db.treasury.update_one(
-            {"type": "main"},
-            {"$set": {"current_balance": new_balance, "total_withdrawals": new_withdrawals, "last_updated": datetime.now(timezone.utc).isoformat()}}
-        )
-    
-    # Delete the transaction
-    await db.treasury_transactions.delete_one({"id": transaction_id})
+    async with treasury_closing_lock():
+        # Get existing transaction; read under the lock so two deletes cannot both reverse it
+        existing = await db.treasury_transactions.find_one({"id": transaction_id}, {"_id": 0})
+        if not existing:
+            raise HTTPException(status_code=404, detail="العملية غير موجودة")
+        await settle_late_treasury_transactions({"id": transaction_id})
+        
+        amount = existing.get("amount", 0)
+        
+        # Reverse the transaction effect on treasury
+        treasury = await shift_treasury_transaction(existing, -amount, count_delta=-1)
+        new_balance = treasury["current_balance"]
+        
+        # Delete the transaction
+        await db.treasury_transactions.delete_one({"id": transaction_id})
     
     await log_activity(
         user_id=current_user["id"],
@@ -2947,16 +4623,59 @@ async def delete_treasury_transaction(
     
     return {"message": "تم حذف العملية وعكس تأثيرها على الخزينة", "new_balance": new_balance}
 
-# Helper function to update treasury
-async def update_treasury(transaction_type: str, amount: float, source_type: str, description: str, source_id: str = None, user_id: str = None, user_name: str = None):
-    """Helper to update treasury balance from other operations"""
-    treasury = await db.treasury.find_one({"type": "main"}, {"_id": 0})
-    current_balance = treasury.get("current_balance", 0) if treasury else 0
+# Treasury posting helpers: every balance change is a single atomic $inc on the
+# treasury document, so concurrent postings cannot overwrite each other.
+async def apply_treasury_delta(balance_delta: float, deposits_delta: float = 0, withdrawals_delta: float = 0,
+                               require_funds: bool = False) -> dict:
+    """Atomically apply a change to the main treasury and return the updated document.
     
+    With require_funds the update only matches while the balance covers the
+    withdrawal; otherwise a 400 is raised and nothing is changed.
+    """
+    query = {"type": "main"}
+    if require_funds and balance_delta < 0:
+        query["current_balance"] = {"$gte": -balance_delta}
+    treasury = await db.treasury.find_one_and_update(
+        query,
+        {
+            "$inc": {
+                "current_balance": balance_delta,
+                "total_deposits": deposits_delta,
+                "total_withdrawals": withdrawals_delta
+            },
+            "$set": {"last_updated": datetime.now(timezone.utc).isoformat()}
+        },
+        projection={"_id": 0},
+        upsert=not require_funds,
+        return_document=ReturnDocument.AFTER
+    )
+    if treasury is None:
+        current = await db.treasury.find_one({"type": "main"}, {"_id": 0, "current_balance": 1})
+        treasury_balance = current.get("current_balance", 0) if current else 0
+        raise HTTPException(
+            status_code=400,
+            detail=f"رصيد الخزينة غير كافٍ. الرصيد الحالي: {treasury_balance} ر.ع، المطلوب: {-balance_delta} ر.ع"
+        )
+    return treasury
+
+async def shift_treasury_transaction(transaction: dict, amount_delta: float, count_delta: int = 0) -> dict:
+    """Apply a change in a posted transaction's amount to the treasury and to the
+    daily closings from its day forward"""
+    if transaction.get("transaction_type") == "deposit":
+        treasury = await apply_treasury_delta(amount_delta, deposits_delta=amount_delta)
+    else:
+        treasury = await apply_treasury_delta(-amount_delta, withdrawals_delta=amount_delta)
+    await shift_treasury_closings(transaction, amount_delta, count_delta)
+    return treasury
+
+# Helper function to update treasury
+async def update_treasury(transaction_type: str, amount: float, source_type: str, description: str, source_id: str = None,
+                          user_id: str = None, user_name: str = None, require_funds: bool = False) -> dict:
+    """Post a deposit or withdrawal to the treasury and record the transaction"""
     if transaction_type == "deposit":
-        new_balance = current_balance + amount
+        treasury = await apply_treasury_delta(amount, deposits_delta=amount)
     else:
-        new_balance = current_balance - amount
+        treasury = await apply_treasury_delta(-amount, withdrawals_delta=amount, require_funds=require_funds)
     
     transaction = TreasuryTransaction(
         transaction_type=transaction_type,
@@ -2964,28 +4683,244 @@ async def update_treasury(transaction_type: str, amount: float, source_type: str
         source_type=source_type,
         source_id=source_id,
         description=description,
-        balance_after=new_balance,
+        balance_after=treasury["current_balance"],
         created_by=user_id,
         created_by_name=user_name or ""
     )
     
-    await db.treasury_transactions.insert_one(transaction.model_dump())
+    # Pending until a closing run counts it into its day
+    await db.treasury_transactions.insert_one({**transaction.model_dump(), "closing_pending": True})
     
-    update_data = {
-        "current_balance": new_balance,
-        "last_updated": datetime.now(timezone.utc).isoformat()
-    }
-    if transaction_type == "deposit":
-        update_data["total_deposits"] = treasury.get("total_deposits", 0) + amount if treasury else amount
-    else:
-        update_data["total_withdrawals"] = treasury.get("total_withdrawals", 0) + amount if treasury else amount
+    # Stamped before midnight but inserted after the closing run read that day:
+    # carry it into the closings now rather than at the next run
+    if local_date(transaction.created_at) < local_today():
+        try:
+            async with treasury_closing_lock():
+                await settle_late_treasury_transactions({"id": transaction.id})
+        except HTTPException:
+            logging.warning(f"Treasury transaction {transaction.id} is left for the next closing run")
     
-    await db.treasury.update_one({"type": "main"}, {"$set": update_data}, upsert=True)
+    return transaction.model_dump()
+
+# Daily treasury closings (الإقفال اليومي للخزينة)
+# One document per local day with opening, deposits, withdrawals and closing.
+# The balance at any moment is the previous day's closing plus a replay of that
+# day's transactions. Editing a past transaction shifts the closings from its
+# day forward instead of rewriting every later transaction.
+TREASURY_CLOSING_INTERVAL_HOURS = float(os.environ.get('TREASURY_CLOSING_INTERVAL_HOURS', 1))
+TREASURY_LOCK_LEASE_SECONDS = int(os.environ.get('TREASURY_LOCK_LEASE_SECONDS', 300))
+TREASURY_LOCK_WAIT_SECONDS = float(os.environ.get('TREASURY_LOCK_WAIT_SECONDS', 10))
+# Bookkeeping of the closing runs on each transaction, kept out of API responses
+TREASURY_CLOSING_FIELDS = {"closing_pending": 0, "closing_run": 0}
+
+@asynccontextmanager
+async def treasury_closing_lock():
+    """Serialize closing runs with edits of posted transactions across workers.
+    
+    A closing run reads a day's transactions and inserts its closing; an edit
+    landing in between would be counted by the run and then shifted again.
+    The lock is a leased document, so a crashed holder frees it on expiry.
+    """
+    owner = str(uuid.uuid4())
+    deadline = time.monotonic() + TREASURY_LOCK_WAIT_SECONDS
+    while True:
+        now = datetime.now(timezone.utc)
+        try:
+            await db.locks.find_one_and_update(
+                {"id": "treasury_closing", "$or": [{"locked_until": {"$lt": now}}, {"locked_until": {"$exists": False}}]},
+                {"$set": {"owner": owner, "locked_until": now + timedelta(seconds=TREASURY_LOCK_LEASE_SECONDS)}},
+                upsert=True
+            )
+            break
+        except DuplicateKeyError:
+            # Held by someone else: the filter missed and the upsert hit the unique id
+            if time.monotonic() >= deadline:
+                raise HTTPException(status_code=409, detail="إقفال الخزينة قيد التنفيذ، أعد المحاولة لاحقاً")
+            await asyncio.sleep(0.2)
+    try:
+        yield
+    finally:
+        await db.locks.update_one({"id": "treasury_closing", "owner": owner}, {"$unset": {"owner": "", "locked_until": ""}})
+
+def signed_amount(transaction: dict) -> float:
+    amount = transaction.get("amount", 0)
+    return amount if transaction.get("transaction_type") == "deposit" else -amount
+
+async def close_treasury_days(through: Optional[str] = None) -> dict:
+    """Write closings for every day after the last closing up to `through` (default: yesterday)"""
+    async with treasury_closing_lock():
+        return await _close_pending_days(through)
+
+async def _close_pending_days(through: Optional[str]) -> dict:
+    through = through or (datetime.fromisoformat(local_today()) - timedelta(days=1)).date().isoformat()
+    await settle_late_treasury_transactions()
+    last = await db.treasury_daily_closings.find_one({}, {"_id": 0}, sort=[("date", -1)])
+    if last:
+        first_day = (datetime.fromisoformat(last["date"]) + timedelta(days=1)).date().isoformat()
+        balance = last["closing"]
+    else:
+        earliest = await db.treasury_transactions.find_one({}, {"_id": 0, "created_at": 1}, sort=[("created_at", 1)])
+        if earliest is None:
+            return {"closed": 0, "through": through}
+        first_day = local_date(earliest["created_at"])
+        balance = 0.0
+    if first_day > through:
+        return {"closed": 0, "through": through}
+    
+    # Claim the rows this run counts; one inserted after the claim stays pending
+    # and is settled into its closing by its poster or the next run
+    run_id = str(uuid.uuid4())
+    await db.treasury_transactions.update_many(
+        {"created_at": {"$gte": local_day_bounds(first_day)[0], "$lt": local_day_bounds(through)[1]}},
+        {"$set": {"closing_run": run_id}, "$unset": {"closing_pending": ""}}
+    )
+    pipeline = [
+        {"$match": {"closing_run": run_id}},
+        {"$group": {
+            "_id": {"$dateToString": {
+                "format": "%Y-%m-%d",
+                "date": {"$dateFromString": {"dateString": "$created_at"}},
+                "timezone": LOCAL_TIMEZONE
+            }},
+            "deposits": {"$sum": {"$cond": [{"$eq": ["$transaction_type", "deposit"]}, "$amount", 0]}},
+            "withdrawals": {"$sum": {"$cond": [{"$eq": ["$transaction_type", "deposit"]}, 0, "$amount"]}},
+            "count": {"$sum": 1}
+        }}
+    ]
+    days = {day["_id"]: day async for day in db.treasury_transactions.aggregate(pipeline)}
+    
+    # Every day gets a closing, even without transactions, so lookups never scan back
+    now = datetime.now(timezone.utc).isoformat()
+    operations = []
+    day = datetime.fromisoformat(first_day)
+    while day.date().isoformat() <= through:
+        date = day.date().isoformat()
+        totals = days.get(date, {})
+        deposits = totals.get("deposits", 0)
+        withdrawals = totals.get("withdrawals", 0)
+        closing = {
+            "date": date,
+            "opening": balance,
+            "deposits": deposits,
+            "withdrawals": withdrawals,
+            "closing": balance + deposits - withdrawals,
+            "transactions_count": totals.get("count", 0),
+            "closed_at": now
+        }
+        operations.append(UpdateOne({"date": date}, {"$setOnInsert": closing}, upsert=True))
+        balance = closing["closing"]
+        day += timedelta(days=1)
+    await db.treasury_daily_closings.bulk_write(operations, ordered=False)
+    return {"closed": len(operations), "through": through}
+
+async def run_treasury_closings():
+    while True:
+        try:
+            await close_treasury_days()
+        except Exception as e:
+            logging.error(f"Error closing treasury days: {e}")
+        await asyncio.sleep(TREASURY_CLOSING_INTERVAL_HOURS * 3600)
+
+async def settle_late_treasury_transactions(query: Optional[dict] = None) -> int:
+    """Count pending transactions dated on a day that was closed without them.
+    Callers hold treasury_closing_lock."""
+    last = await db.treasury_daily_closings.find_one({}, {"_id": 0, "date": 1}, sort=[("date", -1)])
+    if last is None:
+        return 0
+    pending = {**(query or {}), "closing_pending": True, "created_at": {"$lt": local_day_bounds(last["date"])[1]}}
+    settled = 0
+    async for transaction in db.treasury_transactions.find(pending, {"_id": 0}):
+        await shift_treasury_closings(transaction, transaction.get("amount", 0), count_delta=1)
+        await db.treasury_transactions.update_one({"id": transaction["id"]}, {"$unset": {"closing_pending": ""}})
+        settled += 1
+    return settled
+
+async def shift_treasury_closings(transaction: dict, amount_delta: float, count_delta: int = 0):
+    """Carry a change to a posted transaction into its day's closing and every later one.
+    Callers hold treasury_closing_lock together with the transaction write."""
+    day = local_date(transaction["created_at"])
+    signed = signed_amount({**transaction, "amount": amount_delta})
+    total_field = "deposits" if transaction.get("transaction_type") == "deposit" else "withdrawals"
+    await asyncio.gather(
+        db.treasury_daily_closings.update_one(
+            {"date": day},
+            {"$inc": {total_field: amount_delta, "closing": signed, "transactions_count": count_delta}}
+        ),
+        db.treasury_daily_closings.update_many({"date": {"$gt": day}}, {"$inc": {"opening": signed, "closing": signed}})
+    )
+
+async def treasury_balance_at(at: str, through_id: Optional[str] = None) -> dict:
+    """Treasury balance right after `at`: the closing before that day plus a replay of the day so far.
+    With `through_id`, of the transactions stamped exactly `at` only those up to that id
+    count, following the (created_at, id) order of the transaction pages."""
+    closing = await db.treasury_daily_closings.find_one(
+        {"date": {"$lt": local_date(at)}}, {"_id": 0}, sort=[("date", -1)]
+    )
+    created_at = {"$lte": at}
+    balance = 0.0
+    if closing:
+        created_at["$gte"] = local_day_bounds(closing["date"])[1]
+        balance = closing["closing"]
+    match = {"created_at": created_at}
+    if through_id is not None:
+        match = {"$and": [match, {"$or": [{"created_at": {"$lt": at}}, {"created_at": at, "id": {"$lte": through_id}}]}]}
+    replay = await db.treasury_transactions.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": None,
+            "net": {"$sum": {"$cond": [{"$eq": ["$transaction_type", "deposit"]}, "$amount", {"$multiply": ["$amount", -1]}]}},
+            "count": {"$sum": 1}
+        }}
+    ]).to_list(1)
+    net = replay[0]["net"] if replay else 0
+    return {
+        "at": at,
+        "balance": balance + net,
+        "closing_date": closing["date"] if closing else None,
+        "replayed_transactions": replay[0]["count"] if replay else 0
+    }
+
+@api_router.get("/treasury/balance-at")
+async def get_treasury_balance_at(at: str, current_user: dict = Depends(get_current_user)):
+    """Treasury balance at any timestamp"""
+    return await treasury_balance_at(utc_timestamp(at))
+
+@api_router.get("/treasury/closings")
+async def get_treasury_closings(
+    response: Response,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    query = {}
+    if start_date:
+        query["date"] = {"$gte": start_date}
+    if end_date:
+        query.setdefault("date", {})["$lte"] = end_date
     
-    return new_balance
+    closings = await paginate(response, db.treasury_daily_closings, query, sort_field="date", page_size=page_size, cursor=cursor)
+    return closings
+
+@api_router.post("/treasury/closings/run")
+async def run_treasury_closing(through: Optional[str] = None, current_user: dict = Depends(require_role(["admin", "accountant"]))):
+    """Close every pending day up to `through` (default: yesterday)"""
+    if through and through >= local_today():
+        raise HTTPException(status_code=400, detail="لا يمكن إقفال يوم لم ينتهِ بعد")
+    return await close_treasury_days(through)
 
 # ==================== INTEGRATED FINANCIAL REPORTS (التقارير المالية المتكاملة) ====================
 
+async def sum_fields(collection, match: dict, fields: List[str]) -> dict:
+    """Sum the given numeric fields server-side; returns the totals plus a document count"""
+    group = {"_id": None, "count": {"$sum": 1}}
+    group.update({field: {"$sum": f"${field}"} for field in fields})
+    result = await collection.aggregate([{"$match": match}, {"$group": group}]).to_list(1)
+    if not result:
+        return {"count": 0, **{field: 0 for field in fields}}
+    return result[0]
+
 @api_router.get("/reports/financial-summary")
 async def get_financial_summary(
     start_date: Optional[str] = None,
@@ -3003,51 +4938,42 @@ async def get_financial_summary(
     
     date_query = {"$gte": start_date, "$lte": end_date}
     
-    # Get milk receptions (purchases)
-    receptions = await db.milk_receptions.find(
-        {"reception_date": date_query}, {"_id": 0}
-    ).to_list(10000)
-    total_milk_purchased_liters = sum(r.get("quantity_liters", 0) for r in receptions)
-    total_milk_purchased_amount = sum(r.get("total_amount", 0) for r in receptions)
-    
-    # Get sales
-    sales = await db.sales.find(
-        {"sale_date": date_query}, {"_id": 0}
-    ).to_list(10000)
-    total_milk_sold_liters = sum(s.get("quantity_liters", 0) for s in sales)
-    total_sales_amount = sum(s.get("total_amount", 0) for s in sales)
-    
-    # Get supplier payments (approved only)
-    supplier_payments = await db.payments.find(
-        {"payment_type": "supplier_payment", "status": "approved", "payment_date": date_query}, {"_id": 0}
-    ).to_list(10000)
-    total_supplier_payments = sum(p.get("amount", 0) for p in supplier_payments)
-    
-    # Get customer receipts (approved only)
-    customer_receipts = await db.payments.find(
-        {"payment_type": "customer_receipt", "status": "approved", "payment_date": date_query}, {"_id": 0}
-    ).to_list(10000)
-    total_customer_receipts = sum(p.get("amount", 0) for p in customer_receipts)
-    
-    # Get treasury balance
-    treasury = await db.treasury.find_one({"type": "main"}, {"_id": 0})
+    # Every total is computed in MongoDB; the independent queries run concurrently
+    (
+        purchases,
+        sales,
+        supplier_payments,
+        customer_receipts,
+        supplier_dues,
+        customer_dues,
+        treasury,
+        inventory
+    ) = await asyncio.gather(
+        sum_fields(db.milk_receptions, {"reception_date": date_query}, ["quantity_liters", "total_amount"]),
+        sum_fields(db.sales, {"sale_date": date_query}, ["quantity_liters", "total_amount"]),
+        sum_fields(db.payments, {"payment_type": "supplier_payment", "status": "approved", "payment_date": date_query}, ["amount"]),
+        sum_fields(db.payments, {"payment_type": "customer_receipt", "status": "approved", "payment_date": date_query}, ["amount"]),
+        sum_fields(db.suppliers, {"is_active": True}, ["balance"]),
+        sum_fields(db.customers, {"is_active": True}, ["balance"]),
+        db.treasury.find_one({"type": "main"}, {"_id": 0, "current_balance": 1}),
+        raw_milk_stock()
+    )
+    
+    total_milk_purchased_liters = purchases["quantity_liters"]
+    total_milk_purchased_amount = purchases["total_amount"]
+    total_milk_sold_liters = sales["quantity_liters"]
+    total_sales_amount = sales["total_amount"]
+    total_supplier_payments = supplier_payments["amount"]
+    total_customer_receipts = customer_receipts["amount"]
+    total_supplier_dues = supplier_dues["balance"]
+    total_customer_dues = customer_dues["balance"]
     treasury_balance = treasury.get("current_balance", 0) if treasury else 0
-    
-    # Get inventory
-    inventory = await db.inventory.find_one({"product_type": "raw_milk"}, {"_id": 0})
-    current_stock_liters = inventory.get("quantity_liters", 0) if inventory else 0
+    current_stock_liters = inventory
     
     # Calculate profit/loss
     gross_profit = total_sales_amount - total_milk_purchased_amount
     net_cash_flow = total_customer_receipts - total_supplier_payments
     
-    # Get outstanding balances
-    suppliers = await db.suppliers.find({"is_active": True}, {"_id": 0, "balance": 1}).to_list(1000)
-    total_supplier_dues = sum(s.get("balance", 0) for s in suppliers)
-    
-    customers = await db.customers.find({"is_active": True}, {"_id": 0, "balance": 1}).to_list(1000)
-    total_customer_dues = sum(c.get("balance", 0) for c in customers)
-    
     return {
         "period": {
             "start_date": start_date,
@@ -3056,13 +4982,13 @@ async def get_financial_summary(
         "purchases": {
             "total_liters": round(total_milk_purchased_liters, 2),
             "total_amount": round(total_milk_purchased_amount, 2),
-            "transactions_count": len(receptions),
+            "transactions_count": purchases["count"],
             "avg_price_per_liter": round(total_milk_purchased_amount / total_milk_purchased_liters, 3) if total_milk_purchased_liters > 0 else 0
         },
         "sales": {
             "total_liters": round(total_milk_sold_liters, 2),
             "total_amount": round(total_sales_amount, 2),
-            "transactions_count": len(sales),
+            "transactions_count": sales["count"],
             "avg_price_per_liter": round(total_sales_amount / total_milk_sold_liters, 3) if total_milk_sold_liters > 0 else 0
         },
         "payments": {
@@ -3086,50 +5012,33 @@ async def get_financial_summary(
 
 @api_router.get("/dashboard/stats")
 async def get_dashboard_stats(current_user: dict = Depends(get_current_user)):
-    # Today's date range
-    today = datetime.now(timezone.utc).date()
-    today_start = datetime(today.year, today.month, today.day, tzinfo=timezone.utc).isoformat()
-    
     # Get counts
     suppliers_count = await db.suppliers.count_documents({"is_active": True})
     customers_count = await db.customers.count_documents({"is_active": True})
     
-    # Get today's receptions
-    today_receptions = await db.milk_receptions.find(
-        {"reception_date": {"$gte": today_start}},
-        {"_id": 0}
-    ).to_list(1000)
-    today_milk_quantity = sum(r.get("quantity_liters", 0) for r in today_receptions)
-    today_milk_value = sum(r.get("total_amount", 0) for r in today_receptions)
-    
-    # Get today's sales
-    today_sales = await db.sales.find(
-        {"sale_date": {"$gte": today_start}},
-        {"_id": 0}
-    ).to_list(1000)
-    today_sales_quantity = sum(s.get("quantity_liters", 0) for s in today_sales)
-    today_sales_value = sum(s.get("total_amount", 0) for s in today_sales)
+    # Today's receptions and sales from the daily rollups
+    today = local_today()
+    totals = sum_rollups(await read_rollups(today, today))
+    today_milk_quantity = totals["reception_liters"]
+    today_milk_value = totals["reception_amount"]
+    today_sales_quantity = totals["sales_liters"]
+    today_sales_value = totals["sales_amount"]
     
     # Get inventory
-    inventory = await db.inventory.find_one({"product_type": "raw_milk"}, {"_id": 0})
-    current_stock = inventory.get("quantity_liters", 0) if inventory else 0
+    current_stock = await raw_milk_stock()
     
     # Get average quality from today's receptions
     avg_fat = 0
     avg_protein = 0
-    if today_receptions:
-        fats = [r.get("quality_test", {}).get("fat_percentage", 0) for r in today_receptions if r.get("quality_test")]
-        proteins = [r.get("quality_test", {}).get("protein_percentage", 0) for r in today_receptions if r.get("quality_test")]
-        avg_fat = sum(fats) / len(fats) if fats else 0
-        avg_protein = sum(proteins) / len(proteins) if proteins else 0
-    
-    # Get supplier balances (amounts owed)
-    suppliers = await db.suppliers.find({"is_active": True}, {"_id": 0, "balance": 1}).to_list(1000)
-    total_supplier_dues = sum(s.get("balance", 0) for s in suppliers)
+    if totals["reception_count"]:
+        avg_fat = totals["fat_sum"] / totals["reception_count"]
+        avg_protein = totals["protein_sum"] / totals["reception_count"]
     
-    # Get customer balances (amounts receivable)
-    customers = await db.customers.find({"is_active": True}, {"_id": 0, "balance": 1}).to_list(1000)
-    total_customer_dues = sum(c.get("balance", 0) for c in customers)
+    # Get supplier balances (amounts owed) and customer balances (amounts receivable)
+    supplier_dues = await sum_fields(db.suppliers, {"is_active": True}, ["balance"])
+    total_supplier_dues = supplier_dues["balance"]
+    customer_dues = await sum_fields(db.customers, {"is_active": True}, ["balance"])
+    total_customer_dues = customer_dues["balance"]
     
     return {
         "suppliers_count": suppliers_count,
@@ -3148,38 +5057,38 @@ async def get_dashboard_stats(current_user: dict = Depends(get_current_user)):
 @api_router.get("/reports/daily")
 async def get_daily_report(date: Optional[str] = None, current_user: dict = Depends(get_current_user)):
     if not date:
-        date = datetime.now(timezone.utc).date().isoformat()
+        date = local_today()
     
-    day_start = f"{date}T00:00:00"
-    day_end = f"{date}T23:59:59"
+    day_start, day_end = local_day_bounds(date)
+    totals = sum_rollups(await read_rollups(date, date))
     
     receptions = await db.milk_receptions.find(
-        {"reception_date": {"$gte": day_start, "$lte": day_end}},
+        {"reception_date": {"$gte": day_start, "$lt": day_end}},
         {"_id": 0}
     ).to_list(1000)
     
     sales = await db.sales.find(
-        {"sale_date": {"$gte": day_start, "$lte": day_end}},
+        {"sale_date": {"$gte": day_start, "$lt": day_end}},
         {"_id": 0}
     ).to_list(1000)
     
     payments = await db.payments.find(
-        {"payment_date": {"$gte": day_start, "$lte": day_end}},
+        {"payment_date": {"$gte": day_start, "$lt": day_end}},
         {"_id": 0}
     ).to_list(1000)
     
     return {
         "date": date,
         "receptions": {
-            "count": len(receptions),
-            "total_quantity": sum(r.get("quantity_liters", 0) for r in receptions),
-            "total_value": sum(r.get("total_amount", 0) for r in receptions),
+            "count": totals["reception_count"],
+            "total_quantity": totals["reception_liters"],
+            "total_value": totals["reception_amount"],
             "details": receptions
         },
         "sales": {
-            "count": len(sales),
-            "total_quantity": sum(s.get("quantity_liters", 0) for s in sales),
-            "total_value": sum(s.get("total_amount", 0) for s in sales),
+            "count": totals["sales_count"],
+            "total_quantity": totals["sales_liters"],
+            "total_value": totals["sales_amount"],
             "details": sales
         },
         "payments": {
@@ -3191,52 +5100,39 @@ async def get_daily_report(date: Optional[str] = None, current_user: dict = Depe
 
 @api_router.get("/reports/monthly")
 async def get_monthly_report(year: int, month: int, current_user: dict = Depends(get_current_user)):
-    month_start = f"{year}-{month:02d}-01T00:00:00"
+    month_start = f"{year}-{month:02d}-01"
     if month == 12:
-        month_end = f"{year + 1}-01-01T00:00:00"
+        next_month = f"{year + 1}-01-01"
     else:
-        month_end = f"{year}-{month + 1:02d}-01T00:00:00"
-    
-    receptions = await db.milk_receptions.find(
-        {"reception_date": {"$gte": month_start, "$lt": month_end}},
-        {"_id": 0}
-    ).to_list(10000)
-    
-    sales = await db.sales.find(
-        {"sale_date": {"$gte": month_start, "$lt": month_end}},
-        {"_id": 0}
-    ).to_list(10000)
+        next_month = f"{year}-{month + 1:02d}-01"
+    month_end = (datetime.fromisoformat(next_month) - timedelta(days=1)).date().isoformat()
     
-    payments = await db.payments.find(
-        {"payment_date": {"$gte": month_start, "$lt": month_end}},
-        {"_id": 0}
-    ).to_list(10000)
+    rollups = await read_rollups(month_start, month_end)
+    payments = await sum_fields(
+        db.payments,
+        {"payment_date": {"$gte": local_day_bounds(month_start)[0], "$lt": local_day_bounds(next_month)[0]}},
+        ["amount"]
+    )
     
     # Group by day
     daily_data = {}
-    for r in receptions:
-        day = r.get("reception_date", "")[:10]
-        if day not in daily_data:
-            daily_data[day] = {"reception_qty": 0, "reception_value": 0, "sales_qty": 0, "sales_value": 0}
-        daily_data[day]["reception_qty"] += r.get("quantity_liters", 0)
-        daily_data[day]["reception_value"] += r.get("total_amount", 0)
-    
-    for s in sales:
-        day = s.get("sale_date", "")[:10]
-        if day not in daily_data:
-            daily_data[day] = {"reception_qty": 0, "reception_value": 0, "sales_qty": 0, "sales_value": 0}
-        daily_data[day]["sales_qty"] += s.get("quantity_liters", 0)
-        daily_data[day]["sales_value"] += s.get("total_amount", 0)
-    
+    for r in rollups:
+        day = daily_data.setdefault(r["date"], {"reception_qty": 0, "reception_value": 0, "sales_qty": 0, "sales_value": 0})
+        day["reception_qty"] += r.get("reception_liters", 0)
+        day["reception_value"] += r.get("reception_amount", 0)
+        day["sales_qty"] += r.get("sales_liters", 0)
+        day["sales_value"] += r.get("sales_amount", 0)
+    
+    totals = sum_rollups(rollups)
     return {
         "year": year,
         "month": month,
         "summary": {
-            "total_reception_quantity": sum(r.get("quantity_liters", 0) for r in receptions),
-            "total_reception_value": sum(r.get("total_amount", 0) for r in receptions),
-            "total_sales_quantity": sum(s.get("quantity_liters", 0) for s in sales),
-            "total_sales_value": sum(s.get("total_amount", 0) for s in sales),
-            "total_payments": sum(p.get("amount", 0) for p in payments)
+            "total_reception_quantity": totals["reception_liters"],
+            "total_reception_value": totals["reception_amount"],
+            "total_sales_quantity": totals["sales_liters"],
+            "total_sales_value": totals["sales_amount"],
+            "total_payments": payments["amount"]
         },
         "daily_data": [{"date": k, **v} for k, v in sorted(daily_data.items())]
     }
@@ -3268,17 +5164,30 @@ async def get_supplier_report(supplier_id: str, current_user: dict = Depends(get
         }
     }
 
+# ==================== PAYROLL DIRTY TRACKING (تتبع تغييرات الرواتب) ====================
+
+async def mark_payroll_dirty(*keys: Optional[str], reason: str = ""):
+    """Record that payroll inputs changed for employees (by id or name) so incremental recalculation picks them up"""
+    keys = {key for key in keys if key}
+    if not keys:
+        return
+    now = datetime.now(timezone.utc).isoformat()
+    await db.payroll_dirty.bulk_write([
+        UpdateOne({"key": key}, {"$max": {"changed_at": now}, "$set": {"reason": reason}}, upsert=True)
+        for key in keys
+    ], ordered=False)
+
 # ==================== HR - EMPLOYEE MANAGEMENT (إدارة الموظفين) ====================
 
 @api_router.post("/hr/employees", response_model=Employee)
 async def create_hr_employee(employee_data: EmployeeCreate, current_user: dict = Depends(get_current_user)):
     # Generate employee code if not provided
     if not employee_data.employee_code:
-        count = await db.hr_employees.count_documents({})
-        employee_data.employee_code = f"EMP{count + 1:04d}"
+        employee_data.employee_code = f"EMP{await next_sequence('EMP'):04d}"
     
     employee = Employee(**employee_data.model_dump())
     await db.hr_employees.insert_one(employee.model_dump())
+    await mark_payroll_dirty(employee.id, reason="employee")
     
     await log_activity(
         user_id=current_user["id"],
@@ -3294,14 +5203,17 @@ async def create_hr_employee(employee_data: EmployeeCreate, current_user: dict =
 
 @api_router.get("/hr/employees", response_model=List[Employee])
 async def get_hr_employees(
+    response: Response,
     department: Optional[str] = None,
     is_active: bool = True,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {"is_active": is_active}
     if department:
         query["department"] = department
-    employees = await db.hr_employees.find(query, {"_id": 0}).to_list(1000)
+    employees = await paginate(response, db.hr_employees, query, page_size=page_size, cursor=cursor)
     return employees
 
 @api_router.get("/hr/employees/{employee_id}", response_model=Employee)
@@ -3326,9 +5238,10 @@ async def update_hr_employee(employee_id: str, employee_data: EmployeeCreate, cu
     
     result = await db.hr_employees.update_one(
         {"id": employee_id},
-        {"$set": update_data}
+        touch({"$set": update_data})
     )
     employee = await db.hr_employees.find_one({"id": employee_id}, {"_id": 0})
+    await mark_payroll_dirty(employee_id, reason="employee")
     
     await log_activity(
         user_id=current_user["id"],
@@ -3350,8 +5263,9 @@ async def delete_hr_employee(employee_id: str, current_user: dict = Depends(get_
     
     result = await db.hr_employees.update_one(
         {"id": employee_id},
-        {"$set": {"is_active": False}}
+        touch({"$set": {"is_active": False}})
     )
+    await mark_payroll_dirty(employee_id, reason="employee")
     
     await log_activity(
         user_id=current_user["id"],
@@ -3403,17 +5317,18 @@ async def create_employee_account(
         center_id=employee.get("center_id")
     )
     user_dict = user.model_dump()
-    user_dict["password"] = hash_password(password)
+    user_dict["password"] = await hash_password(password)
     user_dict["employee_id"] = employee_id
     user_dict["department"] = employee.get("department")
     user_dict["permissions"] = employee.get("permissions", [])
     
     await db.users.insert_one(user_dict)
+    user_cache.invalidate(user_dict["id"])
     
     # Update employee
     await db.hr_employees.update_one(
         {"id": employee_id},
-        {"$set": {"can_login": True}}
+        touch({"$set": {"can_login": True}})
     )
     
     return {"message": "User account created successfully", "username": username}
@@ -3434,17 +5349,22 @@ async def create_attendance(attendance_data: AttendanceCreate, current_user: dic
             {"$set": attendance_data.model_dump()}
         )
         attendance = await db.hr_attendance.find_one({"id": existing["id"]}, {"_id": 0})
+        await mark_payroll_dirty(attendance_data.employee_id, attendance_data.employee_name, reason="attendance")
         return attendance
     
     attendance = Attendance(**attendance_data.model_dump())
     await db.hr_attendance.insert_one(attendance.model_dump())
+    await mark_payroll_dirty(attendance.employee_id, attendance.employee_name, reason="attendance")
     return attendance
 
 @api_router.get("/hr/attendance")
 async def get_attendance(
+    response: Response,
     employee_id: Optional[str] = None,
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -3458,7 +5378,7 @@ async def get_attendance(
         else:
             query["date"] = {"$lte": end_date}
     
-    attendance = await db.hr_attendance.find(query, {"_id": 0}).sort("date", -1).to_list(1000)
+    attendance = await paginate(response, db.hr_attendance, query, sort_field="date", page_size=page_size, cursor=cursor)
     return attendance
 
 @api_router.get("/hr/attendance/report")
@@ -3534,8 +5454,11 @@ async def create_leave_request(request_data: LeaveRequestCreate, current_user: d
 
 @api_router.get("/hr/leave-requests")
 async def get_leave_requests(
+    response: Response,
     status: Optional[str] = None,
     employee_id: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -3544,23 +5467,12 @@ async def get_leave_requests(
     if employee_id:
         query["employee_id"] = employee_id
     
-    requests = await db.hr_leave_requests.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    requests = await paginate(response, db.hr_leave_requests, query, sort_field="created_at", page_size=page_size, cursor=cursor)
     return requests
 
 @api_router.put("/hr/leave-requests/{request_id}/approve")
 async def approve_leave_request(request_id: str, current_user: dict = Depends(get_current_user)):
-    result = await db.hr_leave_requests.update_one(
-        {"id": request_id},
-        {"$set": {
-            "status": "approved",
-            "approved_by": current_user["full_name"],
-            "approved_at": datetime.now(timezone.utc).isoformat()
-        }}
-    )
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Leave request not found")
-    
-    request = await db.hr_leave_requests.find_one({"id": request_id}, {"_id": 0})
+    request = await transition_status("leave_request", request_id, "approve", current_user)
     
     await log_activity(
         user_id=current_user["id"],
@@ -3576,19 +5488,7 @@ async def approve_leave_request(request_id: str, current_user: dict = Depends(ge
 
 @api_router.put("/hr/leave-requests/{request_id}/reject")
 async def reject_leave_request(request_id: str, reason: str = "", current_user: dict = Depends(get_current_user)):
-    result = await db.hr_leave_requests.update_one(
-        {"id": request_id},
-        {"$set": {
-            "status": "rejected",
-            "approved_by": current_user["full_name"],
-            "approved_at": datetime.now(timezone.utc).isoformat(),
-            "rejection_reason": reason
-        }}
-    )
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Leave request not found")
-    
-    request = await db.hr_leave_requests.find_one({"id": request_id}, {"_id": 0})
+    request = await transition_status("leave_request", request_id, "reject", current_user, reason=reason)
     
     await log_activity(
         user_id=current_user["id"],
@@ -3623,8 +5523,11 @@ async def create_expense_request(request_data: ExpenseRequestCreate, current_use
 
 @api_router.get("/hr/expense-requests")
 async def get_expense_requests(
+    response: Response,
     status: Optional[str] = None,
     employee_id: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -3633,23 +5536,12 @@ async def get_expense_requests(
     if employee_id:
         query["employee_id"] = employee_id
     
-    requests = await db.hr_expense_requests.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    requests = await paginate(response, db.hr_expense_requests, query, sort_field="created_at", page_size=page_size, cursor=cursor)
     return requests
 
 @api_router.put("/hr/expense-requests/{request_id}/approve")
 async def approve_expense_request(request_id: str, current_user: dict = Depends(get_current_user)):
-    result = await db.hr_expense_requests.update_one(
-        {"id": request_id},
-        {"$set": {
-            "status": "approved",
-            "approved_by": current_user["full_name"],
-            "approved_at": datetime.now(timezone.utc).isoformat()
-        }}
-    )
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Expense request not found")
-    
-    request = await db.hr_expense_requests.find_one({"id": request_id}, {"_id": 0})
+    request = await transition_status("expense_request", request_id, "approve", current_user)
     
     await log_activity(
         user_id=current_user["id"],
@@ -3665,19 +5557,7 @@ async def approve_expense_request(request_id: str, current_user: dict = Depends(
 
 @api_router.put("/hr/expense-requests/{request_id}/reject")
 async def reject_expense_request(request_id: str, reason: str = "", current_user: dict = Depends(get_current_user)):
-    result = await db.hr_expense_requests.update_one(
-        {"id": request_id},
-        {"$set": {
-            "status": "rejected",
-            "approved_by": current_user["full_name"],
-            "approved_at": datetime.now(timezone.utc).isoformat(),
-            "rejection_reason": reason
-        }}
-    )
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Expense request not found")
-    
-    request = await db.hr_expense_requests.find_one({"id": request_id}, {"_id": 0})
+    request = await transition_status("expense_request", request_id, "reject", current_user, reason=reason)
     
     await log_activity(
         user_id=current_user["id"],
@@ -3738,8 +5618,11 @@ async def create_car_contract(contract_data: CarContractCreate, current_user: di
 
 @api_router.get("/hr/car-contracts")
 async def get_car_contracts(
+    response: Response,
     status: Optional[str] = None,
     employee_id: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -3748,7 +5631,7 @@ async def get_car_contracts(
     if employee_id:
         query["employee_id"] = employee_id
     
-    contracts = await db.hr_car_contracts.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    contracts = await paginate(response, db.hr_car_contracts, query, sort_field="created_at", page_size=page_size, cursor=cursor)
     return contracts
 
 @api_router.put("/hr/car-contracts/{contract_id}", response_model=CarContract)
@@ -3791,9 +5674,8 @@ async def delete_car_contract(contract_id: str, current_user: dict = Depends(get
 @api_router.post("/hr/official-letters", response_model=OfficialLetter)
 async def create_official_letter(letter_data: OfficialLetterCreate, current_user: dict = Depends(get_current_user)):
     # Generate letter number
-    count = await db.hr_official_letters.count_documents({})
     year = datetime.now().year
-    letter_number = f"LTR-{year}-{count + 1:04d}"
+    letter_number = f"LTR-{year}-{await next_sequence('LTR', year):04d}"
     
     letter = OfficialLetter(**letter_data.model_dump())
     letter_dict = letter.model_dump()
@@ -3815,9 +5697,12 @@ async def create_official_letter(letter_data: OfficialLetterCreate, current_user
 
 @api_router.get("/hr/official-letters")
 async def get_official_letters(
+    response: Response,
     status: Optional[str] = None,
     employee_id: Optional[str] = None,
     letter_type: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -3828,7 +5713,7 @@ async def get_official_letters(
     if letter_type:
         query["letter_type"] = letter_type
     
-    letters = await db.hr_official_letters.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    letters = await paginate(response, db.hr_official_letters, query, sort_field="created_at", page_size=page_size, cursor=cursor)
     return letters
 
 @api_router.put("/hr/official-letters/{letter_id}/issue")
@@ -3861,28 +5746,16 @@ async def issue_official_letter(letter_id: str, current_user: dict = Depends(get
 # Approve official letter (electronic signature by HR manager)
 @api_router.post("/hr/official-letters/{letter_id}/approve")
 async def approve_official_letter(letter_id: str, current_user: dict = Depends(require_role(["admin", "hr_manager"]))):
-    letter = await db.hr_official_letters.find_one({"id": letter_id}, {"_id": 0})
-    if not letter:
-        raise HTTPException(status_code=404, detail="Letter not found")
-    
-    if letter.get("is_approved"):
-        raise HTTPException(status_code=400, detail="Letter already approved")
-    
+    return await sign_official_letter(letter_id, current_user)
+
+async def sign_official_letter(letter_id: str, current_user: dict) -> dict:
     # Generate electronic signature code
-    import hashlib
     signature_data = f"{letter_id}-{current_user['id']}-{datetime.now().isoformat()}"
     signature_code = hashlib.sha256(signature_data.encode()).hexdigest()[:16].upper()
     
-    await db.hr_official_letters.update_one(
-        {"id": letter_id},
-        {"$set": {
-            "status": "approved",
-            "is_approved": True,
-            "approved_by": current_user["id"],
-            "approved_by_name": current_user.get("full_name", ""),
-            "approved_at": datetime.now(timezone.utc).isoformat(),
-            "signature_code": signature_code
-        }}
+    letter = await transition_status(
+        "official_letter", letter_id, "approve", current_user,
+        extra={"signature_code": signature_code}
     )
     
     await log_activity(
@@ -3900,20 +5773,7 @@ async def approve_official_letter(letter_id: str, current_user: dict = Depends(r
 # Reject official letter
 @api_router.post("/hr/official-letters/{letter_id}/reject")
 async def reject_official_letter(letter_id: str, reason: str = "", current_user: dict = Depends(require_role(["admin", "hr_manager"]))):
-    letter = await db.hr_official_letters.find_one({"id": letter_id}, {"_id": 0})
-    if not letter:
-        raise HTTPException(status_code=404, detail="Letter not found")
-    
-    await db.hr_official_letters.update_one(
-        {"id": letter_id},
-        {"$set": {
-            "status": "rejected",
-            "rejection_reason": reason,
-            "approved_by": current_user["id"],
-            "approved_by_name": current_user.get("full_name", ""),
-            "approved_at": datetime.now(timezone.utc).isoformat()
-        }}
-    )
+    letter = await transition_status("official_letter", letter_id, "reject", current_user, reason=reason)
     
     await log_activity(
         user_id=current_user["id"],
@@ -4110,6 +5970,7 @@ async def import_attendance(
             attendance = Attendance(**record.model_dump())
             await db.hr_attendance.insert_one(attendance.model_dump())
         imported += 1
+    await mark_payroll_dirty(*[record.employee_id for record in records], reason="attendance")
     
     return {"message": f"Imported {imported} attendance records"}
 
@@ -4154,6 +6015,7 @@ async def import_attendance_from_excel(
         imported = 0
         updated = 0
         errors = []
+        touched_employees = set()
         
         for idx, row in df.iterrows():
             try:
@@ -4167,6 +6029,7 @@ async def import_attendance_from_excel(
                         employee_id = employee['id']
                     else:
                         employee_id = employee_name  # Use name as fallback
+                touched_employees.add(str(employee_id))
                 
                 # Parse date
                 date_val = row.get('date')
@@ -4230,6 +6093,8 @@ async def import_attendance_from_excel(
             except Exception as e:
                 errors.append(f"خطأ في الصف {idx + 2}: {str(e)}")
         
+        await mark_payroll_dirty(*touched_employees, reason="attendance")
+        
         # Log activity
         await log_activity(
             user_id=current_user["id"],
@@ -4251,143 +6116,154 @@ async def import_attendance_from_excel(
         raise HTTPException(status_code=500, detail=f"خطأ في معالجة الملف: {str(e)}")
 
 # Import attendance from ZKTeco MDB file
+ZKTECO_BULK_BATCH_SIZE = 1000
+# How long mdb-export may take to exit once its output has ended
+MDB_EXPORT_EXIT_SECONDS = 10
+
+async def iter_mdb_table(path: str, table: str):
+    """Stream rows of an Access table as dicts using an async mdb-export subprocess"""
+    process = await asyncio.create_subprocess_exec(
+        'mdb-export', path, table,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    # Drain stderr alongside stdout; a chatty export would otherwise fill the pipe and stall
+    stderr_task = asyncio.create_task(process.stderr.read())
+    header = None
+    pending = ""
+    finished = False
+    try:
+        async for raw_line in process.stdout:
+            pending += raw_line.decode('utf-8', errors='replace')
+            # A quoted field may span lines; wait until the quotes are balanced
+            if pending.count('"') % 2:
+                continue
+            row = next(csv.reader([pending]), [])
+            pending = ""
+            if header is None:
+                header = row
+            elif row:
+                yield dict(zip(header, row))
+        finished = True
+    finally:
+        # At the end of its output the export is exiting by itself: give it time to
+        # report its status, and kill it only if it hangs or the caller stopped early
+        if finished:
+            try:
+                await asyncio.wait_for(process.wait(), MDB_EXPORT_EXIT_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+        if process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+        await process.wait()
+        stderr = (await stderr_task).decode('utf-8', errors='replace')
+    if process.returncode != 0:
+        raise RuntimeError(f"mdb-export {table} failed: {stderr.strip()}")
+
 @api_router.post("/hr/attendance/import-zkteco")
 async def import_attendance_from_zkteco(
     file: UploadFile = File(...),
     current_user: dict = Depends(require_role(["admin"]))
 ):
     """Import attendance records from ZKTeco MDB database file"""
-    import subprocess
-    import tempfile
-    import csv
-    from io import StringIO
-    
     if not file.filename.endswith('.mdb'):
         raise HTTPException(status_code=400, detail="يجب أن يكون الملف بصيغة MDB من جهاز ZKTeco")
     
+    started = time.perf_counter()
+    tmp_path = None
     try:
         # Save uploaded file temporarily
-        content = await file.read()
         with tempfile.NamedTemporaryFile(suffix='.mdb', delete=False) as tmp:
-            tmp.write(content)
             tmp_path = tmp.name
+            while chunk := await file.read(1024 * 1024):
+                tmp.write(chunk)
         
-        # Extract users from MDB
-        users_result = subprocess.run(
-            ['mdb-export', tmp_path, 'USERINFO'],
-            capture_output=True, text=True
-        )
-        
-        # Parse users into dictionary
+        # Parse device users into dictionary
         user_map = {}
-        if users_result.returncode == 0:
-            reader = csv.DictReader(StringIO(users_result.stdout))
-            for row in reader:
+        try:
+            async for row in iter_mdb_table(tmp_path, 'USERINFO'):
                 user_id = row.get('USERID', '')
-                name = row.get('Name', '') or row.get('Badgenumber', '')
-                badge = row.get('Badgenumber', '')
                 if user_id:
-                    user_map[user_id] = {'name': name, 'badge': badge}
+                    badge = row.get('Badgenumber', '')
+                    user_map[user_id] = {'name': row.get('Name', '') or badge, 'badge': badge}
+        except RuntimeError as e:
+            logging.warning(f"ZKTeco import without USERINFO: {e}")
         
-        # Extract attendance records from MDB
-        attendance_result = subprocess.run(
-            ['mdb-export', tmp_path, 'CHECKINOUT'],
-            capture_output=True, text=True
-        )
-        
-        if attendance_result.returncode != 0:
-            raise HTTPException(status_code=500, detail="فشل في قراءة ملف قاعدة البيانات")
-        
-        # Parse attendance records
-        reader = csv.DictReader(StringIO(attendance_result.stdout))
-        
-        # Group records by user and date
+        # Group punches by user and date
         attendance_by_day = {}
-        for row in reader:
-            user_id = row.get('USERID', '')
-            check_time_str = row.get('CHECKTIME', '')
-            
-            if not user_id or not check_time_str:
-                continue
-            
-            try:
-                # Parse datetime (format: "MM/DD/YY HH:MM:SS")
-                from datetime import datetime as dt
-                check_time = dt.strptime(check_time_str, "%m/%d/%y %H:%M:%S")
+        punches = 0
+        try:
+            async for row in iter_mdb_table(tmp_path, 'CHECKINOUT'):
+                user_id = row.get('USERID', '')
+                check_time_str = row.get('CHECKTIME', '')
+                if not user_id or not check_time_str:
+                    continue
+                try:
+                    # Parse datetime (format: "MM/DD/YY HH:MM:SS")
+                    check_time = datetime.strptime(check_time_str, "%m/%d/%y %H:%M:%S")
+                except ValueError:
+                    continue
+                punches += 1
                 date_str = check_time.strftime("%Y-%m-%d")
                 time_str = check_time.strftime("%H:%M")
                 
-                key = f"{user_id}_{date_str}"
-                if key not in attendance_by_day:
-                    user_info = user_map.get(user_id, {'name': f'User_{user_id}', 'badge': user_id})
-                    attendance_by_day[key] = {
-                        'user_id': user_id,
-                        'employee_name': user_info['name'],
-                        'employee_badge': user_info['badge'],
-                        'date': date_str,
-                        'times': []
-                    }
-                attendance_by_day[key]['times'].append(time_str)
-            except Exception as e:
-                continue
+                record = attendance_by_day.get((user_id, date_str))
+                if record is None:
+                    record = attendance_by_day[(user_id, date_str)] = {"first": time_str, "last": time_str, "count": 0}
+                record["first"] = min(record["first"], time_str)
+                record["last"] = max(record["last"], time_str)
+                record["count"] += 1
+        except RuntimeError as e:
+            logging.error(f"Error reading ZKTeco MDB: {e}")
+            raise HTTPException(status_code=500, detail="فشل في قراءة ملف قاعدة البيانات")
         
-        # Process and save attendance records
-        imported = 0
-        updated = 0
+        # Resolve device users to employees once, by fingerprint id, code or name
+        employees_by_badge = {}
+        employees_by_name = {}
+        async for employee in db.hr_employees.find({}, {"_id": 0, "id": 1, "name": 1, "employee_code": 1, "fingerprint_id": 1, "employee_id": 1}):
+            for badge_field in ("fingerprint_id", "employee_code", "employee_id"):
+                if employee.get(badge_field):
+                    employees_by_badge.setdefault(str(employee[badge_field]), employee)
+            if employee.get("name"):
+                employees_by_name.setdefault(employee["name"], employee)
         
-        for key, record in attendance_by_day.items():
-            times = sorted(record['times'])
-            check_in = times[0] if times else None
-            check_out = times[-1] if len(times) > 1 else None
+        # Upsert one row per (employee, date), keeping the earliest check-in and latest check-out
+        now = datetime.now(timezone.utc).isoformat()
+        operations = []
+        touched_employees = set()
+        for (user_id, date_str), record in attendance_by_day.items():
+            user_info = user_map.get(user_id, {'name': f'User_{user_id}', 'badge': user_id})
+            employee = employees_by_badge.get(user_info['badge']) or employees_by_name.get(user_info['name'])
+            employee_id = employee['id'] if employee else user_info['badge']
+            employee_name = employee['name'] if employee else user_info['name']
+            check_out = record["last"] if record["count"] > 1 else None
+            touched_employees.add(employee_id)
             
-            # Find employee by badge or name
-            employee = await db.hr_employees.find_one(
-                {"$or": [
-                    {"employee_id": record['employee_badge']},
-                    {"name": record['employee_name']}
-                ]},
-                {"_id": 0}
-            )
-            
-            employee_id = employee['id'] if employee else record['employee_badge']
-            employee_name = employee['name'] if employee else record['employee_name']
-            
-            # Check if record exists
-            existing = await db.hr_attendance.find_one({
-                "employee_id": employee_id,
-                "date": record['date']
-            })
-            
-            if existing:
-                # Update if new times are different
-                update_data = {"source": "zkteco_import"}
-                if check_in and (not existing.get('check_in') or check_in < existing.get('check_in', '23:59')):
-                    update_data["check_in"] = check_in
-                if check_out and (not existing.get('check_out') or check_out > existing.get('check_out', '00:00')):
-                    update_data["check_out"] = check_out
-                
-                if len(update_data) > 1:
-                    await db.hr_attendance.update_one(
-                        {"id": existing["id"]},
-                        {"$set": update_data}
-                    )
-                    updated += 1
-            else:
-                # Create new record
-                attendance = Attendance(
-                    employee_id=employee_id,
-                    employee_name=employee_name,
-                    date=record['date'],
-                    check_in=check_in,
-                    check_out=check_out,
-                    source="zkteco_import"
-                )
-                await db.hr_attendance.insert_one(attendance.model_dump())
-                imported += 1
+            operations.append(UpdateOne(
+                {"employee_id": employee_id, "date": date_str},
+                [{"$set": {
+                    "check_in": {"$min": ["$check_in", record["first"]]},
+                    "check_out": {"$max": ["$check_out", check_out]},
+                    "source": "zkteco_import",
+                    "id": {"$ifNull": ["$id", str(uuid.uuid4())]},
+                    "employee_name": {"$ifNull": ["$employee_name", employee_name]},
+                    "created_at": {"$ifNull": ["$created_at", now]}
+                }}],
+                upsert=True
+            ))
         
-        # Cleanup temp file
-        import os
-        os.unlink(tmp_path)
+        imported = 0
+        updated = 0
+        for i in range(0, len(operations), ZKTECO_BULK_BATCH_SIZE):
+            result = await db.hr_attendance.bulk_write(operations[i:i + ZKTECO_BULK_BATCH_SIZE], ordered=False)
+            imported += result.upserted_count
+            updated += result.modified_count
+        await mark_payroll_dirty(*touched_employees, reason="attendance")
+        
+        elapsed = time.perf_counter() - started
         
         # Log activity
         await log_activity(
@@ -4403,7 +6279,10 @@ async def import_attendance_from_zkteco(
             "imported": imported,
             "updated": updated,
             "total_users": len(user_map),
-            "total_days": len(attendance_by_day)
+            "total_days": len(attendance_by_day),
+            "total_punches": punches,
+            "elapsed_seconds": round(elapsed, 3),
+            "rows_per_second": round(punches / elapsed, 1) if elapsed > 0 else punches
         }
         
     except HTTPException:
@@ -4411,6 +6290,9 @@ async def import_attendance_from_zkteco(
     except Exception as e:
         logging.error(f"Error importing ZKTeco MDB: {e}")
         raise HTTPException(status_code=500, detail=f"خطأ في معالجة الملف: {str(e)}")
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
 
 # Export attendance to Excel
 @api_router.get("/hr/attendance/export/excel")
@@ -4421,9 +6303,6 @@ async def export_attendance_excel(
     current_user: dict = Depends(get_current_user)
 ):
     """Export attendance report to Excel"""
-    import pandas as pd
-    from openpyxl.styles import PatternFill, Font, Alignment
-    
     month_start = f"{year}-{month:02d}-01"
     if month == 12:
         month_end = f"{year + 1}-01-01"
@@ -4433,49 +6312,17 @@ async def export_attendance_excel(
     query = {"date": {"$gte": month_start, "$lt": month_end}}
     if employee_id:
         query["employee_id"] = employee_id
-    
-    attendance = await db.hr_attendance.find(query, {"_id": 0}).to_list(10000)
-    
-    if not attendance:
-        # Return empty template
-        df = pd.DataFrame(columns=['التاريخ', 'اسم الموظف', 'وقت الحضور', 'وقت الانصراف', 'المصدر'])
-    else:
-        df = pd.DataFrame(attendance)
-        columns_map = {
-            'date': 'التاريخ',
-            'employee_name': 'اسم الموظف',
-            'check_in': 'وقت الحضور',
-            'check_out': 'وقت الانصراف',
-            'source': 'المصدر'
-        }
-        available_cols = [col for col in columns_map.keys() if col in df.columns]
-        df = df[available_cols]
-        df = df.rename(columns={k: v for k, v in columns_map.items() if k in available_cols})
-    
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, sheet_name=f'الحضور {month}-{year}', index=False)
-        
-        worksheet = writer.sheets[f'الحضور {month}-{year}']
-        header_fill = PatternFill(start_color='4472C4', end_color='4472C4', fill_type='solid')
-        header_font = Font(bold=True, color='FFFFFF')
-        
-        for cell in worksheet[1]:
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal='center')
-        
-        for column in worksheet.columns:
-            max_length = max(len(str(cell.value or '')) for cell in column)
-            worksheet.column_dimensions[column[0].column_letter].width = max_length + 5
-    
-    output.seek(0)
-    
-    return StreamingResponse(
-        output,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": f"attachment; filename=attendance_{year}_{month}.xlsx"}
-    )
+    
+    # An empty month still returns a template with the column headers
+    columns_map = {
+        'date': 'التاريخ',
+        'employee_name': 'اسم الموظف',
+        'check_in': 'وقت الحضور',
+        'check_out': 'وقت الانصراف',
+        'source': 'المصدر'
+    }
+    cursor = db.hr_attendance.find(query, {"_id": 0})
+    return await stream_excel_export(cursor, columns_map, f'الحضور {month}-{year}', f"attendance_{year}_{month}.xlsx")
 
 # Export attendance to PDF
 @api_router.get("/hr/attendance/export/pdf")
@@ -4486,12 +6333,6 @@ async def export_attendance_pdf(
     current_user: dict = Depends(get_current_user)
 ):
     """Export attendance report to PDF"""
-    from reportlab.lib import colors
-    from reportlab.lib.pagesizes import A4, landscape
-    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-    from reportlab.lib.enums import TA_CENTER
-    
     month_start = f"{year}-{month:02d}-01"
     if month == 12:
         month_end = f"{year + 1}-01-01"
@@ -4504,54 +6345,10 @@ async def export_attendance_pdf(
     
     attendance = await db.hr_attendance.find(query, {"_id": 0}).sort("date", 1).to_list(10000)
     
-    output = io.BytesIO()
-    doc = SimpleDocTemplate(output, pagesize=landscape(A4), rightMargin=30, leftMargin=30, topMargin=30, bottomMargin=30)
-    
-    elements = []
-    styles = getSampleStyleSheet()
-    
-    # Title
-    title_style = ParagraphStyle('Title', parent=styles['Heading1'], alignment=TA_CENTER, fontSize=16)
-    elements.append(Paragraph(f"تقرير الحضور والانصراف - Attendance Report", title_style))
-    elements.append(Spacer(1, 10))
-    elements.append(Paragraph(f"الشهر: {month}/{year}", ParagraphStyle('Date', alignment=TA_CENTER)))
-    elements.append(Spacer(1, 20))
-    
-    # Table
-    headers = ['Date', 'Employee', 'Check In', 'Check Out', 'Source']
-    data = [headers]
-    
-    for record in attendance:
-        data.append([
-            record.get('date', ''),
-            record.get('employee_name', ''),
-            record.get('check_in', '-'),
-            record.get('check_out', '-'),
-            record.get('source', 'manual')
-        ])
-    
-    if len(data) == 1:
-        data.append(['', 'No attendance records', '', '', ''])
-    
-    table = Table(data, repeatRows=1)
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#4472C4')),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTSIZE', (0, 0), (-1, 0), 10),
-        ('FONTSIZE', (0, 1), (-1, -1), 9),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#F2F2F2')]),
-    ]))
-    
-    elements.append(table)
-    doc.build(elements)
-    
-    output.seek(0)
+    pdf_bytes = await render_pdf(pdf_renderer.render_attendance_report, attendance, year, month)
     
     return StreamingResponse(
-        output,
+        io.BytesIO(pdf_bytes),
         media_type="application/pdf",
         headers={"Content-Disposition": f"attachment; filename=attendance_{year}_{month}.pdf"}
     )
@@ -4593,9 +6390,12 @@ async def delete_shift(shift_id: str, current_user: dict = Depends(require_role(
 # Employee Shift Assignments
 @api_router.get("/hr/employee-shifts")
 async def get_employee_shifts(
+    response: Response,
     employee_id: Optional[str] = None,
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """Get employee shift assignments"""
@@ -4607,7 +6407,7 @@ async def get_employee_shifts(
     elif start_date:
         query["date"] = {"$gte": start_date}
     
-    shifts = await db.hr_employee_shifts.find(query, {"_id": 0}).to_list(1000)
+    shifts = await paginate(response, db.hr_employee_shifts, query, page_size=page_size, cursor=cursor)
     return shifts
 
 @api_router.post("/hr/employee-shifts", response_model=EmployeeShift)
@@ -4643,10 +6443,13 @@ async def delete_employee_shift(assignment_id: str, current_user: dict = Depends
 
 @api_router.get("/hr/overtime")
 async def get_overtime(
+    response: Response,
     employee_id: Optional[str] = None,
     status: Optional[str] = None,
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """Get overtime records"""
@@ -4658,7 +6461,7 @@ async def get_overtime(
     if start_date and end_date:
         query["date"] = {"$gte": start_date, "$lte": end_date}
     
-    overtime = await db.hr_overtime.find(query, {"_id": 0}).sort("date", -1).to_list(1000)
+    overtime = await paginate(response, db.hr_overtime, query, sort_field="date", page_size=page_size, cursor=cursor)
     return overtime
 
 @api_router.post("/hr/overtime", response_model=Overtime)
@@ -4674,6 +6477,7 @@ async def create_overtime(
     
     overtime = Overtime(**data)
     await db.hr_overtime.insert_one(overtime.model_dump())
+    await mark_payroll_dirty(overtime.employee_id, reason="overtime")
     
     await log_activity(
         user_id=current_user["id"],
@@ -4707,12 +6511,16 @@ async def approve_overtime(
     )
     
     overtime = await db.hr_overtime.find_one({"id": overtime_id}, {"_id": 0})
+    if overtime:
+        await mark_payroll_dirty(overtime.get("employee_id"), reason="overtime")
     return overtime
 
 @api_router.delete("/hr/overtime/{overtime_id}")
 async def delete_overtime(overtime_id: str, current_user: dict = Depends(require_role(["admin", "hr"]))):
     """Delete overtime record"""
-    await db.hr_overtime.delete_one({"id": overtime_id})
+    overtime = await db.hr_overtime.find_one_and_delete({"id": overtime_id}, {"_id": 0})
+    if overtime:
+        await mark_payroll_dirty(overtime.get("employee_id"), reason="overtime")
     return {"message": "تم حذف سجل العمل الإضافي"}
 
 # Get overtime summary for payroll
@@ -4746,9 +6554,12 @@ async def get_overtime_summary(
 
 @api_router.get("/hr/loans")
 async def get_loans(
+    response: Response,
     employee_id: Optional[str] = None,
     status: Optional[str] = None,
     loan_type: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """Get loans and advances"""
@@ -4760,7 +6571,7 @@ async def get_loans(
     if loan_type:
         query["loan_type"] = loan_type
     
-    loans = await db.hr_loans.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    loans = await paginate(response, db.hr_loans, query, sort_field="created_at", page_size=page_size, cursor=cursor)
     return loans
 
 @api_router.post("/hr/loans", response_model=Loan)
@@ -4778,6 +6589,7 @@ async def create_loan(
     
     loan = Loan(**data)
     await db.hr_loans.insert_one(loan.model_dump())
+    await mark_payroll_dirty(loan.employee_id, reason="loan")
     
     await log_activity(
         user_id=current_user["id"],
@@ -4797,22 +6609,11 @@ async def approve_loan(
     current_user: dict = Depends(require_role(["admin", "hr"]))
 ):
     """Approve or reject loan"""
-    update_data = {
-        "status": "approved" if approved else "rejected",
-        "approved_by": current_user["full_name"],
-        "approved_at": datetime.now(timezone.utc).isoformat()
-    }
-    if approved:
-        update_data["status"] = "active"  # Active means approved and deduction can start
-    if not approved and rejection_reason:
-        update_data["rejection_reason"] = rejection_reason
-    
-    await db.hr_loans.update_one(
-        {"id": loan_id},
-        {"$set": update_data}
+    loan = await transition_status(
+        "loan", loan_id, "approve" if approved else "reject", current_user,
+        reason=rejection_reason or None
     )
-    
-    loan = await db.hr_loans.find_one({"id": loan_id}, {"_id": 0})
+    await mark_payroll_dirty(loan.get("employee_id"), reason="loan")
     return loan
 
 @api_router.post("/hr/loans/{loan_id}/payment")
@@ -4821,9 +6622,13 @@ async def record_loan_payment(
     amount: float,
     payment_method: str = "salary_deduction",
     notes: Optional[str] = None,
-    current_user: dict = Depends(require_role(["admin", "hr"]))
+    current_user: dict = Depends(require_role(["admin", "hr"])),
+    idempotent: IdempotentRequest = Depends(idempotency)
 ):
     """Record a loan payment"""
+    if idempotent.replay is not None:
+        return idempotent.replay
+    
     loan = await db.hr_loans.find_one({"id": loan_id}, {"_id": 0})
     if not loan:
         raise HTTPException(status_code=404, detail="القرض غير موجود")
@@ -4856,8 +6661,9 @@ async def record_loan_payment(
         update_data["remaining_amount"] = 0
     
     await db.hr_loans.update_one({"id": loan_id}, {"$set": update_data})
+    await mark_payroll_dirty(loan["employee_id"], reason="loan")
     
-    return {"message": "تم تسجيل الدفعة بنجاح", "payment": payment.model_dump()}
+    return await idempotent.save({"message": "تم تسجيل الدفعة بنجاح", "payment": payment.model_dump()})
 
 @api_router.get("/hr/loans/{loan_id}/payments")
 async def get_loan_payments(loan_id: str, current_user: dict = Depends(get_current_user)):
@@ -4885,9 +6691,12 @@ async def get_employee_active_loans(employee_id: str, current_user: dict = Depen
 
 @api_router.get("/hr/documents")
 async def get_employee_documents(
+    response: Response,
     employee_id: Optional[str] = None,
     document_type: Optional[str] = None,
     expiring_soon: bool = False,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """Get employee documents"""
@@ -4897,7 +6706,7 @@ async def get_employee_documents(
     if document_type:
         query["document_type"] = document_type
     
-    documents = await db.hr_documents.find(query, {"_id": 0}).to_list(1000)
+    documents = await paginate(response, db.hr_documents, query, page_size=page_size, cursor=cursor)
     
     # Update expiry status
     today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
@@ -5150,20 +6959,101 @@ async def get_hr_dashboard(current_user: dict = Depends(get_current_user)):
 
 # ==================== REPORTS EXPORT (تصدير التقارير) ====================
 
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+EXCEL_SAMPLE_ROWS = 200
+EXCEL_MAX_COLUMN_WIDTH = 60
+# Rows handed to a worker thread per append; openpyxl serializes each row as it is appended
+EXCEL_APPEND_BATCH_ROWS = 500
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+def _field_value(doc: dict, field: str):
+    """Read a possibly dotted field (e.g. quality_test.fat_percentage) as a cell value"""
+    value = doc
+    for part in field.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    if isinstance(value, (dict, list)):
+        return str(value)
+    return value
+
+def _append_rows(worksheet, rows: list):
+    for row in rows:
+        worksheet.append(row)
+
+def _iter_file_chunks(path: str):
+    with open(path, "rb") as f:
+        while chunk := f.read(EXPORT_CHUNK_SIZE):
+            yield chunk
+
+def _remove_export_file(path: str):
+    """Runs after the response, whether the body was streamed fully, partly or not at all"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+async def stream_excel_export(cursor, columns_map: dict, sheet_name: str, filename: str,
+                              empty_detail: Optional[str] = None) -> StreamingResponse:
+    """Stream a cursor into a write-only workbook and send it in chunks.
+    
+    Columns present in the first rows are kept and sized from that sample;
+    rows are appended in batches on a worker thread, so memory stays flat for
+    large exports and the event loop is not held by the serialization.
+    """
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import PatternFill, Font, Alignment
+    from openpyxl.utils import get_column_letter
+    
+    sample = await cursor.to_list(EXCEL_SAMPLE_ROWS)
+    if not sample and empty_detail:
+        raise HTTPException(status_code=404, detail=empty_detail)
+    
+    fields = [f for f in columns_map if any(_field_value(doc, f) is not None for doc in sample)] or list(columns_map)
+    
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet(sheet_name)
+    for index, field in enumerate(fields, start=1):
+        longest = max([len(str(columns_map[field]))] + [len(str(_field_value(doc, field) or '')) for doc in sample])
+        worksheet.column_dimensions[get_column_letter(index)].width = min(longest + 5, EXCEL_MAX_COLUMN_WIDTH)
+    
+    header_fill = PatternFill(start_color='4472C4', end_color='4472C4', fill_type='solid')
+    header_font = Font(bold=True, color='FFFFFF')
+    header = []
+    for field in fields:
+        cell = WriteOnlyCell(worksheet, value=columns_map[field])
+        cell.fill = header_fill
+        cell.font = header_font
+        cell.alignment = Alignment(horizontal='center')
+        header.append(cell)
+    worksheet.append(header)
+    
+    batch = [[_field_value(doc, f) for f in fields] for doc in sample]
+    async for doc in cursor:
+        batch.append([_field_value(doc, f) for f in fields])
+        if len(batch) >= EXCEL_APPEND_BATCH_ROWS:
+            await asyncio.to_thread(_append_rows, worksheet, batch)
+            batch = []
+    if batch:
+        await asyncio.to_thread(_append_rows, worksheet, batch)
+    
+    with tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False) as tmp:
+        path = tmp.name
+    try:
+        await asyncio.to_thread(workbook.save, path)
+    except Exception:
+        os.unlink(path)
+        raise
+    
+    return StreamingResponse(
+        _iter_file_chunks(path),
+        media_type=XLSX_MEDIA_TYPE,
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+        background=BackgroundTask(_remove_export_file, path)
+    )
+
 @api_router.get("/reports/export/suppliers/excel")
 async def export_suppliers_excel(current_user: dict = Depends(get_current_user)):
     """Export suppliers report to Excel"""
-    import pandas as pd
-    from openpyxl import Workbook
-    from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
-    
-    suppliers = await db.suppliers.find({"is_active": True}, {"_id": 0}).to_list(1000)
-    
-    if not suppliers:
-        raise HTTPException(status_code=404, detail="No suppliers found")
-    
-    # Create DataFrame
-    df = pd.DataFrame(suppliers)
     columns_map = {
         'name': 'اسم المورد',
         'code': 'الكود',
@@ -5173,42 +7063,8 @@ async def export_suppliers_excel(current_user: dict = Depends(get_current_user))
         'total_supplied': 'إجمالي التوريد',
         'center_name': 'المركز'
     }
-    
-    # Select and rename columns
-    available_cols = [col for col in columns_map.keys() if col in df.columns]
-    df = df[available_cols]
-    df = df.rename(columns={k: v for k, v in columns_map.items() if k in available_cols})
-    
-    # Create Excel file
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, sheet_name='الموردين', index=False)
-        
-        # Style the worksheet
-        workbook = writer.book
-        worksheet = writer.sheets['الموردين']
-        
-        # Style header
-        header_fill = PatternFill(start_color='4472C4', end_color='4472C4', fill_type='solid')
-        header_font = Font(bold=True, color='FFFFFF')
-        
-        for cell in worksheet[1]:
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal='center')
-        
-        # Adjust column widths
-        for column in worksheet.columns:
-            max_length = max(len(str(cell.value or '')) for cell in column)
-            worksheet.column_dimensions[column[0].column_letter].width = max_length + 5
-    
-    output.seek(0)
-    
-    return StreamingResponse(
-        output,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": "attachment; filename=suppliers_report.xlsx"}
-    )
+    cursor = db.suppliers.find({"is_active": True}, {"_id": 0})
+    return await stream_excel_export(cursor, columns_map, 'الموردين', "suppliers_report.xlsx", "No suppliers found")
 
 @api_router.get("/reports/export/milk-receptions/excel")
 async def export_milk_receptions_excel(
@@ -5218,8 +7074,6 @@ async def export_milk_receptions_excel(
     current_user: dict = Depends(get_current_user)
 ):
     """Export milk receptions report to Excel"""
-    import pandas as pd
-    
     query = {}
     if start_date:
         query["reception_date"] = {"$gte": start_date}
@@ -5231,66 +7085,21 @@ async def export_milk_receptions_excel(
     if supplier_id:
         query["supplier_id"] = supplier_id
     
-    receptions = await db.milk_receptions.find(query, {"_id": 0}).sort("reception_date", -1).to_list(10000)
-    
-    if not receptions:
-        raise HTTPException(status_code=404, detail="No receptions found")
-    
-    df = pd.DataFrame(receptions)
     columns_map = {
         'reception_date': 'تاريخ الاستلام',
         'supplier_name': 'اسم المورد',
         'quantity_liters': 'الكمية (لتر)',
         'price_per_liter': 'سعر اللتر',
         'total_amount': 'المبلغ الإجمالي',
-        'fat_percentage': 'نسبة الدهون',
-        'protein_percentage': 'نسبة البروتين'
+        'quality_test.fat_percentage': 'نسبة الدهون',
+        'quality_test.protein_percentage': 'نسبة البروتين'
     }
-    
-    available_cols = [col for col in columns_map.keys() if col in df.columns]
-    df = df[available_cols]
-    df = df.rename(columns={k: v for k, v in columns_map.items() if k in available_cols})
-    
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, sheet_name='استلام الحليب', index=False)
-        
-        workbook = writer.book
-        worksheet = writer.sheets['استلام الحليب']
-        
-        from openpyxl.styles import PatternFill, Font, Alignment
-        header_fill = PatternFill(start_color='4472C4', end_color='4472C4', fill_type='solid')
-        header_font = Font(bold=True, color='FFFFFF')
-        
-        for cell in worksheet[1]:
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal='center')
-        
-        for column in worksheet.columns:
-            max_length = max(len(str(cell.value or '')) for cell in column)
-            worksheet.column_dimensions[column[0].column_letter].width = max_length + 5
-    
-    output.seek(0)
-    
-    return StreamingResponse(
-        output,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": "attachment; filename=milk_receptions_report.xlsx"}
-    )
+    cursor = db.milk_receptions.find(query, {"_id": 0}).sort("reception_date", -1)
+    return await stream_excel_export(cursor, columns_map, 'استلام الحليب', "milk_receptions_report.xlsx", "No receptions found")
 
 @api_router.get("/reports/export/hr/employees/excel")
 async def export_employees_excel(current_user: dict = Depends(get_current_user)):
     """Export HR employees report to Excel"""
-    import pandas as pd
-    from openpyxl.styles import PatternFill, Font, Alignment
-    
-    employees = await db.hr_employees.find({"is_active": True}, {"_id": 0}).to_list(1000)
-    
-    if not employees:
-        raise HTTPException(status_code=404, detail="No employees found")
-    
-    df = pd.DataFrame(employees)
     columns_map = {
         'employee_code': 'كود الموظف',
         'name': 'اسم الموظف',
@@ -5301,35 +7110,8 @@ async def export_employees_excel(current_user: dict = Depends(get_current_user))
         'salary': 'الراتب',
         'hire_date': 'تاريخ التعيين'
     }
-    
-    available_cols = [col for col in columns_map.keys() if col in df.columns]
-    df = df[available_cols]
-    df = df.rename(columns={k: v for k, v in columns_map.items() if k in available_cols})
-    
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, sheet_name='الموظفين', index=False)
-        
-        worksheet = writer.sheets['الموظفين']
-        header_fill = PatternFill(start_color='4472C4', end_color='4472C4', fill_type='solid')
-        header_font = Font(bold=True, color='FFFFFF')
-        
-        for cell in worksheet[1]:
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal='center')
-        
-        for column in worksheet.columns:
-            max_length = max(len(str(cell.value or '')) for cell in column)
-            worksheet.column_dimensions[column[0].column_letter].width = max_length + 5
-    
-    output.seek(0)
-    
-    return StreamingResponse(
-        output,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": "attachment; filename=employees_report.xlsx"}
-    )
+    cursor = db.hr_employees.find({"is_active": True}, {"_id": 0})
+    return await stream_excel_export(cursor, columns_map, 'الموظفين', "employees_report.xlsx", "No employees found")
 
 @api_router.get("/reports/export/finance/excel")
 async def export_finance_excel(
@@ -5338,9 +7120,6 @@ async def export_finance_excel(
     current_user: dict = Depends(get_current_user)
 ):
     """Export finance report to Excel"""
-    import pandas as pd
-    from openpyxl.styles import PatternFill, Font, Alignment
-    
     query = {}
     if start_date:
         query["payment_date"] = {"$gte": start_date}
@@ -5350,12 +7129,6 @@ async def export_finance_excel(
         else:
             query["payment_date"] = {"$lte": end_date}
     
-    payments = await db.payments.find(query, {"_id": 0}).sort("payment_date", -1).to_list(10000)
-    
-    if not payments:
-        raise HTTPException(status_code=404, detail="No payments found")
-    
-    df = pd.DataFrame(payments)
     columns_map = {
         'payment_date': 'تاريخ الدفع',
         'payment_type': 'نوع الدفع',
@@ -5365,105 +7138,21 @@ async def export_finance_excel(
         'bank_account': 'الحساب البنكي',
         'notes': 'ملاحظات'
     }
-    
-    available_cols = [col for col in columns_map.keys() if col in df.columns]
-    df = df[available_cols]
-    df = df.rename(columns={k: v for k, v in columns_map.items() if k in available_cols})
-    
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, sheet_name='المدفوعات', index=False)
-        
-        worksheet = writer.sheets['المدفوعات']
-        header_fill = PatternFill(start_color='4472C4', end_color='4472C4', fill_type='solid')
-        header_font = Font(bold=True, color='FFFFFF')
-        
-        for cell in worksheet[1]:
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal='center')
-        
-        for column in worksheet.columns:
-            max_length = max(len(str(cell.value or '')) for cell in column)
-            worksheet.column_dimensions[column[0].column_letter].width = max_length + 5
-    
-    output.seek(0)
-    
-    return StreamingResponse(
-        output,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": "attachment; filename=finance_report.xlsx"}
-    )
+    cursor = db.payments.find(query, {"_id": 0}).sort("payment_date", -1)
+    return await stream_excel_export(cursor, columns_map, 'المدفوعات', "finance_report.xlsx", "No payments found")
 
 @api_router.get("/reports/export/suppliers/pdf")
 async def export_suppliers_pdf(current_user: dict = Depends(get_current_user)):
     """Export suppliers report to PDF"""
-    from reportlab.lib import colors
-    from reportlab.lib.pagesizes import A4, landscape
-    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-    from reportlab.pdfbase import pdfmetrics
-    from reportlab.pdfbase.ttfonts import TTFont
-    from reportlab.lib.enums import TA_RIGHT, TA_CENTER
-    
     suppliers = await db.suppliers.find({"is_active": True}, {"_id": 0}).to_list(1000)
     
     if not suppliers:
         raise HTTPException(status_code=404, detail="No suppliers found")
     
-    output = io.BytesIO()
-    doc = SimpleDocTemplate(output, pagesize=landscape(A4), rightMargin=30, leftMargin=30, topMargin=30, bottomMargin=30)
-    
-    elements = []
-    styles = getSampleStyleSheet()
-    
-    # Title
-    title_style = ParagraphStyle('Title', parent=styles['Heading1'], alignment=TA_CENTER, fontSize=18)
-    elements.append(Paragraph("تقرير الموردين - Suppliers Report", title_style))
-    elements.append(Spacer(1, 20))
-    
-    # Date
-    date_style = ParagraphStyle('Date', parent=styles['Normal'], alignment=TA_CENTER, fontSize=10)
-    elements.append(Paragraph(f"التاريخ: {datetime.now().strftime('%Y-%m-%d')}", date_style))
-    elements.append(Spacer(1, 20))
-    
-    # Table data
-    headers = ['Code', 'Name', 'Phone', 'Bank Account', 'Balance', 'Total Supplied', 'Center']
-    data = [headers]
-    
-    for s in suppliers:
-        row = [
-            s.get('code', ''),
-            s.get('name', ''),
-            s.get('phone', ''),
-            s.get('bank_account', ''),
-            f"{s.get('balance', 0):.3f}",
-            f"{s.get('total_supplied', 0):.2f}",
-            s.get('center_name', '')
-        ]
-        data.append(row)
-    
-    # Create table
-    table = Table(data, repeatRows=1)
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#4472C4')),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTSIZE', (0, 0), (-1, 0), 10),
-        ('FONTSIZE', (0, 1), (-1, -1), 9),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.HexColor('#E9ECF1')),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#F2F2F2')]),
-    ]))
-    
-    elements.append(table)
-    doc.build(elements)
-    
-    output.seek(0)
+    pdf_bytes = await render_pdf(pdf_renderer.render_suppliers_report, suppliers, datetime.now().strftime('%Y-%m-%d'))
     
     return StreamingResponse(
-        output,
+        io.BytesIO(pdf_bytes),
         media_type="application/pdf",
         headers={"Content-Disposition": "attachment; filename=suppliers_report.pdf"}
     )
@@ -5474,97 +7163,262 @@ async def export_daily_report_pdf(
     current_user: dict = Depends(get_current_user)
 ):
     """Export daily report to PDF"""
-    from reportlab.lib import colors
-    from reportlab.lib.pagesizes import A4
-    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-    from reportlab.lib.enums import TA_CENTER
-    
     # Get daily data
-    receptions = await db.milk_receptions.find({"reception_date": date}, {"_id": 0}).to_list(1000)
-    sales = await db.sales.find({"sale_date": date}, {"_id": 0}).to_list(1000)
-    
-    output = io.BytesIO()
-    doc = SimpleDocTemplate(output, pagesize=A4, rightMargin=30, leftMargin=30, topMargin=30, bottomMargin=30)
-    
-    elements = []
-    styles = getSampleStyleSheet()
-    
-    # Title
-    title_style = ParagraphStyle('Title', parent=styles['Heading1'], alignment=TA_CENTER, fontSize=16)
-    elements.append(Paragraph(f"التقرير اليومي - Daily Report", title_style))
-    elements.append(Spacer(1, 10))
-    elements.append(Paragraph(f"التاريخ: {date}", ParagraphStyle('Date', alignment=TA_CENTER)))
-    elements.append(Spacer(1, 20))
-    
-    # Summary
-    total_milk = sum(r.get('quantity_liters', 0) for r in receptions)
-    total_sales = sum(s.get('total_amount', 0) for s in sales)
-    
-    summary_data = [
-        ['الوصف', 'القيمة'],
-        ['إجمالي الحليب المستلم (لتر)', f'{total_milk:.2f}'],
-        ['عدد عمليات الاستلام', str(len(receptions))],
-        ['إجمالي المبيعات (ر.ع)', f'{total_sales:.3f}'],
-        ['عدد عمليات البيع', str(len(sales))],
-    ]
+    day_start, day_end = local_day_bounds(date)
+    receptions = await db.milk_receptions.find({"reception_date": {"$gte": day_start, "$lt": day_end}}, {"_id": 0}).to_list(1000)
+    sales = await db.sales.find({"sale_date": {"$gte": day_start, "$lt": day_end}}, {"_id": 0}).to_list(1000)
     
-    summary_table = Table(summary_data, colWidths=[200, 150])
-    summary_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#4472C4')),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [colors.white, colors.HexColor('#F2F2F2')]),
-    ]))
-    
-    elements.append(summary_table)
-    elements.append(Spacer(1, 30))
-    
-    # Receptions detail
-    if receptions:
-        elements.append(Paragraph("تفاصيل استلام الحليب - Milk Receptions", styles['Heading2']))
-        elements.append(Spacer(1, 10))
-        
-        rec_headers = ['Supplier', 'Quantity (L)', 'Price/L', 'Total', 'Fat %']
-        rec_data = [rec_headers]
-        for r in receptions:
-            rec_data.append([
-                r.get('supplier_name', ''),
-                f"{r.get('quantity_liters', 0):.2f}",
-                f"{r.get('price_per_liter', 0):.3f}",
-                f"{r.get('total_amount', 0):.3f}",
-                f"{r.get('fat_percentage', 0):.1f}"
-            ])
-        
-        rec_table = Table(rec_data, repeatRows=1)
-        rec_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#70AD47')),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTSIZE', (0, 0), (-1, -1), 9),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ]))
-        elements.append(rec_table)
-    
-    doc.build(elements)
-    output.seek(0)
+    pdf_bytes = await render_pdf(pdf_renderer.render_daily_report, date, receptions, sales)
     
     return StreamingResponse(
-        output,
+        io.BytesIO(pdf_bytes),
         media_type="application/pdf",
         headers={"Content-Disposition": f"attachment; filename=daily_report_{date}.pdf"}
     )
 
+# ==================== DELTA SYNC (المزامنة التفاضلية) ====================
+# Catalog collections carry an `updated_at` stamp maintained by every write route
+# (soft deletes included, via is_active). Centers pull only what changed since
+# their last token instead of re-downloading the full lists each session.
+SYNC_COLLECTIONS = {
+    # name in the API: collection
+    "suppliers": "suppliers",
+    "customers": "customers",
+    "feed_types": "feed_types",
+    "centers": "collection_centers",
+    "employees": "hr_employees",
+}
+SYNC_PAGE_SIZE = int(os.environ.get('SYNC_PAGE_SIZE', 500))
+# Writes stamp updated_at just before they commit; changes younger than this are
+# held back to the next pull so a slow in-flight write cannot slip behind a token
+SYNC_SETTLE_SECONDS = float(os.environ.get('SYNC_SETTLE_SECONDS', 2))
+
+def touch(update: dict) -> dict:
+    """Add the updated_at stamp to a MongoDB update document"""
+    return {**update, "$set": {**update.get("$set", {}), "updated_at": datetime.now(timezone.utc).isoformat()}}
+
+def encode_sync_token(positions: dict) -> str:
+    raw = json.dumps(positions).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_sync_token(token: str) -> dict:
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        positions = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(positions, dict) or any(
+            not isinstance(position, list) or len(position) != 2 for position in positions.values()
+        ):
+            raise ValueError(token)
+        return positions
+    except Exception:
+        raise HTTPException(status_code=400, detail="رمز المزامنة غير صالح")
+
+async def backfill_updated_at():
+    """Give catalog documents written before delta sync an updated_at (their created_at)"""
+    for collection_name in SYNC_COLLECTIONS.values():
+        await db[collection_name].update_many(
+            {"updated_at": {"$exists": False}},
+            [{"$set": {"updated_at": {"$ifNull": ["$created_at", "1970-01-01T00:00:00+00:00"]}}}]
+        )
+
+@api_router.get("/sync/changes")
+async def get_sync_changes(
+    since: Optional[str] = None,
+    collections: Optional[str] = None,
+    limit: int = SYNC_PAGE_SIZE,
+    current_user: dict = Depends(get_current_user)
+):
+    """Documents created, updated or deactivated since the token, oldest change first.
+
+    Without `since` this is a full download. Keep calling with the returned token
+    while `has_more` is true.
+    """
+    names = [name.strip() for name in collections.split(",")] if collections else list(SYNC_COLLECTIONS)
+    unknown = [name for name in names if name not in SYNC_COLLECTIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"مجموعات غير معروفة: {', '.join(unknown)}")
+    limit = clamp_page_size(limit)
+    positions = decode_sync_token(since) if since else {}
+    settled = (datetime.now(timezone.utc) - timedelta(seconds=SYNC_SETTLE_SECONDS)).isoformat()
+    
+    async def pull(name: str) -> list:
+        query = {"updated_at": {"$lt": settled}}
+        position = positions.get(name)
+        if position:
+            query = {"$and": [query, _after_cursor("updated_at", 1, position[0], position[1])]}
+        return await db[SYNC_COLLECTIONS[name]].find(query, {"_id": 0}).sort(
+            [("updated_at", 1), ("id", 1)]
+        ).limit(limit + 1).to_list(limit + 1)
+    
+    pages = await asyncio.gather(*(pull(name) for name in names))
+    
+    changes = {}
+    has_more = False
+    for name, docs in zip(names, pages):
+        if len(docs) > limit:
+            docs = docs[:limit]
+            has_more = True
+        if docs:
+            positions[name] = [docs[-1]["updated_at"], docs[-1]["id"]]
+        changes[name] = docs
+    
+    return {
+        "changes": changes,
+        "token": encode_sync_token(positions),
+        "has_more": has_more,
+        "server_time": settled
+    }
+
+# ==================== DATA EXPORT (تصدير البيانات) ====================
+
+# Bulk extracts for accounting and BI: each source maps to a collection, the
+# date field its list route filters on, and the extra equality filters it accepts.
+def model_columns(model, prefix: str = "") -> list:
+    """Flattened CSV columns of a model, nested models as dotted names (matches _flatten)"""
+    columns = []
+    for name, field in model.model_fields.items():
+        annotation = field.annotation
+        if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+            columns.extend(model_columns(annotation, f"{prefix}{name}."))
+        else:
+            columns.append(f"{prefix}{name}")
+    return columns
+
+# CSV columns are fixed per source so fields missing from early (older) rows are not dropped
+EXPORT_SOURCES = {
+    "milk-receptions": {"collection": "milk_receptions", "date_field": "reception_date", "filters": ["supplier_id"], "columns": model_columns(MilkReception)},
+    "sales": {"collection": "sales", "date_field": "sale_date", "filters": ["customer_id"], "columns": model_columns(Sale)},
+    "payments": {"collection": "payments", "date_field": "payment_date", "filters": ["payment_type", "status"], "columns": model_columns(Payment)},
+    "attendance": {"collection": "hr_attendance", "date_field": "date", "filters": ["employee_id"], "columns": model_columns(Attendance)},
+    "treasury-transactions": {"collection": "treasury_transactions", "date_field": "created_at", "filters": ["transaction_type"], "columns": model_columns(TreasuryTransaction)},
+    # Activity logs past the retention window live in monthly archives; read across all of them
+    "activity-logs": {"collection": "activity_logs", "date_field": "timestamp", "filters": ["user_id", "action"], "columns": model_columns(ActivityLog),
+                      "partitions": activity_log_partitions, "projection": {"_id": 0, "logged_at": 0}},
+}
+EXPORT_BATCH_SIZE = 1000
+
+def _flatten(doc: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in doc.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{name}."))
+        elif isinstance(value, list):
+            flat[name] = json.dumps(value, ensure_ascii=False, default=str)
+        else:
+            flat[name] = value
+    return flat
+
+async def _export_rows(cursor, fmt: str, columns: List[str]):
+    """Yield encoded CSV or NDJSON text from a cursor, roughly EXPORT_CHUNK_SIZE at a time"""
+    buffer = io.StringIO()
+    writer = None
+    if fmt == "csv":
+        writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+    async for doc in cursor:
+        if fmt == "ndjson":
+            buffer.write(json.dumps(doc, ensure_ascii=False, default=str))
+            buffer.write("\n")
+        else:
+            writer.writerow(_flatten(doc))
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+async def _export_cursor(spec: dict, query: dict, start_date: Optional[str], end_date: Optional[str]):
+    """Documents of one export source in (date, id) order, across its partitions if it has any"""
+    date_field = spec["date_field"]
+    projection = spec.get("projection", {"_id": 0})
+    if "partitions" not in spec:
+        cursor = db[spec["collection"]].find(query, projection).sort([(date_field, 1), ("id", 1)]).batch_size(EXPORT_BATCH_SIZE)
+        async for doc in cursor:
+            yield doc
+        return
+    # Partitions come newest first and do not overlap, so oldest first keeps the order
+    for collection, bounds in reversed(await spec["partitions"](start_date, end_date)):
+        partition_query = {"$and": [query, {date_field: bounds}]} if query else {date_field: bounds}
+        cursor = collection.find(partition_query, projection).sort([(date_field, 1), ("id", 1)]).batch_size(EXPORT_BATCH_SIZE)
+        async for doc in cursor:
+            yield doc
+
+async def _gzip_stream(chunks):
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+@api_router.get("/export/{source}.{fmt}")
+async def export_collection(
+    source: str,
+    fmt: str,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    supplier_id: Optional[str] = None,
+    customer_id: Optional[str] = None,
+    payment_type: Optional[str] = None,
+    status: Optional[str] = None,
+    employee_id: Optional[str] = None,
+    transaction_type: Optional[str] = None,
+    user_id: Optional[str] = None,
+    action: Optional[str] = None,
+    gzip: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    """Stream a full extract of a collection as CSV or NDJSON (optionally gzip-compressed)"""
+    spec = EXPORT_SOURCES.get(source)
+    if not spec:
+        raise HTTPException(status_code=404, detail=f"مصدر التصدير غير معروف: {source}")
+    if fmt not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="صيغة التصدير يجب أن تكون csv أو ndjson")
+    
+    date_field = spec["date_field"]
+    query = {}
+    if start_date:
+        query[date_field] = {"$gte": start_date}
+    if end_date:
+        query.setdefault(date_field, {})["$lte"] = end_date
+    filter_values = {
+        "supplier_id": supplier_id,
+        "customer_id": customer_id,
+        "payment_type": payment_type,
+        "status": status,
+        "employee_id": employee_id,
+        "transaction_type": transaction_type,
+        "user_id": user_id,
+        "action": action
+    }
+    for field in spec["filters"]:
+        if filter_values[field]:
+            query[field] = filter_values[field]
+    
+    body = _export_rows(_export_cursor(spec, query, start_date, end_date), fmt, spec["columns"])
+    filename = f"{source}.{fmt}"
+    media_type = "text/csv; charset=utf-8" if fmt == "csv" else "application/x-ndjson"
+    if gzip:
+        body = _gzip_stream(body)
+        filename += ".gz"
+        media_type = "application/gzip"
+    
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
 # ==================== LEGAL MODULE ROUTES (قسم القانون) ====================
 
 # Legal Contracts (العقود القانونية)
 @api_router.post("/legal/contracts", response_model=LegalContract)
 async def create_legal_contract(contract_data: LegalContractCreate, current_user: dict = Depends(get_current_user)):
     # Generate contract number
-    count = await db.legal_contracts.count_documents({})
     year = datetime.now().year
-    contract_number = f"CTR-{year}-{count + 1:04d}"
+    contract_number = f"CTR-{year}-{await next_sequence('CTR', year):04d}"
     
     contract = LegalContract(**contract_data.model_dump())
     contract_dict = contract.model_dump()
@@ -5587,8 +7441,11 @@ async def create_legal_contract(contract_data: LegalContractCreate, current_user
 
 @api_router.get("/legal/contracts")
 async def get_legal_contracts(
+    response: Response,
     status: Optional[str] = None,
     contract_type: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -5597,7 +7454,7 @@ async def get_legal_contracts(
     if contract_type:
         query["contract_type"] = contract_type
     
-    contracts = await db.legal_contracts.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    contracts = await paginate(response, db.legal_contracts, query, sort_field="created_at", page_size=page_size, cursor=cursor)
     return contracts
 
 @api_router.get("/legal/contracts/{contract_id}")
@@ -5656,9 +7513,8 @@ async def delete_legal_contract(contract_id: str, current_user: dict = Depends(g
 # Legal Cases (القضايا القانونية)
 @api_router.post("/legal/cases", response_model=LegalCase)
 async def create_legal_case(case_data: LegalCaseCreate, current_user: dict = Depends(get_current_user)):
-    count = await db.legal_cases.count_documents({})
     year = datetime.now().year
-    case_number = f"CASE-{year}-{count + 1:04d}"
+    case_number = f"CASE-{year}-{await next_sequence('CASE', year):04d}"
     
     case = LegalCase(**case_data.model_dump())
     case_dict = case.model_dump()
@@ -5681,9 +7537,12 @@ async def create_legal_case(case_data: LegalCaseCreate, current_user: dict = Dep
 
 @api_router.get("/legal/cases")
 async def get_legal_cases(
+    response: Response,
     status: Optional[str] = None,
     case_type: Optional[str] = None,
     priority: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -5694,7 +7553,7 @@ async def get_legal_cases(
     if priority:
         query["priority"] = priority
     
-    cases = await db.legal_cases.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    cases = await paginate(response, db.legal_cases, query, sort_field="created_at", page_size=page_size, cursor=cursor)
     return cases
 
 @api_router.put("/legal/cases/{case_id}", response_model=LegalCase)
@@ -5768,14 +7627,17 @@ async def create_legal_consultation(consultation_data: LegalConsultationCreate,
 
 @api_router.get("/legal/consultations")
 async def get_legal_consultations(
+    response: Response,
     status: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
     if status:
         query["status"] = status
     
-    consultations = await db.legal_consultations.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    consultations = await paginate(response, db.legal_consultations, query, sort_field="created_at", page_size=page_size, cursor=cursor)
     return consultations
 
 @api_router.put("/legal/consultations/{consultation_id}/respond")
@@ -5818,8 +7680,11 @@ async def create_legal_document(document_data: LegalDocumentCreate, current_user
 
 @api_router.get("/legal/documents")
 async def get_legal_documents(
+    response: Response,
     document_type: Optional[str] = None,
     status: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -5828,7 +7693,7 @@ async def get_legal_documents(
     if status:
         query["status"] = status
     
-    documents = await db.legal_documents.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    documents = await paginate(response, db.legal_documents, query, sort_field="created_at", page_size=page_size, cursor=cursor)
     return documents
 
 # Legal Dashboard Stats
@@ -5854,9 +7719,8 @@ async def get_legal_dashboard(current_user: dict = Depends(get_current_user)):
 # Projects
 @api_router.post("/projects", response_model=Project)
 async def create_project(project_data: ProjectCreate, current_user: dict = Depends(get_current_user)):
-    count = await db.projects.count_documents({})
     year = datetime.now().year
-    project_code = f"PRJ-{year}-{count + 1:04d}"
+    project_code = f"PRJ-{year}-{await next_sequence('PRJ', year):04d}"
     
     project = Project(**project_data.model_dump())
     project_dict = project.model_dump()
@@ -5879,9 +7743,12 @@ async def create_project(project_data: ProjectCreate, current_user: dict = Depen
 
 @api_router.get("/projects")
 async def get_projects(
+    response: Response,
     status: Optional[str] = None,
     project_type: Optional[str] = None,
     manager_id: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -5892,7 +7759,7 @@ async def get_projects(
     if manager_id:
         query["manager_id"] = manager_id
     
-    projects = await db.projects.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    projects = await paginate(response, db.projects, query, sort_field="created_at", page_size=page_size, cursor=cursor)
     return projects
 
 @api_router.get("/projects/{project_id}")
@@ -5971,12 +7838,12 @@ async def create_project_task(task_data: ProjectTaskCreate, current_user: dict =
     return task
 
 @api_router.get("/projects/{project_id}/tasks")
-async def get_project_tasks(project_id: str, status: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+async def get_project_tasks(response: Response, project_id: str, status: Optional[str] = None, page_size: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, current_user: dict = Depends(get_current_user)):
     query = {"project_id": project_id}
     if status:
         query["status"] = status
     
-    tasks = await db.project_tasks.find(query, {"_id": 0}).sort("due_date", 1).to_list(1000)
+    tasks = await paginate(response, db.project_tasks, query, sort_field="due_date", direction=1, page_size=page_size, cursor=cursor)
     return tasks
 
 @api_router.put("/projects/tasks/{task_id}", response_model=ProjectTask)
@@ -6130,9 +7997,12 @@ async def create_daily_operation(operation_data: DailyOperationCreate, current_u
 
 @api_router.get("/operations/daily")
 async def get_daily_operations(
+    response: Response,
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
     center_id: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -6146,7 +8016,7 @@ async def get_daily_operations(
     if center_id:
         query["center_id"] = center_id
     
-    operations = await db.daily_operations.find(query, {"_id": 0}).sort("operation_date", -1).to_list(1000)
+    operations = await paginate(response, db.daily_operations, query, sort_field="operation_date", page_size=page_size, cursor=cursor)
     return operations
 
 @api_router.put("/operations/daily/{operation_id}", response_model=DailyOperation)
@@ -6164,8 +8034,7 @@ async def update_daily_operation(operation_id: str, operation_data: DailyOperati
 # Equipment
 @api_router.post("/operations/equipment", response_model=Equipment)
 async def create_equipment(equipment_data: EquipmentCreate, current_user: dict = Depends(get_current_user)):
-    count = await db.equipment.count_documents({})
-    equipment_code = f"EQP-{count + 1:04d}"
+    equipment_code = f"EQP-{await next_sequence('EQP'):04d}"
     
     equipment = Equipment(**equipment_data.model_dump())
     equipment_dict = equipment.model_dump()
@@ -6187,9 +8056,12 @@ async def create_equipment(equipment_data: EquipmentCreate, current_user: dict =
 
 @api_router.get("/operations/equipment")
 async def get_equipment(
+    response: Response,
     equipment_type: Optional[str] = None,
     status: Optional[str] = None,
     center_id: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -6200,7 +8072,7 @@ async def get_equipment(
     if center_id:
         query["center_id"] = center_id
     
-    equipment = await db.equipment.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    equipment = await paginate(response, db.equipment, query, sort_field="created_at", page_size=page_size, cursor=cursor)
     return equipment
 
 @api_router.put("/operations/equipment/{equipment_id}", response_model=Equipment)
@@ -6270,8 +8142,11 @@ async def create_maintenance_record(maintenance_data: MaintenanceRecordCreate, c
 
 @api_router.get("/operations/maintenance")
 async def get_maintenance_records(
+    response: Response,
     equipment_id: Optional[str] = None,
     maintenance_type: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -6280,15 +8155,14 @@ async def get_maintenance_records(
     if maintenance_type:
         query["maintenance_type"] = maintenance_type
     
-    records = await db.maintenance_records.find(query, {"_id": 0}).sort("maintenance_date", -1).to_list(1000)
+    records = await paginate(response, db.maintenance_records, query, sort_field="maintenance_date", page_size=page_size, cursor=cursor)
     return records
 
 # Incident Reports
 @api_router.post("/operations/incidents", response_model=IncidentReport)
 async def create_incident_report(incident_data: IncidentReportCreate, current_user: dict = Depends(get_current_user)):
-    count = await db.incident_reports.count_documents({})
     year = datetime.now().year
-    incident_number = f"INC-{year}-{count + 1:04d}"
+    incident_number = f"INC-{year}-{await next_sequence('INC', year):04d}"
     
     incident = IncidentReport(**incident_data.model_dump())
     incident_dict = incident.model_dump()
@@ -6310,10 +8184,13 @@ async def create_incident_report(incident_data: IncidentReportCreate, current_us
 
 @api_router.get("/operations/incidents")
 async def get_incident_reports(
+    response: Response,
     incident_type: Optional[str] = None,
     status: Optional[str] = None,
     severity: Optional[str] = None,
     center_id: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -6326,7 +8203,7 @@ async def get_incident_reports(
     if center_id:
         query["center_id"] = center_id
     
-    incidents = await db.incident_reports.find(query, {"_id": 0}).sort("incident_date", -1).to_list(1000)
+    incidents = await paginate(response, db.incident_reports, query, sort_field="incident_date", page_size=page_size, cursor=cursor)
     return incidents
 
 @api_router.put("/operations/incidents/{incident_id}/resolve")
@@ -6360,8 +8237,7 @@ async def resolve_incident(incident_id: str, resolution_notes: str, current_user
 # Vehicle Fleet
 @api_router.post("/operations/vehicles", response_model=Vehicle)
 async def create_vehicle(vehicle_data: VehicleCreate, current_user: dict = Depends(get_current_user)):
-    count = await db.vehicles.count_documents({})
-    vehicle_code = f"VEH-{count + 1:04d}"
+    vehicle_code = f"VEH-{await next_sequence('VEH'):04d}"
     
     vehicle = Vehicle(**vehicle_data.model_dump())
     vehicle_dict = vehicle.model_dump()
@@ -6383,9 +8259,12 @@ async def create_vehicle(vehicle_data: VehicleCreate, current_user: dict = Depen
 
 @api_router.get("/operations/vehicles")
 async def get_vehicles(
+    response: Response,
     vehicle_type: Optional[str] = None,
     status: Optional[str] = None,
     center_id: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -6396,7 +8275,7 @@ async def get_vehicles(
     if center_id:
         query["center_id"] = center_id
     
-    vehicles = await db.vehicles.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    vehicles = await paginate(response, db.vehicles, query, sort_field="created_at", page_size=page_size, cursor=cursor)
     return vehicles
 
 @api_router.put("/operations/vehicles/{vehicle_id}", response_model=Vehicle)
@@ -6457,9 +8336,8 @@ async def get_operations_dashboard(current_user: dict = Depends(get_current_user
 # Marketing Campaigns
 @api_router.post("/marketing/campaigns", response_model=MarketingCampaign)
 async def create_marketing_campaign(campaign_data: MarketingCampaignCreate, current_user: dict = Depends(get_current_user)):
-    count = await db.marketing_campaigns.count_documents({})
     year = datetime.now().year
-    campaign_code = f"CMP-{year}-{count + 1:04d}"
+    campaign_code = f"CMP-{year}-{await next_sequence('CMP', year):04d}"
     
     campaign = MarketingCampaign(**campaign_data.model_dump())
     campaign_dict = campaign.model_dump()
@@ -6482,8 +8360,11 @@ async def create_marketing_campaign(campaign_data: MarketingCampaignCreate, curr
 
 @api_router.get("/marketing/campaigns")
 async def get_marketing_campaigns(
+    response: Response,
     status: Optional[str] = None,
     campaign_type: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -6492,7 +8373,7 @@ async def get_marketing_campaigns(
     if campaign_type:
         query["campaign_type"] = campaign_type
     
-    campaigns = await db.marketing_campaigns.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    campaigns = await paginate(response, db.marketing_campaigns, query, sort_field="created_at", page_size=page_size, cursor=cursor)
     return campaigns
 
 @api_router.put("/marketing/campaigns/{campaign_id}", response_model=MarketingCampaign)
@@ -6522,8 +8403,7 @@ async def update_campaign_status(campaign_id: str, status: str, current_user: di
 # Leads (العملاء المحتملين)
 @api_router.post("/marketing/leads", response_model=Lead)
 async def create_lead(lead_data: LeadCreate, current_user: dict = Depends(get_current_user)):
-    count = await db.marketing_leads.count_documents({})
-    lead_code = f"LEAD-{count + 1:05d}"
+    lead_code = f"LEAD-{await next_sequence('LEAD'):05d}"
     
     lead = Lead(**lead_data.model_dump())
     lead_dict = lead.model_dump()
@@ -6553,9 +8433,12 @@ async def create_lead(lead_data: LeadCreate, current_user: dict = Depends(get_cu
 
 @api_router.get("/marketing/leads")
 async def get_leads(
+    response: Response,
     status: Optional[str] = None,
     lead_source: Optional[str] = None,
     assigned_to_id: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -6566,7 +8449,7 @@ async def get_leads(
     if assigned_to_id:
         query["assigned_to_id"] = assigned_to_id
     
-    leads = await db.marketing_leads.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    leads = await paginate(response, db.marketing_leads, query, sort_field="created_at", page_size=page_size, cursor=cursor)
     return leads
 
 @api_router.put("/marketing/leads/{lead_id}", response_model=Lead)
@@ -6631,8 +8514,11 @@ async def create_social_post(post_data: SocialMediaPostCreate, current_user: dic
 
 @api_router.get("/marketing/social-posts")
 async def get_social_posts(
+    response: Response,
     platform: Optional[str] = None,
     status: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -6641,7 +8527,7 @@ async def get_social_posts(
     if status:
         query["status"] = status
     
-    posts = await db.social_media_posts.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    posts = await paginate(response, db.social_media_posts, query, sort_field="created_at", page_size=page_size, cursor=cursor)
     return posts
 
 @api_router.put("/marketing/social-posts/{post_id}/publish")
@@ -6662,8 +8548,7 @@ async def publish_social_post(post_id: str, current_user: dict = Depends(get_cur
 # Sales Offers
 @api_router.post("/marketing/offers", response_model=SalesOffer)
 async def create_sales_offer(offer_data: SalesOfferCreate, current_user: dict = Depends(get_current_user)):
-    count = await db.sales_offers.count_documents({})
-    offer_code = f"OFFER-{count + 1:04d}"
+    offer_code = f"OFFER-{await next_sequence('OFFER'):04d}"
     
     offer = SalesOffer(**offer_data.model_dump())
     offer_dict = offer.model_dump()
@@ -6686,8 +8571,11 @@ async def create_sales_offer(offer_data: SalesOfferCreate, current_user: dict =
 
 @api_router.get("/marketing/offers")
 async def get_sales_offers(
+    response: Response,
     status: Optional[str] = None,
     offer_type: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -6696,7 +8584,7 @@ async def get_sales_offers(
     if offer_type:
         query["offer_type"] = offer_type
     
-    offers = await db.sales_offers.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    offers = await paginate(response, db.sales_offers, query, sort_field="created_at", page_size=page_size, cursor=cursor)
     return offers
 
 @api_router.put("/marketing/offers/{offer_id}/activate")
@@ -6714,9 +8602,8 @@ async def activate_offer(offer_id: str, current_user: dict = Depends(get_current
 # Market Returns (مرتجعات السوق)
 @api_router.post("/marketing/returns", response_model=MarketReturn)
 async def create_market_return(return_data: MarketReturnCreate, current_user: dict = Depends(get_current_user)):
-    count = await db.market_returns.count_documents({})
     year = datetime.now().year
-    return_code = f"RTN-{year}-{count + 1:04d}"
+    return_code = f"RTN-{year}-{await next_sequence('RTN', year):04d}"
     
     market_return = MarketReturn(**return_data.model_dump())
     return_dict = market_return.model_dump()
@@ -6739,10 +8626,13 @@ async def create_market_return(return_data: MarketReturnCreate, current_user: di
 
 @api_router.get("/marketing/returns")
 async def get_market_returns(
+    response: Response,
     status: Optional[str] = None,
     center_id: Optional[str] = None,
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -6758,7 +8648,7 @@ async def get_market_returns(
         else:
             query["return_date"] = {"$lte": end_date}
     
-    returns = await db.market_returns.find(query, {"_id": 0}).sort("return_date", -1).to_list(1000)
+    returns = await paginate(response, db.market_returns, query, sort_field="return_date", page_size=page_size, cursor=cursor)
     return returns
 
 @api_router.put("/marketing/returns/{return_id}/approve")
@@ -6795,9 +8685,12 @@ async def create_market_sales_summary(summary_data: MarketSalesSummaryCreate, cu
 
 @api_router.get("/marketing/sales-summary")
 async def get_market_sales_summaries(
+    response: Response,
     center_id: Optional[str] = None,
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     query = {}
@@ -6811,7 +8704,7 @@ async def get_market_sales_summaries(
         else:
             query["report_date"] = {"$lte": end_date}
     
-    summaries = await db.market_sales_summaries.find(query, {"_id": 0}).sort("report_date", -1).to_list(1000)
+    summaries = await paginate(response, db.market_sales_summaries, query, sort_field="report_date", page_size=page_size, cursor=cursor)
     return summaries
 
 # Marketing Dashboard
@@ -6877,49 +8770,77 @@ async def get_marketing_dashboard(current_user: dict = Depends(get_current_user)
 async def get_central_dashboard(current_user: dict = Depends(get_current_user)):
     """Central dashboard showing data from all centers"""
     
-    # Get all centers
-    centers = await db.collection_centers.find({"is_active": True}, {"_id": 0}).to_list(100)
+    today = local_today()
+    this_month_start = today[:8] + "01"
+    
+    # Per-center milk totals in a single pass over the month's rollups
+    rollup_pipeline = [
+        {"$match": {"date": {"$gte": this_month_start, "$lte": today}}},
+        {"$group": {
+            "_id": "$center_id",
+            "today_milk_liters": {"$sum": {"$cond": [{"$eq": ["$date", today]}, "$reception_liters", 0]}},
+            "today_amount": {"$sum": {"$cond": [{"$eq": ["$date", today]}, "$reception_amount", 0]}},
+            "monthly_milk_liters": {"$sum": "$reception_liters"},
+            "today_sales_liters": {"$sum": {"$cond": [{"$eq": ["$date", today]}, "$sales_liters", 0]}},
+            "today_sales_amount": {"$sum": {"$cond": [{"$eq": ["$date", today]}, "$sales_amount", 0]}}
+        }}
+    ]
+    suppliers_pipeline = [
+        {"$match": {"is_active": True}},
+        {"$group": {"_id": "$center_id", "count": {"$sum": 1}}}
+    ]
+    payments_pipeline = [
+        {"$match": {"payment_date": {"$gte": local_day_bounds(this_month_start)[0]}}},
+        {"$group": {"_id": "$payment_type", "amount": {"$sum": "$amount"}}}
+    ]
     
-    # Today's date
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    this_month_start = datetime.now().replace(day=1).strftime("%Y-%m-%d")
+    (
+        centers,
+        milk_by_center,
+        suppliers_by_center,
+        payments_by_type,
+        inventory,
+        total_employees,
+        present_today,
+        pending_leaves,
+        pending_expenses
+    ) = await asyncio.gather(
+        db.collection_centers.find({"is_active": True}, {"_id": 0}).to_list(100),
+        db.daily_rollups.aggregate(rollup_pipeline).to_list(None),
+        db.suppliers.aggregate(suppliers_pipeline).to_list(None),
+        db.payments.aggregate(payments_pipeline).to_list(None),
+        db.inventory_stock.find({"product_type": "raw_milk"}, {"_id": 0, "center_id": 1, "quantity": 1}).to_list(None),
+        db.hr_employees.count_documents({"is_active": True}),
+        db.hr_attendance.count_documents({"date": today, "check_in": {"$ne": None}}),
+        db.hr_leave_requests.count_documents({"status": "pending"}),
+        db.hr_expense_requests.count_documents({"status": "pending"})
+    )
+    
+    milk_by_center = {m["_id"]: m for m in milk_by_center}
+    suppliers_by_center = {s["_id"]: s["count"] for s in suppliers_by_center}
+    payments_by_type = {p["_id"]: p["amount"] for p in payments_by_type}
+    stock_by_center = {s["center_id"]: s["quantity"] for s in inventory}
     
     center_stats = []
     total_milk_today = 0
     total_milk_month = 0
-    total_sales_today = 0
     total_suppliers = 0
     
     for center in centers:
         center_id = center["id"]
-        
-        # Today's milk reception for this center
-        today_milk = await db.milk_receptions.find(
-            {"center_id": center_id, "reception_date": {"$regex": f"^{today}"}},
-            {"_id": 0, "quantity_liters": 1, "total_amount": 1}
-        ).to_list(1000)
-        
-        center_milk_today = sum(m.get("quantity_liters", 0) for m in today_milk)
-        center_amount_today = sum(m.get("total_amount", 0) for m in today_milk)
-        
-        # Monthly milk for this center
-        monthly_milk = await db.milk_receptions.find(
-            {"center_id": center_id, "reception_date": {"$gte": this_month_start}},
-            {"_id": 0, "quantity_liters": 1}
-        ).to_list(10000)
-        
-        center_milk_month = sum(m.get("quantity_liters", 0) for m in monthly_milk)
-        
-        # Suppliers count for this center
-        center_suppliers = await db.suppliers.count_documents({"center_id": center_id, "is_active": True})
+        milk = milk_by_center.get(center_id, {})
+        center_milk_today = milk.get("today_milk_liters", 0)
+        center_milk_month = milk.get("monthly_milk_liters", 0)
+        center_suppliers = suppliers_by_center.get(center_id, 0)
         
         center_stats.append({
             "center_id": center_id,
             "center_name": center["name"],
             "center_code": center.get("code", ""),
             "today_milk_liters": center_milk_today,
-            "today_amount": center_amount_today,
+            "today_amount": milk.get("today_amount", 0),
             "monthly_milk_liters": center_milk_month,
+            "current_stock": stock_by_center.get(center_id, 0),
             "suppliers_count": center_suppliers
         })
         
@@ -6927,35 +8848,13 @@ async def get_central_dashboard(current_user: dict = Depends(get_current_user)):
         total_milk_month += center_milk_month
         total_suppliers += center_suppliers
     
-    # Total sales today
-    today_sales = await db.sales.find(
-        {"sale_date": {"$regex": f"^{today}"}},
-        {"_id": 0, "total_amount": 1, "quantity_liters": 1}
-    ).to_list(1000)
-    
-    total_sales_amount = sum(s.get("total_amount", 0) for s in today_sales)
-    total_sales_liters = sum(s.get("quantity_liters", 0) for s in today_sales)
-    
-    # Inventory status
-    inventory = await db.inventory.find_one({"product_type": "raw_milk"}, {"_id": 0})
-    current_stock = inventory.get("quantity_liters", 0) if inventory else 0
+    # Total sales today across all centers
+    total_sales_amount = sum(m.get("today_sales_amount", 0) for m in milk_by_center.values())
+    total_sales_liters = sum(m.get("today_sales_liters", 0) for m in milk_by_center.values())
     
-    # HR stats
-    total_employees = await db.hr_employees.count_documents({"is_active": True})
-    present_today = await db.hr_attendance.count_documents({"date": today, "check_in": {"$ne": None}})
-    
-    # Pending approvals
-    pending_leaves = await db.hr_leave_requests.count_documents({"status": "pending"})
-    pending_expenses = await db.hr_expense_requests.count_documents({"status": "pending"})
-    
-    # Financial summary
-    monthly_payments = await db.payments.find(
-        {"payment_date": {"$gte": this_month_start}},
-        {"_id": 0, "amount": 1, "payment_type": 1}
-    ).to_list(10000)
-    
-    supplier_payments = sum(p.get("amount", 0) for p in monthly_payments if p.get("payment_type") == "supplier_payment")
-    customer_receipts = sum(p.get("amount", 0) for p in monthly_payments if p.get("payment_type") == "customer_receipt")
+    current_stock = sum(stock_by_center.values())
+    supplier_payments = payments_by_type.get("supplier_payment", 0)
+    customer_receipts = payments_by_type.get("customer_receipt", 0)
     
     return {
         "summary": {
@@ -7004,6 +8903,7 @@ async def import_attendance_from_excel(
         
         imported_count = 0
         errors = []
+        touched_employees = set()
         
         # Expected columns: employee_code, date, check_in, check_out
         headers = [cell.value for cell in ws[1]]
@@ -7031,6 +8931,7 @@ async def import_attendance_from_excel(
                 if not employee:
                     errors.append(f"Row {row_num}: Employee {employee_code} not found")
                     continue
+                touched_employees.add(employee["id"])
                 
                 # Check if attendance already exists
                 existing = await db.hr_attendance.find_one({
@@ -7070,6 +8971,8 @@ async def import_attendance_from_excel(
             except Exception as e:
                 errors.append(f"Row {row_num}: {str(e)}")
         
+        await mark_payroll_dirty(*touched_employees, reason="attendance")
+        
         await log_activity(
             user_id=current_user["id"],
             user_name=current_user["full_name"],
@@ -7125,9 +9028,9 @@ async def create_payroll_period(
     return period.model_dump()
 
 @api_router.get("/hr/payroll/periods")
-async def get_payroll_periods(current_user: dict = Depends(get_current_user)):
+async def get_payroll_periods(response: Response, page_size: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None, current_user: dict = Depends(get_current_user)):
     """Get all payroll periods"""
-    periods = await db.payroll_periods.find({}, {"_id": 0}).sort("created_at", -1).to_list(100)
+    periods = await paginate(response, db.payroll_periods, {}, sort_field="created_at", page_size=page_size, cursor=cursor)
     return periods
 
 @api_router.get("/hr/payroll/periods/{period_id}")
@@ -7150,6 +9053,87 @@ async def get_payroll_period(period_id: str, current_user: dict = Depends(get_cu
         }
     }
 
+# Attendance status -> payroll record counter
+PAYROLL_STATUS_FIELDS = {
+    "present": "working_days",
+    "off": "day_off",
+    "weekend": "day_off",
+    "sick_leave": "sick_leave",
+    "annual_leave": "annual_leave",
+    "public_holiday": "public_holiday",
+    "emergency_leave": "emergency_leave",
+    "on_duty": "on_duty",
+    "absent": "absent_days",
+    "unpaid_leave": "unpaid_leave",
+}
+PAYROLL_PAID_FIELDS = ("working_days", "day_off", "sick_leave", "annual_leave", "public_holiday", "emergency_leave", "on_duty")
+PAYROLL_UNPAID_FIELDS = ("absent_days", "unpaid_leave")
+
+async def attendance_status_groups(start_date: str, end_date: str, employee_ids: Optional[List[str]] = None, employee_names: Optional[List[str]] = None) -> List[dict]:
+    """Count attendance per (employee_id, employee_name, status) over a date range in one $group"""
+    match = {"date": {"$gte": start_date, "$lte": end_date}, "status": {"$in": list(PAYROLL_STATUS_FIELDS)}}
+    if employee_ids is not None or employee_names is not None:
+        match["$or"] = [
+            {"employee_id": {"$in": employee_ids or []}},
+            {"employee_name": {"$in": employee_names or []}}
+        ]
+    pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": {"employee_id": "$employee_id", "employee_name": "$employee_name", "status": "$status"},
+            "count": {"$sum": 1}
+        }}
+    ]
+    return [group async for group in db.hr_attendance.aggregate(pipeline)]
+
+def index_status_groups(groups: List[dict]):
+    """Index grouped attendance counts by employee id and by employee name"""
+    by_id, by_name = {}, {}
+    for position, group in enumerate(groups):
+        key = group["_id"]
+        if key.get("employee_id"):
+            by_id.setdefault(key["employee_id"], []).append(position)
+        if key.get("employee_name"):
+            by_name.setdefault(key["employee_name"], []).append(position)
+    return by_id, by_name
+
+def build_payroll_record(period_id: str, emp: dict, groups: List[dict], by_id: dict, by_name: dict) -> dict:
+    """Build one employee's payroll record from the grouped attendance counts"""
+    counts = dict.fromkeys(PAYROLL_STATUS_FIELDS.values(), 0)
+    # Attendance matches an employee by id or by name; each group is counted once
+    for position in set(by_id.get(emp.get("id"), [])) | set(by_name.get(emp.get("name"), [])):
+        group = groups[position]
+        counts[PAYROLL_STATUS_FIELDS[group["_id"]["status"]]] += group["count"]
+    
+    # Calculate salary
+    basic_salary = emp.get("salary", 0)
+    daily_rate = basic_salary / 30 if basic_salary > 0 else 0
+    
+    # Total pay days = working + paid leaves
+    total_pay_days = sum(counts[field] for field in PAYROLL_PAID_FIELDS)
+    gross_salary = daily_rate * total_pay_days
+    
+    # Deductions for unpaid leave and absences
+    deductions = daily_rate * sum(counts[field] for field in PAYROLL_UNPAID_FIELDS)
+    net_salary = gross_salary - deductions
+    
+    record = PayrollRecord(
+        period_id=period_id,
+        employee_id=emp.get("id"),
+        employee_name=emp.get("name"),
+        employee_code=emp.get("employee_code"),
+        department=emp.get("department"),
+        position=emp.get("position"),
+        **counts,
+        basic_salary=basic_salary,
+        daily_rate=round(daily_rate, 3),
+        total_pay_days=total_pay_days,
+        gross_salary=round(gross_salary, 3),
+        deductions=round(deductions, 3),
+        net_salary=round(net_salary, 3)
+    )
+    return record.model_dump()
+
 @api_router.post("/hr/payroll/periods/{period_id}/calculate")
 async def calculate_payroll(period_id: str, current_user: dict = Depends(get_current_user)):
     """Calculate payroll for all employees based on attendance"""
@@ -7157,86 +9141,29 @@ async def calculate_payroll(period_id: str, current_user: dict = Depends(get_cur
     if not period:
         raise HTTPException(status_code=404, detail="Payroll period not found")
     
-    # Get all active employees
-    employees = await db.hr_employees.find({"is_active": True}, {"_id": 0}).to_list(1000)
+    # Changes marked after this point are picked up by the next incremental run
+    started_at = datetime.now(timezone.utc).isoformat()
     
-    # Get attendance records for the period
-    start_date = period["start_date"]
-    end_date = period["end_date"]
+    # Attendance counts for the period, grouped in Mongo
+    groups = await attendance_status_groups(period["start_date"], period["end_date"])
+    by_id, by_name = index_status_groups(groups)
     
-    attendance_records = await db.hr_attendance.find({
-        "date": {"$gte": start_date, "$lte": end_date}
-    }, {"_id": 0}).to_list(10000)
+    payroll_records = [
+        build_payroll_record(period_id, emp, groups, by_id, by_name)
+        async for emp in db.hr_employees.find({"is_active": True}, {"_id": 0})
+    ]
     
-    # Delete existing payroll records for this period
+    # Replace existing payroll records for this period
     await db.payroll_records.delete_many({"period_id": period_id})
-    
-    payroll_records = []
-    
-    for emp in employees:
-        # Filter attendance for this employee
-        emp_attendance = [a for a in attendance_records if a.get("employee_id") == emp.get("id") or a.get("employee_name") == emp.get("name")]
-        
-        # Count attendance types
-        working_days = len([a for a in emp_attendance if a.get("status") == "present"])
-        day_off = len([a for a in emp_attendance if a.get("status") in ["off", "weekend"]])
-        sick_leave = len([a for a in emp_attendance if a.get("status") == "sick_leave"])
-        annual_leave = len([a for a in emp_attendance if a.get("status") == "annual_leave"])
-        public_holiday = len([a for a in emp_attendance if a.get("status") == "public_holiday"])
-        emergency_leave = len([a for a in emp_attendance if a.get("status") == "emergency_leave"])
-        on_duty = len([a for a in emp_attendance if a.get("status") == "on_duty"])
-        absent_days = len([a for a in emp_attendance if a.get("status") == "absent"])
-        unpaid_leave = len([a for a in emp_attendance if a.get("status") == "unpaid_leave"])
-        
-        # Calculate salary
-        basic_salary = emp.get("salary", 0)
-        daily_rate = basic_salary / 30 if basic_salary > 0 else 0
-        
-        # Total pay days = working + paid leaves
-        total_pay_days = working_days + day_off + sick_leave + annual_leave + public_holiday + emergency_leave + on_duty
-        
-        # Gross salary
-        gross_salary = daily_rate * total_pay_days
-        
-        # Deductions for unpaid leave and absences
-        deductions = daily_rate * (absent_days + unpaid_leave)
-        
-        # Net salary
-        net_salary = gross_salary - deductions
-        
-        record = PayrollRecord(
-            period_id=period_id,
-            employee_id=emp.get("id"),
-            employee_name=emp.get("name"),
-            employee_code=emp.get("employee_code"),
-            department=emp.get("department"),
-            position=emp.get("position"),
-            working_days=working_days,
-            day_off=day_off,
-            sick_leave=sick_leave,
-            annual_leave=annual_leave,
-            public_holiday=public_holiday,
-            emergency_leave=emergency_leave,
-            on_duty=on_duty,
-            absent_days=absent_days,
-            unpaid_leave=unpaid_leave,
-            basic_salary=basic_salary,
-            daily_rate=round(daily_rate, 3),
-            total_pay_days=total_pay_days,
-            gross_salary=round(gross_salary, 3),
-            deductions=round(deductions, 3),
-            net_salary=round(net_salary, 3)
-        )
-        
-        await db.payroll_records.insert_one(record.model_dump())
-        payroll_records.append(record.model_dump())
+    if payroll_records:
+        await db.payroll_records.insert_many(payroll_records, ordered=False)
     
     # Update period status
     await db.payroll_periods.update_one(
         {"id": period_id},
         {"$set": {
             "status": "calculated",
-            "calculated_at": datetime.now(timezone.utc).isoformat()
+            "calculated_at": started_at
         }}
     )
     
@@ -7256,10 +9183,82 @@ async def calculate_payroll(period_id: str, current_user: dict = Depends(get_cur
         "records_count": len(payroll_records)
     }
 
+@api_router.post("/hr/payroll/periods/{period_id}/recalculate")
+async def recalculate_payroll(period_id: str, mode: str = "incremental", current_user: dict = Depends(get_current_user)):
+    """Recalculate payroll; incremental mode only recomputes employees whose inputs changed since the last calculation"""
+    if mode not in ("incremental", "full"):
+        raise HTTPException(status_code=400, detail="وضع إعادة الحساب يجب أن يكون incremental أو full")
+    period = await db.payroll_periods.find_one({"id": period_id}, {"_id": 0})
+    if not period:
+        raise HTTPException(status_code=404, detail="Payroll period not found")
+    if mode == "full" or not period.get("calculated_at"):
+        return await calculate_payroll(period_id, current_user)
+    
+    started_at = datetime.now(timezone.utc).isoformat()
+    keys = [
+        entry["key"]
+        async for entry in db.payroll_dirty.find({"changed_at": {"$gt": period["calculated_at"]}}, {"_id": 0, "key": 1})
+    ]
+    employees = []
+    if keys:
+        employees = await db.hr_employees.find(
+            {"$or": [{"id": {"$in": keys}}, {"name": {"$in": keys}}]}, {"_id": 0}
+        ).to_list(None)
+    active = [emp for emp in employees if emp.get("is_active")]
+    inactive_ids = [emp["id"] for emp in employees if not emp.get("is_active")]
+    
+    groups = await attendance_status_groups(
+        period["start_date"], period["end_date"],
+        employee_ids=[emp["id"] for emp in active],
+        employee_names=[emp["name"] for emp in active if emp.get("name")]
+    )
+    by_id, by_name = index_status_groups(groups)
+    
+    # Upsert in place so record ids stay stable across recalculations
+    operations = []
+    for emp in active:
+        record = build_payroll_record(period_id, emp, groups, by_id, by_name)
+        on_insert = {"id": record.pop("id"), "created_at": record.pop("created_at")}
+        operations.append(UpdateOne(
+            {"period_id": period_id, "employee_id": emp["id"]},
+            {"$set": record, "$setOnInsert": on_insert},
+            upsert=True
+        ))
+    if operations:
+        await db.payroll_records.bulk_write(operations, ordered=False)
+    if inactive_ids:
+        await db.payroll_records.delete_many({"period_id": period_id, "employee_id": {"$in": inactive_ids}})
+    
+    await db.payroll_periods.update_one(
+        {"id": period_id},
+        {"$set": {"status": "calculated", "calculated_at": started_at}}
+    )
+    
+    await log_activity(
+        user_id=current_user["id"],
+        user_name=current_user["full_name"],
+        action="recalculate_payroll",
+        entity_type="payroll",
+        entity_id=period_id,
+        entity_name=period["name"],
+        details=f"إعادة حساب رواتب {len(active)} موظف"
+    )
+    
+    return {
+        "message": f"تم إعادة حساب رواتب {len(active)} موظف",
+        "period_id": period_id,
+        "mode": "incremental",
+        "recalculated": len(active),
+        "removed": len(inactive_ids)
+    }
+
 @api_router.get("/hr/payroll/records")
 async def get_payroll_records(
+    response: Response,
     period_id: Optional[str] = None,
     employee_id: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """Get payroll records with optional filters"""
@@ -7269,7 +9268,7 @@ async def get_payroll_records(
     if employee_id:
         query["employee_id"] = employee_id
     
-    records = await db.payroll_records.find(query, {"_id": 0}).to_list(1000)
+    records = await paginate(response, db.payroll_records, query, page_size=page_size, cursor=cursor)
     return records
 
 @api_router.put("/hr/payroll/records/{record_id}")
@@ -7315,18 +9314,7 @@ async def update_payroll_record(
 @api_router.post("/hr/payroll/periods/{period_id}/approve")
 async def approve_payroll(period_id: str, current_user: dict = Depends(get_current_user)):
     """Approve a payroll period"""
-    period = await db.payroll_periods.find_one({"id": period_id}, {"_id": 0})
-    if not period:
-        raise HTTPException(status_code=404, detail="Payroll period not found")
-    
-    await db.payroll_periods.update_one(
-        {"id": period_id},
-        {"$set": {
-            "status": "approved",
-            "approved_at": datetime.now(timezone.utc).isoformat(),
-            "approved_by": current_user["full_name"]
-        }}
-    )
+    period = await transition_status("payroll", period_id, "approve", current_user)
     
     await log_activity(
         user_id=current_user["id"],
@@ -7355,6 +9343,66 @@ async def delete_payroll_period(period_id: str, current_user: dict = Depends(get
     
     return {"message": "تم حذف فترة الرواتب بنجاح"}
 
+# ==================== BULK APPROVALS (الموافقات الجماعية) ====================
+
+BULK_APPROVAL_MAX = int(os.environ.get('BULK_APPROVAL_MAX', 200))
+
+class BulkApproval(BaseModel):
+    entity: str  # payment, leave_request, expense_request, loan, official_letter, feed_purchase, payroll
+    action: str  # approve, reject
+    ids: List[str]
+    reason: Optional[str] = None
+
+# Transitions with per-item side effects (treasury, balances, signatures) run one by one
+BULK_ITEM_HANDLERS = {
+    ("payment", "approve"): lambda doc_id, reason, user: decide_payment(doc_id, "approve", reason, user),
+    ("payment", "reject"): lambda doc_id, reason, user: decide_payment(doc_id, "reject", reason, user),
+    ("official_letter", "approve"): lambda doc_id, reason, user: sign_official_letter(doc_id, user),
+    ("feed_purchase", "approve"): lambda doc_id, reason, user: sign_feed_purchase(doc_id, user),
+}
+
+@api_router.post("/approvals/bulk")
+async def bulk_approve(approval: BulkApproval, current_user: dict = Depends(require_role(["admin"]))):
+    """Approve or reject many pending items of one kind in a single request"""
+    if approval.entity not in WORKFLOWS:
+        raise HTTPException(status_code=400, detail="نوع العنصر غير مدعوم")
+    workflow_transition(approval.entity, approval.action)
+    ids = list(dict.fromkeys(approval.ids))
+    if len(ids) > BULK_APPROVAL_MAX:
+        raise HTTPException(status_code=400, detail=f"الحد الأقصى {BULK_APPROVAL_MAX} عنصر في الطلب الواحد")
+    
+    handler = BULK_ITEM_HANDLERS.get((approval.entity, approval.action))
+    if handler is not None:
+        done, errors = [], []
+        for doc_id in ids:
+            try:
+                await handler(doc_id, approval.reason, current_user)
+                done.append(doc_id)
+            except HTTPException as e:
+                errors.append({"id": doc_id, "error": e.detail})
+    else:
+        changed = await transition_many(approval.entity, ids, approval.action, current_user, reason=approval.reason)
+        done = [doc["id"] for doc in changed]
+        skipped = set(ids) - set(done)
+        errors = [{"id": doc_id, "error": "غير موجود أو تمت معالجته مسبقاً"} for doc_id in ids if doc_id in skipped]
+        if approval.entity == "loan":
+            await mark_payroll_dirty(*[doc.get("employee_id") for doc in changed], reason="loan")
+        if done:
+            await log_activity(
+                user_id=current_user["id"],
+                user_name=current_user["full_name"],
+                action=f"bulk_{approval.action}_{approval.entity}",
+                entity_type=approval.entity,
+                details=f"{'موافقة' if approval.action == 'approve' else 'رفض'} جماعي على {len(done)} عنصر"
+            )
+    
+    return {
+        "entity": approval.entity,
+        "action": approval.action,
+        "processed": done,
+        "errors": errors
+    }
+
 # ==================== AI ANALYSIS (التحليل الذكي) ====================
 
 class AnalysisRequest(BaseModel):
@@ -7824,8 +9872,11 @@ class Warning(WarningBase):
 
 @api_router.get("/hr/warnings")
 async def get_warnings(
+    response: Response,
     employee_id: Optional[str] = None,
     status: Optional[str] = None,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """Get all warnings"""
@@ -7835,7 +9886,7 @@ async def get_warnings(
     if status:
         query["status"] = status
     
-    warnings = await db.hr_warnings.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    warnings = await paginate(response, db.hr_warnings, query, sort_field="created_at", page_size=page_size, cursor=cursor)
     return warnings
 
 @api_router.post("/hr/warnings", response_model=Warning)
@@ -7904,6 +9955,60 @@ async def delete_warning(warning_id: str, current_user: dict = Depends(require_r
     
     return {"message": "Warning deleted successfully"}
 
+# ==================== SYSTEM (النظام) ====================
+
+@api_router.get("/system/indexes")
+async def get_system_indexes(current_user: dict = Depends(require_role(["admin"]))):
+    """Report registered indexes that are missing or unused"""
+    return await get_index_report()
+
+@api_router.post("/system/activity-logs/archive")
+async def archive_activity_logs_now(current_user: dict = Depends(require_role(["admin"]))):
+    """Run the activity log archive job immediately"""
+    return await archive_activity_logs()
+
+@api_router.get("/system/metrics")
+async def get_system_metrics(current_user: dict = Depends(require_role(["admin"]))):
+    """In-process cache and worker counters for this API worker"""
+    return {
+        "pid": os.getpid(),
+        "user_cache": user_cache.stats(),
+        "password_hashing": password_metrics(),
+        "pdf_rendering": {"workers": PDF_WORKERS, **pdf_stats},
+        "activity_log_buffer": activity_log_buffer.metrics(),
+        "group_commit": group_commit.metrics()
+    }
+
+@api_router.post("/system/inventory/rebuild")
+async def rebuild_inventory(current_user: dict = Depends(require_role(["admin"]))):
+    """Recompute per-center stock documents from the inventory ledger"""
+    result = await rebuild_inventory_stock()
+    
+    await log_activity(
+        user_id=current_user["id"],
+        user_name=current_user["full_name"],
+        action="rebuild_inventory_stock",
+        entity_type="system",
+        details=f"إعادة بناء أرصدة المخزون: {result['stock_documents']} سجل"
+    )
+    
+    return result
+
+@api_router.post("/system/rollups/rebuild")
+async def rebuild_rollups(current_user: dict = Depends(require_role(["admin"]))):
+    """Backfill daily_rollups from raw receptions and sales"""
+    result = await rebuild_daily_rollups()
+    
+    await log_activity(
+        user_id=current_user["id"],
+        user_name=current_user["full_name"],
+        action="rebuild_rollups",
+        entity_type="system",
+        details=f"إعادة بناء الملخصات اليومية: {result['rollups']} سجل"
+    )
+    
+    return result
+
 @api_router.get("/")
 async def root():
     return {"message": "Milk Collection Center ERP API", "version": "1.0.0"}
@@ -7917,6 +10022,7 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Idempotent-Replay"],
 )
 
 # Configure logging
@@ -7928,4 +10034,26 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
+    await group_commit.stop()
+    await activity_log_buffer.stop()
     client.close()
+    if pdf_executor is not None:
+        pdf_executor.shutdown(wait=False, cancel_futures=True)
+
+if __name__ == "__main__":
+    import sys
+    
+    # Maintenance commands, e.g. python server.py rebuild-rollups
+    commands = {
+        "rebuild-rollups": rebuild_daily_rollups,
+        "archive-activity-logs": archive_activity_logs,
+        "rebuild-inventory-stock": rebuild_inventory_stock,
+        "inventory-snapshots": take_inventory_snapshots,
+        "close-treasury-days": close_treasury_days,
+    }
+    if len(sys.argv) == 2 and sys.argv[1] in commands:
+        print(asyncio.run(commands[sys.argv[1]]()))
+    else:
+        print(f"Usage: python server.py [{'|'.join(commands)}]")
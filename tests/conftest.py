@@ -0,0 +1,32 @@
+import pytest
+
+from tests.live import BACKEND_URL, DB_NAME, MONGO_URL, TEST_PASSWORD, TEST_USERNAME
+
+
+@pytest.fixture(scope="session")
+def api():
+    requests = pytest.importorskip("requests")
+    session = requests.Session()
+    try:
+        response = session.post(
+            f"{BACKEND_URL}/auth/login",
+            json={"username": TEST_USERNAME, "password": TEST_PASSWORD},
+            timeout=10
+        )
+    except requests.ConnectionError:
+        pytest.skip(f"backend not reachable at {BACKEND_URL}")
+    assert response.status_code == 200, response.text
+    session.headers.update({"Authorization": f"Bearer {response.json()['access_token']}"})
+    return session
+
+
+@pytest.fixture(scope="session")
+def db():
+    pymongo = pytest.importorskip("pymongo")
+    client = pymongo.MongoClient(MONGO_URL, serverSelectionTimeoutMS=3000)
+    try:
+        client.admin.command("ping")
+    except pymongo.errors.PyMongoError:
+        pytest.skip(f"MongoDB not reachable at {MONGO_URL}")
+    yield client[DB_NAME]
+    client.close()
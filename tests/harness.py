@@ -0,0 +1,656 @@
+"""
+Run backend/server.py functions against an in-memory database.
+
+server.py connects to MongoDB and pulls in the whole web stack when imported, so
+unit tests compile only the definitions they exercise out of its source, together
+with its module-level constants, and run them against FakeDatabase: an asyncio
+subset of the Motor API. Every operation yields to the event loop before it runs
+and then applies atomically, so concurrent callers interleave between operations
+the way they do against a real server.
+
+The web framework and driver types those definitions refer to (HTTPException,
+DuplicateKeyError, UpdateOne, ...) are replaced by the minimal classes below.
+"""
+
+import __future__
+import ast
+import asyncio
+import base64
+import copy
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import secrets
+import tempfile
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager, nullcontext
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import List, Optional
+from zoneinfo import ZoneInfo
+
+SERVER_PATH = Path(__file__).resolve().parent.parent / "backend" / "server.py"
+
+
+# ==================== FRAMEWORK AND DRIVER TYPES ====================
+
+class HTTPException(Exception):
+    def __init__(self, status_code: int, detail=None, headers=None):
+        super().__init__(status_code, detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.headers = headers
+
+
+class DuplicateKeyError(Exception):
+    code = 11000
+
+
+class BulkWriteError(Exception):
+    def __init__(self, details: dict):
+        super().__init__(details)
+        self.details = details
+
+
+class ReturnDocument:
+    BEFORE = False
+    AFTER = True
+
+
+class UpdateOne:
+    def __init__(self, filter, update, upsert=False):
+        self.filter, self.update, self.upsert = filter, update, upsert
+
+
+class ReplaceOne:
+    def __init__(self, filter, replacement, upsert=False):
+        self.filter, self.replacement, self.upsert = filter, replacement, upsert
+
+
+class InsertOne:
+    def __init__(self, document):
+        self.document = document
+
+
+class Result:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+# ==================== QUERY AND UPDATE EVALUATION ====================
+
+MISSING = object()
+
+
+def get_path(document: dict, path: str):
+    value = document
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return MISSING
+        value = value[part]
+    return value
+
+
+def set_path(document: dict, path: str, value):
+    *parents, last = path.split(".")
+    for part in parents:
+        document = document.setdefault(part, {})
+    document[last] = value
+
+
+def unset_path(document: dict, path: str):
+    *parents, last = path.split(".")
+    for part in parents:
+        document = document.get(part)
+        if not isinstance(document, dict):
+            return
+    document.pop(last, None)
+
+
+def is_operator_document(value) -> bool:
+    return isinstance(value, dict) and bool(value) and all(key.startswith("$") for key in value)
+
+
+def compare(value, operator: str, argument) -> bool:
+    if operator == "$exists":
+        return (value is not MISSING) == bool(argument)
+    if operator == "$not":
+        return not condition_holds(value, argument)
+    if value is MISSING:
+        value = None
+    if operator == "$eq":
+        return value == argument or (isinstance(value, list) and argument in value)
+    if operator == "$ne":
+        return not compare(value, "$eq", argument)
+    if operator == "$in":
+        return any(compare(value, "$eq", item) for item in argument)
+    if operator == "$nin":
+        return not compare(value, "$in", argument)
+    if operator == "$regex":
+        return isinstance(value, str) and re.search(argument, value) is not None
+    if value is None or argument is None:
+        return False
+    try:
+        if operator == "$gt":
+            return value > argument
+        if operator == "$gte":
+            return value >= argument
+        if operator == "$lt":
+            return value < argument
+        if operator == "$lte":
+            return value <= argument
+    except TypeError:
+        # Values of different types never match a range query
+        return False
+    raise NotImplementedError(f"query operator {operator}")
+
+
+def condition_holds(value, condition) -> bool:
+    if is_operator_document(condition):
+        return all(compare(value, operator, argument) for operator, argument in condition.items())
+    return compare(value, "$eq", condition)
+
+
+def matches(document: dict, query: Optional[dict]) -> bool:
+    for key, condition in (query or {}).items():
+        if key == "$or":
+            if not any(matches(document, branch) for branch in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(document, branch) for branch in condition):
+                return False
+        elif key == "$expr":
+            if not evaluate(condition, document):
+                return False
+        elif not condition_holds(get_path(document, key), condition):
+            return False
+    return True
+
+
+def apply_update(document: dict, update: dict, inserting: bool = False) -> dict:
+    if not any(key.startswith("$") for key in update):
+        return copy.deepcopy(update)
+    for operator, fields in update.items():
+        for path, argument in fields.items():
+            current = get_path(document, path)
+            if operator == "$set" or (operator == "$setOnInsert" and inserting):
+                set_path(document, path, copy.deepcopy(argument))
+            elif operator == "$unset":
+                unset_path(document, path)
+            elif operator == "$inc":
+                set_path(document, path, (0 if current is MISSING else current) + argument)
+            elif operator == "$max":
+                set_path(document, path, argument if current is MISSING or current is None else max(current, argument))
+            elif operator == "$min":
+                set_path(document, path, argument if current is MISSING or current is None else min(current, argument))
+            elif operator == "$push":
+                set_path(document, path, ([] if current is MISSING else current) + [copy.deepcopy(argument)])
+            elif operator != "$setOnInsert":
+                raise NotImplementedError(f"update operator {operator}")
+    return document
+
+
+def upsert_seed(query: dict) -> dict:
+    """Fields an upsert copies from its filter"""
+    document = {}
+    for key, condition in query.items():
+        if not key.startswith("$") and not is_operator_document(condition):
+            set_path(document, key, copy.deepcopy(condition))
+    return document
+
+
+def project(document: dict, projection: Optional[dict]) -> dict:
+    document = copy.deepcopy(document)
+    if not projection:
+        return document
+    included = [key for key, flag in projection.items() if flag and key != "_id"]
+    if included:
+        return {key: document[key] for key in included if key in document}
+    for key, flag in projection.items():
+        if not flag:
+            document.pop(key, None)
+    return document
+
+
+def sort_key(document: dict, fields: list):
+    key = []
+    for field, direction in fields:
+        value = get_path(document, field)
+        value = None if value is MISSING else value
+        key.append(Ordered(value, direction))
+    return key
+
+
+class Ordered:
+    """Sorts None first and honours a per-field direction"""
+
+    def __init__(self, value, direction: int):
+        self.value, self.direction = value, direction
+
+    def __lt__(self, other):
+        mine, theirs = (self.value is not None, self.value), (other.value is not None, other.value)
+        return mine < theirs if self.direction > 0 else theirs < mine
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+# ==================== AGGREGATION ====================
+
+def evaluate(expression, document: dict):
+    if isinstance(expression, str) and expression.startswith("$"):
+        value = get_path(document, expression[1:])
+        return None if value is MISSING else value
+    if isinstance(expression, dict):
+        if not is_operator_document(expression):
+            return {key: evaluate(value, document) for key, value in expression.items()}
+        (operator, arguments), = expression.items()
+        if isinstance(arguments, dict) and not is_operator_document(arguments):
+            return evaluate_date(operator, evaluate(arguments, document))
+        if not isinstance(arguments, list):
+            arguments = [arguments]
+        values = [evaluate(argument, document) for argument in arguments]
+        if operator == "$add":
+            return sum(values)
+        if operator == "$multiply":
+            product = 1
+            for value in values:
+                product *= value
+            return product
+        if operator == "$cond":
+            return values[1] if values[0] else values[2]
+        if operator == "$substrCP":
+            string, start, length = values
+            return string[start:start + length]
+        if operator == "$strLenCP":
+            return len(values[0])
+        if operator == "$toLong":
+            return int(values[0])
+        if operator == "$ifNull":
+            return next((value for value in values if value is not None), None)
+        if operator in EXPRESSION_COMPARISONS:
+            return compare(values[0], operator, values[1])
+        raise NotImplementedError(f"aggregation expression {operator}")
+    return expression
+
+
+EXPRESSION_COMPARISONS = ("$eq", "$ne", "$gt", "$gte", "$lt", "$lte")
+
+
+def evaluate_date(operator: str, arguments: dict):
+    if operator == "$dateFromString":
+        moment = datetime.fromisoformat(arguments["dateString"].replace("Z", "+00:00"))
+        return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+    if operator == "$dateToString":
+        # Only the %Y-%m-%d form the server uses
+        assert arguments["format"] == "%Y-%m-%d", arguments["format"]
+        return arguments["date"].astimezone(ZoneInfo(arguments.get("timezone", "UTC"))).date().isoformat()
+    raise NotImplementedError(f"aggregation expression {operator}")
+
+
+def group(documents: list, spec: dict) -> list:
+    groups = {}
+    for document in documents:
+        group_id = evaluate(spec["_id"], document)
+        key = json.dumps(group_id, sort_keys=True, default=str)
+        result = groups.setdefault(key, {"_id": group_id})
+        for field, accumulator in spec.items():
+            if field == "_id":
+                continue
+            (operator, argument), = accumulator.items()
+            value = evaluate(argument, document)
+            if operator == "$sum":
+                result[field] = result.get(field, 0) + (value if isinstance(value, (int, float)) else 0)
+            elif operator in ("$max", "$min"):
+                if value is not None:
+                    current = result.get(field)
+                    pick = max if operator == "$max" else min
+                    result[field] = value if current is None else pick(current, value)
+                else:
+                    result.setdefault(field, None)
+            elif operator == "$first":
+                result.setdefault(field, value)
+            elif operator == "$last":
+                result[field] = value
+            elif operator == "$push":
+                result.setdefault(field, []).append(value)
+            else:
+                raise NotImplementedError(f"accumulator {operator}")
+    return list(groups.values())
+
+
+def run_pipeline(documents: list, pipeline: list) -> list:
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        if name == "$match":
+            documents = [document for document in documents if matches(document, spec)]
+        elif name == "$group":
+            documents = group(documents, spec)
+        elif name == "$sort":
+            documents = sorted(documents, key=lambda document: sort_key(document, list(spec.items())))
+        elif name == "$limit":
+            documents = documents[:spec]
+        elif name == "$skip":
+            documents = documents[spec:]
+        elif name == "$project":
+            documents = [project(document, spec) for document in documents]
+        else:
+            raise NotImplementedError(f"aggregation stage {name}")
+    return documents
+
+
+# ==================== COLLECTIONS ====================
+
+class FakeCursor:
+    def __init__(self, source, projection=None):
+        self._source = source  # called when the cursor is first read, like a lazy server cursor
+        self._projection = projection
+        self._sort = []
+        self._skip = 0
+        self._limit = 0
+        self._buffer = None
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = [(key_or_list, direction or 1)] if isinstance(key_or_list, str) else list(key_or_list)
+        return self
+
+    def skip(self, count: int):
+        self._skip = count
+        return self
+
+    def limit(self, count: int):
+        self._limit = count
+        return self
+
+    def batch_size(self, size: int):
+        return self
+
+    async def _load(self):
+        if self._buffer is None:
+            await asyncio.sleep(0)
+            documents = self._source()
+            if self._sort:
+                documents = sorted(documents, key=lambda document: sort_key(document, self._sort))
+            documents = documents[self._skip:]
+            if self._limit:
+                documents = documents[:self._limit]
+            self._buffer = [project(document, self._projection) for document in documents]
+        return self._buffer
+
+    async def to_list(self, length=None):
+        # Like Motor, reading advances the cursor
+        documents = await self._load()
+        taken = documents[:length] if length else list(documents)
+        del documents[:len(taken)]
+        return taken
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        documents = await self._load()
+        while documents:
+            await asyncio.sleep(0)
+            yield documents.pop(0)
+
+
+class FakeCollection:
+    def __init__(self, name: str, unique=()):
+        self.name = name
+        self.documents = []
+        self.unique = [tuple(fields) for fields in unique]
+
+    # ---- helpers ----
+
+    def _conflict(self, candidate: dict, ignore=None) -> bool:
+        for fields in self.unique:
+            key = tuple(get_path(candidate, field) for field in fields)
+            key = tuple(None if value is MISSING else value for value in key)
+            for document in self.documents:
+                if document is ignore:
+                    continue
+                other = tuple(get_path(document, field) for field in fields)
+                if tuple(None if value is MISSING else value for value in other) == key:
+                    return True
+        return False
+
+    def _matching(self, query, sort=None) -> list:
+        documents = [document for document in self.documents if matches(document, query)]
+        if sort:
+            documents = sorted(documents, key=lambda document: sort_key(document, list(sort)))
+        return documents
+
+    def _insert(self, document: dict):
+        document = copy.deepcopy(document)
+        if self._conflict(document):
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name}")
+        self.documents.append(document)
+        return document
+
+    def _update(self, query: dict, update: dict, upsert: bool, many: bool = False, sort=None):
+        targets = self._matching(query, sort)
+        if not many:
+            targets = targets[:1]
+        for target in targets:
+            updated = apply_update(copy.deepcopy(target), update)
+            if self._conflict(updated, ignore=target):
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name}")
+            target.clear()
+            target.update(updated)
+        if targets or not upsert:
+            return Result(matched_count=len(targets), modified_count=len(targets), upserted_id=None), targets
+        document = self._insert(apply_update(upsert_seed(query), update, inserting=True))
+        return Result(matched_count=0, modified_count=0, upserted_id=document.get("id", True)), [document]
+
+    # ---- Motor API ----
+
+    async def insert_one(self, document: dict):
+        await asyncio.sleep(0)
+        self._insert(document)
+        return Result(inserted_id=document.get("id"))
+
+    async def insert_many(self, documents: list, ordered: bool = True):
+        await asyncio.sleep(0)
+        errors, inserted = [], 0
+        for index, document in enumerate(documents):
+            try:
+                self._insert(document)
+                inserted += 1
+            except DuplicateKeyError as e:
+                errors.append({"index": index, "code": 11000, "errmsg": str(e)})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "writeConcernErrors": [], "nInserted": inserted})
+        return Result(inserted_ids=[document.get("id") for document in documents])
+
+    async def find_one(self, query=None, projection=None, sort=None):
+        await asyncio.sleep(0)
+        documents = self._matching(query, sort)
+        return project(documents[0], projection) if documents else None
+
+    def find(self, query=None, projection=None, sort=None):
+        cursor = FakeCursor(lambda: self._matching(query), projection)
+        return cursor.sort(sort) if sort else cursor
+
+    async def find_one_and_update(self, query, update, projection=None, upsert=False,
+                                  return_document=ReturnDocument.BEFORE, sort=None):
+        await asyncio.sleep(0)
+        before = self._matching(query, sort)[:1]
+        before = copy.deepcopy(before[0]) if before else None
+        _, documents = self._update(query, update, upsert, sort=sort)
+        if return_document == ReturnDocument.AFTER:
+            return project(documents[0], projection) if documents else None
+        return project(before, projection) if before else None
+
+    async def update_one(self, query, update, upsert=False):
+        await asyncio.sleep(0)
+        return self._update(query, update, upsert)[0]
+
+    async def update_many(self, query, update, upsert=False):
+        await asyncio.sleep(0)
+        return self._update(query, update, upsert, many=True)[0]
+
+    async def replace_one(self, query, replacement, upsert=False):
+        await asyncio.sleep(0)
+        return self._update(query, replacement, upsert)[0]
+
+    async def delete_one(self, query):
+        await asyncio.sleep(0)
+        documents = self._matching(query)[:1]
+        for document in documents:
+            self.documents.remove(document)
+        return Result(deleted_count=len(documents))
+
+    async def delete_many(self, query):
+        await asyncio.sleep(0)
+        documents = self._matching(query)
+        self.documents = [document for document in self.documents if document not in documents]
+        return Result(deleted_count=len(documents))
+
+    async def count_documents(self, query, limit=0, **kwargs):
+        await asyncio.sleep(0)
+        count = len(self._matching(query))
+        return min(count, limit) if limit else count
+
+    async def distinct(self, field, query=None):
+        await asyncio.sleep(0)
+        values = []
+        for document in self._matching(query):
+            value = get_path(document, field)
+            if value is not MISSING and value not in values:
+                values.append(value)
+        return values
+
+    def aggregate(self, pipeline: list, **kwargs):
+        return FakeCursor(lambda: run_pipeline(copy.deepcopy(self.documents), pipeline))
+
+    async def bulk_write(self, operations: list, ordered: bool = True):
+        if not operations:
+            # pymongo refuses an empty batch
+            raise ValueError("No operations to execute")
+        await asyncio.sleep(0)
+        errors = []
+        for index, operation in enumerate(operations):
+            try:
+                if isinstance(operation, UpdateOne):
+                    self._update(operation.filter, operation.update, operation.upsert)
+                elif isinstance(operation, ReplaceOne):
+                    self._update(operation.filter, operation.replacement, operation.upsert)
+                elif isinstance(operation, InsertOne):
+                    self._insert(operation.document)
+                else:
+                    raise NotImplementedError(f"bulk operation {type(operation).__name__}")
+            except DuplicateKeyError as e:
+                errors.append({"index": index, "code": 11000, "errmsg": str(e)})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "writeConcernErrors": []})
+        return Result(bulk_api_result={})
+
+
+class FakeDatabase:
+    def __init__(self, indexes: Optional[dict] = None):
+        self._unique = {
+            name: [[field for field, _ in spec["keys"]] for spec in specs
+                   if spec.get("unique") and not spec.get("partialFilterExpression")]
+            for name, specs in (indexes or {}).items()
+        }
+        self._collections = {}
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(name, self._unique.get(name, ()))
+        return self._collections[name]
+
+    def __getattr__(self, name: str) -> FakeCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+
+# ==================== LOADING SERVER DEFINITIONS ====================
+
+BASE_NAMESPACE = {
+    "__file__": str(SERVER_PATH),
+    "__name__": "server",
+    "asyncio": asyncio, "base64": base64, "csv": csv, "hashlib": hashlib, "io": io, "json": json,
+    "logging": logging, "os": os, "re": re, "secrets": secrets, "tempfile": tempfile, "time": time,
+    "uuid": uuid, "zlib": zlib,
+    "OrderedDict": OrderedDict, "asynccontextmanager": asynccontextmanager, "nullcontext": nullcontext,
+    "datetime": datetime, "timedelta": timedelta, "timezone": timezone, "ZoneInfo": ZoneInfo,
+    "Path": Path, "List": List, "Optional": Optional,
+    "HTTPException": HTTPException, "DuplicateKeyError": DuplicateKeyError, "BulkWriteError": BulkWriteError,
+    "ReturnDocument": ReturnDocument, "UpdateOne": UpdateOne, "ReplaceOne": ReplaceOne,
+}
+
+
+class Server(dict):
+    """Namespace of loaded server.py definitions; attributes read and write its globals"""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+
+def _target_names(node) -> list:
+    targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+    return [target.id for target in targets if isinstance(target, ast.Name)]
+
+
+def load_server(*names: str, **overrides) -> Server:
+    """Compile the named top-level definitions of server.py into a fresh namespace.
+
+    Module-level UPPER_CASE constants come along in source order, except those that
+    need something outside the namespace. `db` is a FakeDatabase with the unique
+    indexes of MONGO_INDEXES; keyword arguments add or replace globals, both before
+    the definitions are compiled and after.
+    """
+    tree = ast.parse(SERVER_PATH.read_text(encoding="utf-8"))
+    server = Server(BASE_NAMESPACE)
+    # Definitions may need them while they are compiled (decorators, defaults)
+    server.update(overrides)
+    wanted = set(names)
+    for node in tree.body:
+        if isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = _target_names(node)
+            if not (set(targets) & wanted or any(name.isupper() for name in targets)):
+                continue
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            if node.name not in wanted:
+                continue
+        else:
+            continue
+        # Annotations name pydantic models that are not loaded; keep them unevaluated
+        code = compile(ast.Module(body=[node], type_ignores=[]), str(SERVER_PATH), "exec",
+                       flags=__future__.annotations.compiler_flag, dont_inherit=True)
+        if isinstance(node, (ast.Assign, ast.AnnAssign)) and not set(_target_names(node)) & wanted:
+            try:
+                exec(code, server)
+            except (NameError, AttributeError, TypeError):
+                pass
+        else:
+            exec(code, server)
+    missing = wanted - set(server)
+    if missing:
+        raise LookupError(f"not defined at the top level of server.py: {sorted(missing)}")
+    server["db"] = FakeDatabase(server.get("MONGO_INDEXES"))
+    server.update(overrides)
+    return server
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
@@ -0,0 +1,81 @@
+"""
+Helpers for the tests that run against a live backend and its MongoDB (the same
+ones backend_test.py uses):
+    BACKEND_URL=http://localhost:8001/api MONGO_URL=mongodb://localhost:27017 DB_NAME=... pytest tests
+The `api` and `db` fixtures in conftest.py skip those tests when either is
+unreachable or requests/pymongo are not installed.
+"""
+
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from zoneinfo import ZoneInfo
+
+BACKEND_URL = os.environ.get("BACKEND_URL", "http://localhost:8001/api").rstrip("/")
+MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+DB_NAME = os.environ.get("DB_NAME", "test_database")
+LOCAL_TZ = ZoneInfo(os.environ.get("LOCAL_TIMEZONE", "Asia/Muscat"))
+
+# Test credentials (same admin account as backend_test.py)
+TEST_USERNAME = os.environ.get("TEST_USERNAME", "yasir")
+TEST_PASSWORD = os.environ.get("TEST_PASSWORD", "admin123")
+
+CONCURRENCY = 8
+
+
+def run_concurrently(calls):
+    """Fire every zero-argument call at once and return the responses in order"""
+    with ThreadPoolExecutor(max_workers=len(calls)) as pool:
+        return list(pool.map(lambda call: call(), calls))
+
+
+def make_supplier(api):
+    response = api.post(f"{BACKEND_URL}/suppliers", json={
+        "name": f"Test Supplier {uuid.uuid4().hex[:8]}",
+        "phone": "90000000",
+        "address": "Test"
+    })
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def make_customer(api, credit_limit=0.0):
+    response = api.post(f"{BACKEND_URL}/customers", json={
+        "name": f"Test Customer {uuid.uuid4().hex[:8]}",
+        "phone": "90000000",
+        "address": "Test",
+        "credit_limit": credit_limit
+    })
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def reception_item(supplier, liters=10.0, price=1.0):
+    return {
+        "supplier_id": supplier["id"],
+        "supplier_name": supplier["name"],
+        "quantity_liters": liters,
+        "price_per_liter": price,
+        "quality_test": {"fat_percentage": 3.5, "protein_percentage": 3.2, "temperature": 4.0}
+    }
+
+
+def payment_request(supplier, amount=1.0, notes=None):
+    return {
+        "payment_type": "supplier_payment",
+        "related_id": supplier["id"],
+        "related_name": supplier["name"],
+        "amount": amount,
+        "notes": notes or f"integrity test {uuid.uuid4().hex[:8]}"
+    }
+
+
+def deposit(api, amount):
+    response = api.post(f"{BACKEND_URL}/treasury/transaction", params={
+        "transaction_type": "deposit",
+        "amount": amount,
+        "source_type": "other",
+        "description": f"integrity test {uuid.uuid4().hex[:8]}"
+    })
+    assert response.status_code == 200, response.text
+    return response.json()
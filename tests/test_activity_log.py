@@ -0,0 +1,162 @@
+"""
+Write-behind activity log buffer and the monthly archive partitions.
+"""
+
+import asyncio
+import re
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from tests.harness import FakeDatabase, load_server, run
+
+
+@pytest.fixture
+def server():
+    return load_server("ActivityLogBuffer")
+
+
+def entries(count, start=0):
+    return [{"id": f"a{n}", "action": "test"} for n in range(start, start + count)]
+
+
+def test_entries_are_written_in_batches(server):
+    buffer = server.ActivityLogBuffer(batch_size=10, flush_seconds=5, max_size=100)
+    calls = []
+    insert_many = server.db.activity_logs.insert_many
+
+    async def recording(documents, **kwargs):
+        calls.append(len(documents))
+        return await insert_many(documents, **kwargs)
+
+    server.db.activity_logs.insert_many = recording
+
+    async def scenario():
+        buffer.start()
+        for entry in entries(25):
+            await buffer.add(entry)
+        await asyncio.sleep(0.05)
+        # Two full batches went out without waiting for the interval
+        assert calls == [10, 10]
+        await buffer.stop()
+
+    run(scenario())
+    assert calls == [10, 10, 5]
+    assert buffer.metrics()["written"] == 25 and buffer.metrics()["direct_writes"] == 0
+    assert len(server.db.activity_logs.documents) == 25
+
+
+def test_partial_batch_is_flushed_on_the_interval(server):
+    buffer = server.ActivityLogBuffer(batch_size=10, flush_seconds=0.05, max_size=100)
+
+    async def scenario():
+        buffer.start()
+        for entry in entries(3):
+            await buffer.add(entry)
+        await asyncio.sleep(0.2)
+        written = len(server.db.activity_logs.documents)
+        await buffer.stop()
+        return written
+
+    assert run(scenario()) == 3
+
+
+def test_entries_are_written_directly_when_stopped_or_full(server):
+    buffer = server.ActivityLogBuffer(batch_size=10, flush_seconds=5, max_size=2)
+
+    async def scenario():
+        await buffer.add(entries(1)[0])
+        assert len(server.db.activity_logs.documents) == 1
+        buffer.start()
+        for entry in entries(3, start=1):
+            await buffer.add(entry)
+        assert len(buffer.entries) == 2 and len(server.db.activity_logs.documents) == 2
+        await buffer.stop()
+
+    run(scenario())
+    assert buffer.stats["direct_writes"] == 2
+    assert sorted(doc["id"] for doc in server.db.activity_logs.documents) == ["a0", "a1", "a2", "a3"]
+
+
+def test_failed_flush_keeps_the_batch_for_the_next_one(server):
+    buffer = server.ActivityLogBuffer(batch_size=10, flush_seconds=5, max_size=100)
+    insert_many = server.db.activity_logs.insert_many
+    failures = {"left": 1}
+
+    async def flaky(documents, **kwargs):
+        if failures["left"]:
+            failures["left"] -= 1
+            raise ConnectionError("write failed")
+        return await insert_many(documents, **kwargs)
+
+    server.db.activity_logs.insert_many = flaky
+    buffer.entries = entries(4)
+
+    assert run(buffer.flush()) is False
+    assert len(buffer.entries) == 4 and buffer.stats["failed_flushes"] == 1
+    assert run(buffer.flush()) is True
+    assert len(server.db.activity_logs.documents) == 4 and buffer.stats["dropped"] == 0
+
+
+# ==================== ARCHIVE PARTITIONS ====================
+
+class ArchivedDatabase(FakeDatabase):
+    async def list_collection_names(self, filter=None):
+        pattern = filter["name"]["$regex"] if filter else ""
+        return [name for name in self._collections if re.search(pattern, name)]
+
+
+@pytest.fixture
+def archive():
+    server = load_server(
+        "activity_archive_name", "hot_activity_floor", "activity_log_partitions", "_export_cursor",
+        db=ArchivedDatabase(),
+    )
+    server.ACTIVITY_LOG_RETENTION_DAYS = 90
+    return server
+
+
+def months_ago(count):
+    moment = datetime.now(timezone.utc).replace(day=15) - timedelta(days=31 * count)
+    return moment.strftime("%Y-%m")
+
+
+def names(partitions):
+    return [collection.name for collection, _ in partitions]
+
+
+def test_archive_names_follow_the_month(archive):
+    assert archive.activity_archive_name("2025-03-31T10:00:00+00:00") == "activity_logs_2025_03"
+
+
+def test_partitions_cover_only_the_months_asked_for(archive):
+    db = archive.db
+    old, older, oldest = (archive.activity_archive_name(months_ago(n)) for n in (4, 5, 6))
+    for name in (old, older, oldest, "activity_logs_backup"):
+        db[name]
+    recent = datetime.now(timezone.utc).isoformat()
+
+    assert names(run(archive.activity_log_partitions(recent, None))) == ["activity_logs"]
+    assert names(run(archive.activity_log_partitions(None, None))) == ["activity_logs", old, older, oldest]
+    assert names(run(archive.activity_log_partitions(f"{months_ago(5)}-01", f"{months_ago(5)}-28"))) == [older]
+    bounds = dict((collection.name, bounds) for collection, bounds in run(archive.activity_log_partitions(None, None)))
+    assert bounds["activity_logs"] == {"$gte": bounds[old]["$lt"]}
+
+
+def test_export_reads_archives_then_the_hot_collection_in_order(archive):
+    db = archive.db
+    floor = archive.hot_activity_floor()
+    now = datetime.now(timezone.utc)
+    hot = (now - timedelta(days=1)).isoformat()
+    month = months_ago(4)
+    run(db[archive.activity_archive_name(month)].insert_many([
+        {"id": "b", "timestamp": f"{month}-02T00:00:00+00:00"}, {"id": "a", "timestamp": f"{month}-01T00:00:00+00:00"},
+    ]))
+    run(db.activity_logs.insert_many([{"id": "c", "timestamp": hot}, {"id": "stale", "timestamp": floor[:4] + "-01-01"}]))
+    spec = {"collection": "activity_logs", "date_field": "timestamp", "partitions": archive.activity_log_partitions}
+
+    async def scenario():
+        return [doc["id"] async for doc in archive._export_cursor(spec, {}, None, None)]
+
+    # Hot entries older than the floor are already archived and are not read twice
+    assert run(scenario()) == ["a", "b", "c"]
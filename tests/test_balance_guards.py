@@ -0,0 +1,114 @@
+"""
+Balance guards: the balance check and the $inc are one conditional update, so
+concurrent feed purchases and credit sales cannot overdraw.
+"""
+
+import asyncio
+import uuid
+
+import pytest
+
+from tests.harness import HTTPException, load_server, run
+from tests.live import BACKEND_URL, CONCURRENCY, make_customer, make_supplier, reception_item, run_concurrently
+
+
+@pytest.fixture
+def server():
+    return load_server("touch", "debit_supplier_balance", "charge_customer_credit")
+
+
+def outcomes(calls):
+    async def attempt(call):
+        try:
+            await call()
+            return 200
+        except HTTPException as e:
+            return e.status_code
+
+    async def scenario():
+        return await asyncio.gather(*(attempt(call) for call in calls))
+    return run(scenario())
+
+
+def test_concurrent_debits_never_overdraw_a_supplier(server):
+    server.db.suppliers.documents.append({"id": "s1", "balance": 10.0})
+    results = outcomes([lambda: server.debit_supplier_balance("s1", 4.0) for _ in range(CONCURRENCY)])
+    assert results.count(200) == 2 and results.count(400) == CONCURRENCY - 2
+    assert server.db.suppliers.documents[0]["balance"] == 2.0
+
+
+def test_debit_of_unknown_supplier_is_404(server):
+    assert outcomes([lambda: server.debit_supplier_balance("missing", 1.0)]) == [404]
+
+
+def test_concurrent_credit_sales_stay_within_the_limit(server):
+    server.db.customers.documents.append({"id": "c1", "credit_limit": 100.0, "balance": 0.0, "total_purchases": 0.0})
+    results = outcomes([lambda: server.charge_customer_credit("c1", 30.0) for _ in range(CONCURRENCY)])
+    assert results.count(200) == 3
+    customer = server.db.customers.documents[0]
+    assert customer["balance"] == 90.0 and customer["total_purchases"] == 90.0
+
+
+def test_zero_credit_limit_means_no_limit(server):
+    server.db.customers.documents.append({"id": "c1", "credit_limit": 0})
+    assert outcomes([lambda: server.charge_customer_credit("c1", 500.0)]) == [200]
+    assert server.db.customers.documents[0]["balance"] == 500.0
+    assert outcomes([lambda: server.charge_customer_credit("missing", 1.0)]) == [404]
+
+
+# ==================== LIVE ====================
+
+def credit_sale(api, customer, amount):
+    return api.post(f"{BACKEND_URL}/sales", json={
+        "customer_id": customer["id"],
+        "customer_name": customer["name"],
+        "quantity_liters": amount,
+        "price_per_liter": 1.0,
+        "sale_type": "credit"
+    })
+
+
+def test_credit_limit_rejects_sale_over_limit(api, db):
+    customer = make_customer(api, credit_limit=100)
+    assert credit_sale(api, customer, 60).status_code == 200
+
+    rejected = credit_sale(api, customer, 60)
+    assert rejected.status_code == 400
+    assert db.customers.find_one({"id": customer["id"]})["balance"] == pytest.approx(60)
+
+
+def test_credit_limit_holds_under_concurrent_sales(api, db):
+    customer = make_customer(api, credit_limit=100)
+    responses = run_concurrently([lambda: credit_sale(api, customer, 30) for _ in range(CONCURRENCY)])
+    accepted = [response for response in responses if response.status_code == 200]
+    assert len(accepted) == 3
+    assert all(response.status_code == 400 for response in responses if response.status_code != 200)
+
+    stored = db.customers.find_one({"id": customer["id"]})
+    assert stored["balance"] == pytest.approx(90)
+    assert db.sales.count_documents({"customer_id": customer["id"]}) == 3
+
+
+def feed_purchase(api, supplier, amount):
+    return api.post(f"{BACKEND_URL}/feed-purchases", json={
+        "supplier_id": supplier["id"],
+        "supplier_name": supplier["name"],
+        "feed_type_id": str(uuid.uuid4()),
+        "feed_type_name": "Test Feed",
+        "company_name": "Test Company",
+        "quantity": amount,
+        "price_per_unit": 1.0
+    })
+
+
+def test_supplier_balance_guard_rejects_overdraw(api, db):
+    supplier = make_supplier(api)
+    assert feed_purchase(api, supplier, 1).status_code == 400
+
+    # 10 liters at 1.0 gives the supplier a balance of 10
+    assert api.post(f"{BACKEND_URL}/milk-receptions", json=reception_item(supplier, liters=10)).status_code == 200
+    responses = run_concurrently([lambda: feed_purchase(api, supplier, 4) for _ in range(CONCURRENCY)])
+    assert sum(response.status_code == 200 for response in responses) == 2
+    assert db.suppliers.find_one({"id": supplier["id"]})["balance"] == pytest.approx(2)
+
+
@@ -0,0 +1,86 @@
+"""
+Bulk milk receptions: per-item failure isolation and retries that do not record a
+reception twice.
+"""
+
+import asyncio
+import uuid
+
+import pytest
+
+from tests.harness import load_server, run
+from tests.live import BACKEND_URL, make_supplier, reception_item
+
+
+@pytest.fixture
+def server():
+    return load_server("IdempotentRequest", "GroupCommitWriter", "totals_writer")
+
+
+def test_item_ids_are_stable_per_key_and_position(server):
+    first = server.IdempotentRequest({"key": "k1", "user_id": "u1", "lease_id": "a"})
+    retry = server.IdempotentRequest({"key": "k1", "user_id": "u1", "lease_id": "b"})
+    assert [first.item_id(i) for i in range(3)] == [retry.item_id(i) for i in range(3)]
+    assert len({first.item_id(i) for i in range(3)}) == 3
+    assert first.item_id(0) != server.IdempotentRequest({"key": "k2", "user_id": "u1"}).item_id(0)
+    assert first.item_id(0) != server.IdempotentRequest({"key": "k1", "user_id": "u2"}).item_id(0)
+    assert server.IdempotentRequest().item_id(0) is None
+
+
+def test_deferred_side_effects_are_retried_by_the_writer(server):
+    writer = server.GroupCommitWriter(0.01, 100)
+    server.GROUP_COMMIT_RETRY_SECONDS = 0.05
+    applied = []
+
+    async def write(value):
+        applied.append(value)
+
+    async def scenario():
+        writer.start()
+        writer.defer([("suppliers", write, (1,)), ("customers", write, (2,))], 0)
+        writer.defer([], 0)
+        await asyncio.sleep(0.1)
+        await writer.stop()
+
+    run(scenario())
+    assert sorted(applied) == [1, 2]
+    assert writer.unapplied == []
+
+
+# ==================== LIVE ====================
+
+def test_bulk_reception_isolates_bad_items(api, db):
+    supplier = make_supplier(api)
+    items = [
+        reception_item(supplier, liters=10),
+        {"supplier_id": supplier["id"]},  # fails validation
+        reception_item({"id": str(uuid.uuid4()), "name": "missing"}),  # unknown supplier
+        reception_item(supplier, liters=5),
+    ]
+    response = api.post(f"{BACKEND_URL}/milk-receptions/bulk", json=items)
+    assert response.status_code == 200, response.text
+    result = response.json()
+    assert result["created"] == 2
+    assert [error["index"] for error in result["errors"]] == [1, 2]
+
+    stored = db.suppliers.find_one({"id": supplier["id"]})
+    assert stored["total_supplied"] == pytest.approx(15)
+    assert stored["balance"] == pytest.approx(15)
+    assert db.milk_receptions.count_documents({"id": {"$in": result["ids"]}}) == 2
+    assert db.inventory_movements.count_documents({"source_id": {"$in": result["ids"]}}) == 2
+
+
+def test_bulk_retry_after_a_lost_response_does_not_duplicate(api, db):
+    supplier = make_supplier(api)
+    items = [reception_item(supplier, liters=10), reception_item(supplier, liters=5)]
+    key = str(uuid.uuid4())
+    first = api.post(f"{BACKEND_URL}/milk-receptions/bulk", json=items, headers={"Idempotency-Key": key})
+    assert first.status_code == 200, first.text
+
+    # As if the first attempt had failed after inserting: its claim is gone
+    db.idempotency_keys.delete_many({"key": key})
+    retry = api.post(f"{BACKEND_URL}/milk-receptions/bulk", json=items, headers={"Idempotency-Key": key})
+    assert retry.status_code == 200, retry.text
+    assert retry.json()["ids"] == first.json()["ids"]
+    assert db.milk_receptions.count_documents({"supplier_id": supplier["id"]}) == 2
+    assert db.suppliers.find_one({"id": supplier["id"]})["total_supplied"] == pytest.approx(15)
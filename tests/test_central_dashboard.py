@@ -0,0 +1,81 @@
+"""
+Central dashboard: per-center figures from grouped queries, not one query per center.
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+from tests.harness import FakeDatabase, load_server, run
+
+TODAY = "2024-03-15"
+
+
+class CountingDatabase:
+    """Count the collection lookups, i.e. the queries, made through the database"""
+
+    def __init__(self, db):
+        self.db = db
+        self.queries = 0
+
+    def __getattr__(self, name):
+        self.queries += 1
+        return getattr(self.db, name)
+
+
+@pytest.fixture
+def server():
+    router = SimpleNamespace(get=lambda *args, **kwargs: (lambda function: function))
+    return load_server(
+        "get_central_dashboard", "local_day_bounds",
+        api_router=router, Depends=lambda dependency=None: None, get_current_user=None, local_today=lambda: TODAY,
+    )
+
+
+def rollup(center_id, date, liters, sales_liters=0.0):
+    return {
+        "center_id": center_id, "date": date, "shift": "morning", "reception_liters": liters,
+        "reception_amount": liters / 2, "sales_liters": sales_liters, "sales_amount": sales_liters,
+    }
+
+
+def seed(db, centers):
+    async def scenario():
+        await db.collection_centers.insert_many([
+            {"id": f"c{n}", "name": f"center {n}", "code": f"C{n}", "is_active": True} for n in range(centers)
+        ])
+        await db.daily_rollups.insert_many([
+            rollup("c0", TODAY, 100.0, sales_liters=30.0), rollup("c0", "2024-03-02", 50.0),
+            rollup("c1", TODAY, 40.0), rollup("c1", "2024-02-28", 999.0),
+        ])
+        await db.suppliers.insert_many([
+            {"id": "s1", "center_id": "c0", "is_active": True}, {"id": "s2", "center_id": "c0", "is_active": True},
+            {"id": "s3", "center_id": "c1", "is_active": False},
+        ])
+        await db.inventory_stock.insert_many([
+            {"center_id": "c0", "product_type": "raw_milk", "quantity": 70.0},
+            {"center_id": "c0", "product_type": "cheese", "quantity": 9.0},
+        ])
+    run(scenario())
+
+
+def test_center_figures_come_from_the_month_rollups(server):
+    seed(server.db, centers=2)
+    dashboard = run(server.get_central_dashboard(current_user=None))
+    c0, c1 = dashboard["centers"]
+    assert (c0["today_milk_liters"], c0["monthly_milk_liters"], c0["current_stock"], c0["suppliers_count"]) == (100.0, 150.0, 70.0, 2)
+    assert (c1["today_milk_liters"], c1["monthly_milk_liters"], c1["current_stock"], c1["suppliers_count"]) == (40.0, 40.0, 0, 0)
+    assert dashboard["milk"] == {"today_liters": 140.0, "monthly_liters": 190.0, "current_stock": 70.0}
+    assert dashboard["sales"] == {"today_liters": 30.0, "today_amount": 30.0}
+
+
+def test_query_count_does_not_grow_with_the_centers(server):
+    counts = []
+    for centers in (2, 20):
+        server.db = FakeDatabase()
+        seed(server.db, centers)
+        server.db = CountingDatabase(server.db)
+        dashboard = run(server.get_central_dashboard(current_user=None))
+        assert len(dashboard["centers"]) == centers
+        counts.append(server.db.queries)
+    assert counts[0] == counts[1]
@@ -0,0 +1,76 @@
+"""
+Streaming CSV / NDJSON extracts of whole collections.
+"""
+
+import csv
+import gzip
+import io
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from tests.harness import HTTPException, load_server, run
+
+SOURCES = {
+    "sales": {"collection": "sales", "date_field": "sale_date", "filters": ["customer_id"],
+              "columns": ["id", "customer_id", "sale_date", "total_amount", "quality.fat", "tags"]},
+}
+
+
+@pytest.fixture
+def server():
+    router = SimpleNamespace(get=lambda *args, **kwargs: (lambda function: function))
+    server = load_server(
+        "_flatten", "_export_rows", "_export_cursor", "_gzip_stream", "export_collection",
+        api_router=router, Depends=lambda dependency=None: None, get_current_user=None, EXPORT_SOURCES=SOURCES,
+        StreamingResponse=lambda body, **kwargs: SimpleNamespace(body=body, **kwargs),
+    )
+    server.EXPORT_CHUNK_SIZE = 256
+    run(server.db.sales.insert_many([
+        {"id": f"s{n:02d}", "customer_id": "c1" if n % 2 else "c2", "sale_date": f"2024-03-{n + 1:02d}T05:00:00+00:00",
+         "total_amount": 10.0 * n, "quality": {"fat": 3.5}, "tags": ["a", "b"]}
+        for n in range(30)
+    ]))
+    return server
+
+
+def export(server, source="sales", fmt="csv", **params):
+    async def scenario():
+        response = await server.export_collection(source, fmt, current_user=None, **params)
+        return response, [chunk async for chunk in response.body]
+    return run(scenario())
+
+
+def test_csv_has_fixed_columns_and_flattened_values(server):
+    response, chunks = export(server)
+    assert response.headers["Content-Disposition"] == "attachment; filename=sales.csv"
+    assert len(chunks) > 1 and all(isinstance(chunk, bytes) for chunk in chunks)
+    rows = list(csv.DictReader(io.StringIO(b"".join(chunks).decode("utf-8"))))
+    assert [row["id"] for row in rows] == [f"s{n:02d}" for n in range(30)]
+    assert rows[1] == {"id": "s01", "customer_id": "c1", "sale_date": "2024-03-02T05:00:00+00:00",
+                       "total_amount": "10.0", "quality.fat": "3.5", "tags": '["a", "b"]'}
+
+
+def test_ndjson_filtered_by_date_and_field(server):
+    response, chunks = export(server, fmt="ndjson", customer_id="c1",
+                              start_date="2024-03-05T00:00:00+00:00", end_date="2024-03-10T23:59:59+00:00")
+    assert response.media_type == "application/x-ndjson"
+    docs = [json.loads(line) for line in b"".join(chunks).decode("utf-8").splitlines()]
+    assert [doc["id"] for doc in docs] == ["s05", "s07", "s09"]
+    assert docs[0]["quality"] == {"fat": 3.5}
+
+
+def test_gzip_wraps_the_same_body(server):
+    _, plain = export(server)
+    response, chunks = export(server, gzip=True)
+    assert response.media_type == "application/gzip"
+    assert response.headers["Content-Disposition"].endswith("sales.csv.gz")
+    assert gzip.decompress(b"".join(chunks)) == b"".join(plain)
+
+
+@pytest.mark.parametrize("source, fmt, status", [("nothing", "csv", 404), ("sales", "xlsx", 400)])
+def test_unknown_source_or_format_is_rejected(server, source, fmt, status):
+    with pytest.raises(HTTPException) as error:
+        export(server, source, fmt)
+    assert error.value.status_code == status
@@ -0,0 +1,76 @@
+"""
+Delta sync: centers pull only the catalog changes after their token.
+"""
+
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from tests.harness import HTTPException, load_server, run
+
+SYNC = ("touch", "encode_sync_token", "decode_sync_token", "get_sync_changes", "_after_cursor", "clamp_page_size")
+
+
+@pytest.fixture
+def server():
+    router = SimpleNamespace(get=lambda *args, **kwargs: (lambda function: function))
+    server = load_server(*SYNC, api_router=router, Depends=lambda dependency=None: None, get_current_user=None)
+    server.SYNC_SETTLE_SECONDS = 0
+    return server
+
+
+def stamp(minutes_ago):
+    return (datetime.now(timezone.utc) - timedelta(minutes=minutes_ago)).isoformat()
+
+
+def changes(server, since=None, collections="suppliers,customers", limit=2):
+    return run(server.get_sync_changes(since, collections, limit, current_user=None))
+
+
+def ids(result, name):
+    return [doc["id"] for doc in result["changes"][name]]
+
+
+def test_full_download_pages_through_every_document_once(server):
+    # Three suppliers share a stamp, so the token has to break the tie by id
+    run(server.db.suppliers.insert_many([{"id": f"s{n}", "updated_at": stamp(10 if n < 3 else 5)} for n in range(5)]))
+    run(server.db.customers.insert_one({"id": "c1", "updated_at": stamp(7)}))
+
+    seen, token = {"suppliers": [], "customers": []}, None
+    while True:
+        result = changes(server, token)
+        for name in seen:
+            seen[name] += ids(result, name)
+        token = result["token"]
+        if not result["has_more"]:
+            break
+    assert seen == {"suppliers": ["s0", "s1", "s2", "s3", "s4"], "customers": ["c1"]}
+    # Nothing changed since: an empty pull that keeps the positions
+    again = changes(server, token)
+    assert again["changes"] == {"suppliers": [], "customers": []} and again["token"] == token
+
+
+def test_updates_after_the_token_are_pulled_again(server):
+    db = server.db
+    run(db.suppliers.insert_many([{"id": "s1", "name": "old", "updated_at": stamp(10)}, {"id": "s2", "updated_at": stamp(9)}]))
+    token = changes(server, collections="suppliers")["token"]
+
+    run(db.suppliers.update_one({"id": "s1"}, server.touch({"$set": {"name": "new", "is_active": False}})))
+    result = changes(server, token, collections="suppliers")
+    assert result["changes"]["suppliers"] == [
+        {"id": "s1", "name": "new", "is_active": False, "updated_at": result["changes"]["suppliers"][0]["updated_at"]}
+    ]
+
+
+def test_changes_inside_the_settle_window_wait_for_the_next_pull(server):
+    server.SYNC_SETTLE_SECONDS = 60
+    run(server.db.suppliers.insert_many([{"id": "s1", "updated_at": stamp(5)}, {"id": "s2", "updated_at": stamp(0)}]))
+    assert ids(changes(server, collections="suppliers"), "suppliers") == ["s1"]
+
+
+@pytest.mark.parametrize("since, collections", [("garbage", "suppliers"), (None, "suppliers,invoices")])
+def test_bad_token_or_collection_is_400(server, since, collections):
+    with pytest.raises(HTTPException) as error:
+        changes(server, since, collections)
+    assert error.value.status_code == 400
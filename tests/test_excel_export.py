@@ -0,0 +1,73 @@
+"""
+Excel exports streamed from a cursor into a write-only workbook.
+"""
+
+import io
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from tests.harness import HTTPException, load_server, run
+
+openpyxl = pytest.importorskip("openpyxl")
+
+EXPORT = ("stream_excel_export", "_field_value", "_append_rows", "_iter_file_chunks", "_remove_export_file")
+
+
+@pytest.fixture
+def server():
+    server = load_server(
+        *EXPORT,
+        StreamingResponse=lambda body, **kwargs: SimpleNamespace(body=body, **kwargs),
+        BackgroundTask=lambda function, *args: lambda: function(*args),
+    )
+    server.EXCEL_SAMPLE_ROWS = 3
+    server.EXCEL_APPEND_BATCH_ROWS = 4
+    return server
+
+
+def export(server, documents, empty_detail=None):
+    async def scenario():
+        await server.db.rows.insert_many(documents)
+        response = await server.stream_excel_export(
+            server.db.rows.find({}, {"_id": 0}).sort("code"), {"code": "الكود", "name": "الاسم", "bank.account": "الحساب"},
+            "الموردين", "suppliers.xlsx", empty_detail
+        )
+        content = b"".join(response.body)
+        response.background()
+        return openpyxl.load_workbook(io.BytesIO(content)).active
+
+    return run(scenario())
+
+
+def test_every_row_is_written_after_the_header(server):
+    documents = [{"code": f"S{n:02d}", "name": f"supplier {n}", "bank": {"account": str(n)}} for n in range(11)]
+    sheet = export(server, documents)
+    rows = list(sheet.iter_rows(values_only=True))
+    assert rows[0] == ("الكود", "الاسم", "الحساب")
+    assert rows[1:] == [(document["code"], document["name"], document["bank"]["account"]) for document in documents]
+
+
+def test_columns_missing_from_the_sample_are_dropped(server):
+    sheet = export(server, [{"code": f"S{n}", "name": None} for n in range(5)])
+    assert next(sheet.iter_rows(values_only=True)) == ("الكود",)
+
+
+def test_rows_are_appended_off_the_event_loop(server):
+    threads = set()
+    append_rows = server._append_rows
+
+    def recording(worksheet, rows):
+        threads.add(threading.current_thread())
+        append_rows(worksheet, rows)
+
+    server._append_rows = recording
+    export(server, [{"code": f"S{n:02d}"} for n in range(10)])
+    assert threads and threading.main_thread() not in threads
+
+
+def test_empty_export_is_404_when_asked(server):
+    with pytest.raises(HTTPException) as error:
+        export(server, [], "No suppliers found")
+    assert error.value.status_code == 404
@@ -0,0 +1,61 @@
+"""
+Financial summary computed from server-side sums.
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+from tests.harness import load_server, run
+
+START, END = "2024-03-01T00:00:00+00:00", "2024-03-31T23:59:59+00:00"
+
+
+@pytest.fixture
+def server():
+    router = SimpleNamespace(get=lambda *args, **kwargs: (lambda function: function))
+    return load_server(
+        "get_financial_summary", "sum_fields", "raw_milk_stock",
+        api_router=router, Depends=lambda dependency=None: None, get_current_user=None,
+    )
+
+
+def test_summary_totals_only_count_the_period_and_approved_payments(server):
+    db = server.db
+
+    async def scenario():
+        await db.milk_receptions.insert_many([
+            {"id": "r1", "reception_date": "2024-03-02T05:00:00+00:00", "quantity_liters": 100.0, "total_amount": 50.0},
+            {"id": "r2", "reception_date": "2024-03-20T05:00:00+00:00", "quantity_liters": 60.0, "total_amount": 30.0},
+            {"id": "r3", "reception_date": "2024-04-01T05:00:00+00:00", "quantity_liters": 999.0, "total_amount": 999.0},
+        ])
+        await db.sales.insert_many([
+            {"id": "s1", "sale_date": "2024-03-05T05:00:00+00:00", "quantity_liters": 80.0, "total_amount": 64.0},
+        ])
+        await db.payments.insert_many([
+            {"id": "p1", "payment_type": "supplier_payment", "status": "approved", "payment_date": "2024-03-10T00:00:00+00:00", "amount": 40.0},
+            {"id": "p2", "payment_type": "supplier_payment", "status": "pending", "payment_date": "2024-03-10T00:00:00+00:00", "amount": 500.0},
+            {"id": "p3", "payment_type": "customer_receipt", "status": "approved", "payment_date": "2024-03-11T00:00:00+00:00", "amount": 25.0},
+        ])
+        await db.suppliers.insert_many([{"id": "a", "is_active": True, "balance": 12.5}, {"id": "b", "is_active": False, "balance": 100.0}])
+        await db.customers.insert_one({"id": "c", "is_active": True, "balance": 7.0})
+        await db.treasury.insert_one({"type": "main", "current_balance": 300.0})
+        await db.inventory_stock.insert_many([
+            {"center_id": "c1", "product_type": "raw_milk", "quantity": 20.0},
+            {"center_id": "c1", "product_type": "cheese", "quantity": 5.0},
+        ])
+        return await server.get_financial_summary(START, END, current_user=None)
+
+    summary = run(scenario())
+    assert summary["purchases"] == {"total_liters": 160.0, "total_amount": 80.0, "transactions_count": 2, "avg_price_per_liter": 0.5}
+    assert summary["sales"] == {"total_liters": 80.0, "total_amount": 64.0, "transactions_count": 1, "avg_price_per_liter": 0.8}
+    assert summary["payments"] == {"supplier_payments": 40.0, "customer_receipts": 25.0, "net_cash_flow": -15.0}
+    assert summary["profit_loss"] == {"gross_profit": -16.0, "profit_margin_percentage": -25.0}
+    assert summary["balances"] == {"treasury_balance": 300.0, "supplier_dues": 12.5, "customer_receivables": 7.0, "inventory_liters": 20.0}
+
+
+def test_empty_period_reports_zeros(server):
+    summary = run(server.get_financial_summary(START, END, current_user=None))
+    assert summary["purchases"]["avg_price_per_liter"] == 0
+    assert summary["profit_loss"] == {"gross_profit": 0, "profit_margin_percentage": 0}
+    assert summary["balances"]["treasury_balance"] == 0
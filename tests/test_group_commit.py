@@ -0,0 +1,175 @@
+"""
+Group-commit writer: batched inserts, isolated failures and side-effect retries.
+"""
+
+import asyncio
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+from tests.harness import HTTPException, load_server, run
+from tests.live import BACKEND_URL, CONCURRENCY, make_supplier, reception_item, run_concurrently
+
+GROUP_COMMIT = (
+    "GroupCommitWriter", "rollup_key", "checked_rollup_key", "reception_rollup_inc", "sale_rollup_inc",
+    "merge_inc", "touch", "stock_movement", "insert_stock_movements", "apply_stock_movements",
+    "record_stock_movements", "totals_writer", "totals_rebuild", "replace_rebuilt", "rebuild_inventory_stock",
+)
+
+
+class Reception(SimpleNamespace):
+    def model_dump(self):
+        return {**vars(self), "quality_test": vars(self.quality_test)}
+
+
+def reception(supplier_id="s1", liters=10.0, reception_id=None):
+    return Reception(
+        id=reception_id or str(uuid.uuid4()),
+        supplier_id=supplier_id,
+        center_id="c1",
+        quantity_liters=liters,
+        total_amount=liters * 0.5,
+        reception_date="2024-03-01T05:00:00+00:00",
+        quality_test=SimpleNamespace(fat_percentage=3.5, protein_percentage=3.2),
+    )
+
+
+@pytest.fixture
+def server():
+    server = load_server(*GROUP_COMMIT)
+    server.GROUP_COMMIT_RETRY_SECONDS = 0.05
+    return server
+
+
+def failing(method, times=1):
+    """Wrap a collection method so its first `times` calls raise"""
+    calls = {"left": times}
+
+    async def wrapper(*args, **kwargs):
+        if calls["left"]:
+            calls["left"] -= 1
+            raise ConnectionError("write failed")
+        return await method(*args, **kwargs)
+    return wrapper
+
+
+def supplier_totals(db):
+    return {supplier["id"]: supplier["total_supplied"] for supplier in db.suppliers.documents}
+
+
+def test_batch_inserts_once_and_coalesces_side_effects(server):
+    db = server.db
+    writer = server.GroupCommitWriter(0.01, 100)
+
+    async def scenario():
+        await db.suppliers.insert_many([{"id": "s1", "total_supplied": 0.0, "balance": 0.0}, {"id": "s2", "total_supplied": 0.0, "balance": 0.0}])
+        writer.start()
+        await asyncio.gather(*(writer.submit("reception", reception(f"s{1 + i % 2}")) for i in range(10)))
+        await writer.stop()
+
+    run(scenario())
+    assert writer.stats["batches"] == 1 and writer.stats["committed"] == 10
+    assert supplier_totals(db) == {"s1": 50.0, "s2": 50.0}
+    assert len(db.inventory_movements.documents) == 10
+    assert db.inventory_stock.documents[0]["quantity"] == 100.0
+    assert db.daily_rollups.documents[0]["reception_count"] == 10
+
+
+def test_failed_insert_only_fails_its_own_caller(server):
+    db = server.db
+    writer = server.GroupCommitWriter(0.01, 100)
+    duplicate = reception(reception_id="taken")
+
+    async def scenario():
+        await db.suppliers.insert_one({"id": "s1", "total_supplied": 0.0, "balance": 0.0})
+        await db.milk_receptions.insert_one({"id": "taken"})
+        writer.start()
+        results = await asyncio.gather(
+            writer.submit("reception", reception()), writer.submit("reception", duplicate), writer.submit("reception", reception()),
+            return_exceptions=True
+        )
+        await writer.stop()
+        return results
+
+    results = run(scenario())
+    assert results[0] is None and results[2] is None
+    assert isinstance(results[1], HTTPException) and results[1].status_code == 500
+    assert supplier_totals(db) == {"s1": 20.0}
+
+
+def test_failed_side_effect_is_retried_once_without_failing_callers(server):
+    db = server.db
+    writer = server.GroupCommitWriter(0.01, 100)
+    db.suppliers.bulk_write = failing(db.suppliers.bulk_write)
+
+    async def scenario():
+        await db.suppliers.insert_one({"id": "s1", "total_supplied": 0.0, "balance": 0.0})
+        writer.start()
+        await asyncio.gather(*(writer.submit("reception", reception()) for _ in range(3)))
+        assert supplier_totals(db) == {"s1": 0.0}
+        await asyncio.sleep(0.2)
+        await writer.stop()
+
+    run(scenario())
+    assert supplier_totals(db) == {"s1": 30.0}
+    assert db.daily_rollups.documents[0]["reception_liters"] == 30.0
+    assert writer.unapplied == []
+
+
+def test_side_effects_deferred_across_a_rebuild_are_not_counted_twice(server):
+    db = server.db
+    writer = server.GroupCommitWriter(0.01, 100)
+    # The stock $inc fails, and so does the ledger insert of the second batch
+    db.inventory_stock.bulk_write = failing(db.inventory_stock.bulk_write, times=2)
+
+    async def scenario():
+        await db.suppliers.insert_one({"id": "s1", "total_supplied": 0.0, "balance": 0.0})
+        await writer._commit([("reception", reception(liters=10.0), rollup(), asyncio.get_running_loop().create_future())])
+        db.inventory_movements.insert_many = failing(db.inventory_movements.insert_many)
+        await writer._commit([("reception", reception(liters=5.0), rollup(), asyncio.get_running_loop().create_future())])
+        assert len(writer.unapplied) == 3
+        # The rebuild sees the first movement only; the retry must add exactly the second one
+        await server.rebuild_inventory_stock()
+        await writer._drain()
+
+    def rollup():
+        return server.rollup_key("2024-03-01T05:00:00+00:00", "c1")
+
+    run(scenario())
+    assert writer.unapplied == []
+    assert len(db.inventory_movements.documents) == 2
+    assert db.inventory_stock.documents[0]["quantity"] == 15.0
+
+
+def test_stop_commits_what_is_still_queued(server):
+    db = server.db
+    writer = server.GroupCommitWriter(0.2, 100)
+
+    async def scenario():
+        await db.suppliers.insert_one({"id": "s1", "total_supplied": 0.0, "balance": 0.0})
+        writer.start()
+        pending = [asyncio.create_task(writer.submit("reception", reception())) for _ in range(4)]
+        await asyncio.sleep(0.01)
+        await writer.stop()
+        await asyncio.gather(*pending)
+
+    run(scenario())
+    assert len(db.milk_receptions.documents) == 4
+    assert supplier_totals(db) == {"s1": 40.0}
+
+
+# ==================== LIVE ====================
+
+def test_concurrent_receptions_all_apply_side_effects(api, db):
+    """With or without group commit, every accepted reception reaches the supplier totals"""
+    supplier = make_supplier(api)
+    responses = run_concurrently([
+        lambda: api.post(f"{BACKEND_URL}/milk-receptions", json=reception_item(supplier, liters=2))
+        for _ in range(CONCURRENCY)
+    ])
+    assert all(response.status_code == 200 for response in responses), [r.text for r in responses]
+
+    stored = db.suppliers.find_one({"id": supplier["id"]})
+    assert stored["total_supplied"] == pytest.approx(2 * CONCURRENCY)
+    assert db.milk_receptions.count_documents({"supplier_id": supplier["id"]}) == CONCURRENCY
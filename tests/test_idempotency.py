@@ -0,0 +1,194 @@
+"""
+Idempotency keys on money-moving POSTs: replays, conflicts, reuse with another
+body, and takeover of a claim whose lease expired.
+"""
+
+import asyncio
+import hashlib
+import uuid
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from tests.harness import HTTPException, load_server, run
+from tests.live import BACKEND_URL, CONCURRENCY, make_supplier, payment_request, run_concurrently
+
+USER = {"id": "u1"}
+
+
+@pytest.fixture
+def server():
+    return load_server(
+        "IdempotentRequest", "idempotency",
+        Header=lambda default=None, **kwargs: default, Depends=lambda dependency=None: None,
+        get_current_user=None, jsonable_encoder=lambda value: value,
+    )
+
+
+def request(body=b'{"amount": 1}'):
+    async def read():
+        return body
+    return SimpleNamespace(method="POST", url=SimpleNamespace(path="/api/payments", query=""), body=read)
+
+
+async def open_key(server, key, body=b'{"amount": 1}'):
+    """Enter the dependency; returns (handle, response, generator)"""
+    response = SimpleNamespace(headers={})
+    dependency = server.idempotency(request(body), response, key, USER)
+    return await dependency.__anext__(), response, dependency
+
+
+async def finish(dependency, error=None):
+    with pytest.raises((StopAsyncIteration, type(error)) if error else StopAsyncIteration):
+        if error:
+            await dependency.athrow(error)
+        else:
+            await dependency.__anext__()
+
+
+def test_completed_key_replays_the_stored_response(server):
+    async def scenario():
+        handle, _, dependency = await open_key(server, "k")
+        await handle.save({"id": "p1"})
+        await finish(dependency)
+        return await open_key(server, "k")
+
+    replay, response, _ = run(scenario())
+    assert replay.replay == {"id": "p1"}
+    assert response.headers["Idempotent-Replay"] == "true"
+
+
+def test_key_reused_with_another_body_is_rejected(server):
+    async def scenario():
+        handle, _, dependency = await open_key(server, "k")
+        await handle.save({"id": "p1"})
+        await finish(dependency)
+        await open_key(server, "k", body=b'{"amount": 2}')
+
+    with pytest.raises(HTTPException) as error:
+        run(scenario())
+    assert error.value.status_code == 422
+
+
+def test_concurrent_requests_with_one_key_run_the_handler_once(server):
+    async def attempt():
+        try:
+            handle, _, dependency = await open_key(server, "k")
+        except HTTPException as e:
+            return e.status_code
+        if handle.replay is not None:
+            return "replay"
+        await asyncio.sleep(0.01)
+        await handle.save({"id": "p1"})
+        await finish(dependency)
+        return "ran"
+
+    async def scenario():
+        return await asyncio.gather(*(attempt() for _ in range(CONCURRENCY)))
+
+    outcomes = run(scenario())
+    assert outcomes.count("ran") == 1
+    assert set(outcomes) <= {"ran", "replay", 409}
+
+
+def test_failed_request_releases_the_key(server):
+    async def scenario():
+        _, _, dependency = await open_key(server, "k")
+        await finish(dependency, RuntimeError("handler failed"))
+        handle, _, _ = await open_key(server, "k")
+        return handle
+
+    assert run(scenario()).claim is not None
+
+
+def test_expired_lease_is_taken_over_and_the_old_holder_cannot_save(server):
+    db = server.db
+
+    async def scenario():
+        stale, _, _ = await open_key(server, "k")
+        with pytest.raises(HTTPException) as error:
+            await open_key(server, "k")
+        assert error.value.status_code == 409
+
+        # The first holder hangs past its lease; a retry takes the claim over
+        await db.idempotency_keys.update_one({"key": "k"}, {"$set": {"locked_until": datetime.now(timezone.utc) - timedelta(seconds=1)}})
+        retry, _, dependency = await open_key(server, "k")
+        assert retry.claim["lease_id"] != stale.claim["lease_id"]
+        await stale.save({"id": "stale"})
+        await retry.save({"id": "p1"})
+        await finish(dependency)
+
+    run(scenario())
+    stored, = db.idempotency_keys.documents
+    assert stored["status"] == "completed" and stored["response"] == {"id": "p1"}
+
+
+# ==================== LIVE ====================
+
+def test_idempotent_retry_replays_stored_response(api, db):
+    supplier = make_supplier(api)
+    body = payment_request(supplier)
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+
+    first = api.post(f"{BACKEND_URL}/payments", json=body, headers=headers)
+    retry = api.post(f"{BACKEND_URL}/payments", json=body, headers=headers)
+    assert first.status_code == 200, first.text
+    assert retry.status_code == 200, retry.text
+    assert retry.headers.get("Idempotent-Replay") == "true"
+    assert retry.json()["id"] == first.json()["id"]
+    assert db.payments.count_documents({"notes": body["notes"]}) == 1
+
+    reused = api.post(f"{BACKEND_URL}/payments", json={**body, "amount": 2.0}, headers=headers)
+    assert reused.status_code == 422
+
+
+def test_concurrent_same_key_runs_handler_once(api, db):
+    supplier = make_supplier(api)
+    body = payment_request(supplier)
+    headers = {"Idempotency-Key": str(uuid.uuid4())}
+    responses = run_concurrently([
+        lambda: api.post(f"{BACKEND_URL}/payments", json=body, headers=headers)
+        for _ in range(CONCURRENCY)
+    ])
+    statuses = {response.status_code for response in responses}
+    assert statuses <= {200, 409}, [r.text for r in responses]
+    assert len({response.json()["id"] for response in responses if response.status_code == 200}) == 1
+    assert db.payments.count_documents({"notes": body["notes"]}) == 1
+
+
+def _claim(db, api, key, body, locked_until):
+    """Plant an in-progress claim the way the dependency would have stored it"""
+    import requests
+    request = requests.Request("POST", f"{BACKEND_URL}/payments", json=body).prepare()
+    path = requests.utils.urlparse(request.url).path
+    fingerprint = hashlib.sha256(f"POST {path}?\n".encode() + request.body).hexdigest()
+    me = api.get(f"{BACKEND_URL}/auth/me").json()
+    db.idempotency_keys.insert_one({
+        "key": key,
+        "user_id": me["id"],
+        "lease_id": str(uuid.uuid4()),
+        "fingerprint": fingerprint,
+        "status": "in_progress",
+        "locked_until": locked_until,
+        "created_at": datetime.now(timezone.utc)
+    })
+
+
+def test_in_progress_key_conflicts_until_its_lease_expires(api, db):
+    supplier = make_supplier(api)
+    body = payment_request(supplier)
+
+    live_key = str(uuid.uuid4())
+    _claim(db, api, live_key, body, datetime.now(timezone.utc) + timedelta(minutes=5))
+    response = api.post(f"{BACKEND_URL}/payments", json=body, headers={"Idempotency-Key": live_key})
+    assert response.status_code == 409
+
+    # A worker that died mid-request leaves an expired lease; the retry takes it over
+    expired_key = str(uuid.uuid4())
+    _claim(db, api, expired_key, body, datetime.now(timezone.utc) - timedelta(seconds=1))
+    response = api.post(f"{BACKEND_URL}/payments", json=body, headers={"Idempotency-Key": expired_key})
+    assert response.status_code == 200, response.text
+    assert db.idempotency_keys.find_one({"key": expired_key})["status"] == "completed"
+
+
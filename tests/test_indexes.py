@@ -0,0 +1,88 @@
+"""
+Startup reconciliation of the MONGO_INDEXES registry against the indexes that exist.
+"""
+
+import pytest
+
+from tests.harness import load_server, run
+
+REGISTRY = {
+    "suppliers": [
+        {"keys": [("id", 1)], "name": "id_unique", "unique": True},
+        {"keys": [("name", 1)], "name": "name"},
+    ],
+    "sessions": [
+        {"keys": [("created_at", 1)], "name": "created_at_ttl", "expireAfterSeconds": 3600},
+    ],
+}
+
+
+class IndexedCollection:
+    """Just the index management of a collection"""
+
+    def __init__(self, name):
+        self.name = name
+        self.indexes = {"_id_": {"name": "_id_", "key": {"_id": 1}}}
+        self.fail_names = set()
+
+    async def list_indexes(self):
+        for index in list(self.indexes.values()):
+            yield index
+
+    async def create_index(self, keys, name, **options):
+        if name in self.fail_names:
+            raise RuntimeError("E11000 duplicate key error")
+        self.indexes[name] = {"name": name, "key": dict(keys), **options}
+
+    async def drop_index(self, name):
+        del self.indexes[name]
+
+
+class IndexedDatabase(dict):
+    def __missing__(self, name):
+        self[name] = IndexedCollection(name)
+        return self[name]
+
+
+@pytest.fixture
+def server():
+    return load_server("index_definition", "ensure_indexes", MONGO_INDEXES=REGISTRY, db=IndexedDatabase())
+
+
+def test_missing_indexes_are_created_once(server):
+    first = run(server.ensure_indexes())
+    assert sorted(first["created"]) == ["sessions.created_at_ttl", "suppliers.id_unique", "suppliers.name"]
+    assert server.db["sessions"].indexes["created_at_ttl"]["expireAfterSeconds"] == 3600
+    assert run(server.ensure_indexes()) == {"created": [], "replaced": [], "failed": []}
+
+
+def test_index_with_the_same_keys_under_another_name_is_replaced(server):
+    suppliers = server.db["suppliers"]
+    suppliers.indexes["name_1"] = {"name": "name_1", "key": {"name": 1}}
+    # Registered name, changed definition
+    suppliers.indexes["id_unique"] = {"name": "id_unique", "key": {"id": 1}}
+
+    report = run(server.ensure_indexes())
+    assert sorted(report["replaced"]) == ["suppliers.id_unique", "suppliers.name"]
+    assert set(suppliers.indexes) == {"_id_", "id_unique", "name"}
+    assert suppliers.indexes["id_unique"]["unique"] is True
+
+
+def test_failed_build_puts_back_the_index_it_dropped(server):
+    suppliers = server.db["suppliers"]
+    suppliers.indexes["id_1"] = {"name": "id_1", "key": {"id": 1}}
+    suppliers.fail_names.add("id_unique")
+
+    report = run(server.ensure_indexes())
+    assert [failure["index"] for failure in report["failed"]] == ["id_unique"]
+    assert "id_1" in suppliers.indexes and "id_unique" not in suppliers.indexes
+
+
+def test_registry_names_are_unique_and_options_known():
+    registry = load_server("index_definition").MONGO_INDEXES
+    assert registry
+    for collection, specs in registry.items():
+        names = [spec["name"] for spec in specs]
+        assert len(names) == len(set(names)), collection
+        for spec in specs:
+            assert set(spec) <= {"keys", "name", "unique", "expireAfterSeconds", "partialFilterExpression"}, spec
@@ -0,0 +1,81 @@
+"""
+Inventory ledger: the one-time opening balance, per-center stock and snapshots.
+"""
+
+import asyncio
+
+import pytest
+
+from tests.harness import load_server, run
+
+LEDGER = (
+    "stock_movement", "record_stock_movements", "insert_stock_movements", "apply_stock_movements",
+    "seed_inventory_ledger", "totals_writer", "take_inventory_snapshots", "stock_at", "sum_fields",
+    "utc_timestamp", "local_today", "local_day_bounds",
+)
+
+
+@pytest.fixture
+def server():
+    return load_server(*LEDGER)
+
+
+def test_workers_seeding_together_book_the_opening_balance_once(server):
+    db = server.db
+
+    async def scenario():
+        await db.inventory.insert_one({"product_type": "raw_milk", "quantity_liters": 500.0})
+        await asyncio.gather(*(server.seed_inventory_ledger() for _ in range(4)))
+        # A restart finds the ledger opened already
+        await server.seed_inventory_ledger()
+
+    run(scenario())
+    assert [movement["id"] for movement in db.inventory_movements.documents] == ["opening_balance:raw_milk"]
+    assert [stock["quantity"] for stock in db.inventory_stock.documents] == [500.0]
+    assert db.totals_writers.documents == []
+
+
+def test_movements_are_kept_per_center(server):
+    db = server.db
+
+    async def scenario():
+        await server.record_stock_movements([
+            server.stock_movement("c1", 100.0, "reception"), server.stock_movement("c2", 40.0, "reception"),
+            server.stock_movement("c1", -30.0, "sale"),
+        ])
+
+    run(scenario())
+    assert {stock["center_id"]: stock["quantity"] for stock in db.inventory_stock.documents} == {"c1": 70.0, "c2": 40.0}
+
+
+def test_retried_insert_applies_only_the_new_movements(server):
+    first = server.stock_movement("c1", 10.0, "reception", "r1")
+    second = server.stock_movement("c1", 5.0, "reception", "r2")
+
+    async def scenario():
+        await server.insert_stock_movements([first])
+        return await server.insert_stock_movements([first, second])
+
+    assert [movement["id"] for movement in run(scenario())] == [second["id"]]
+
+
+def test_stock_at_replays_the_tail_after_the_latest_snapshot(server):
+    db = server.db
+
+    async def scenario():
+        await server.record_stock_movements([
+            server.stock_movement("c1", 100.0, "reception", ts="2024-03-01T05:00:00+00:00"),
+            server.stock_movement("c1", -20.0, "sale", ts="2024-03-02T05:00:00+00:00"),
+            server.stock_movement("c1", 7.0, "reception", ts="2024-03-03T05:00:00+00:00"),
+        ])
+        assert await server.take_inventory_snapshots("2024-03-02T00:00:00+00:00") == {
+            "as_of": "2024-03-02T00:00:00+00:00", "snapshots": 1
+        }
+        # Movements before the snapshot no longer need replaying
+        await db.inventory_movements.delete_many({"ts": {"$lt": "2024-03-02T00:00:00+00:00"}})
+        return (
+            await server.stock_at("c1", "raw_milk", "2024-03-02T12:00:00Z"),
+            await server.stock_at("c1", "raw_milk", "2024-03-04T00:00:00+00:00"),
+        )
+
+    assert run(scenario()) == (80.0, 87.0)
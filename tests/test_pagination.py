@@ -0,0 +1,68 @@
+"""
+Keyset pagination: every row exactly once across pages, whatever the sort values.
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+from tests.harness import HTTPException, load_server, run
+
+PAGINATION = ("encode_cursor", "decode_cursor", "_after_cursor", "paginate", "clamp_page_size", "fetch_page", "finish_page")
+
+
+@pytest.fixture
+def server():
+    return load_server(*PAGINATION)
+
+
+def all_pages(server, collection, sort_field, direction, page_size=3):
+    async def scenario():
+        ids, cursor = [], None
+        while True:
+            response = SimpleNamespace(headers={})
+            page = await server.paginate(response, collection, {}, sort_field, direction, page_size, cursor)
+            assert len(page) <= page_size
+            ids += [doc["id"] for doc in page]
+            cursor = response.headers.get("X-Next-Cursor")
+            if cursor is None:
+                return ids
+    return run(scenario())
+
+
+@pytest.mark.parametrize("direction", [1, -1])
+def test_pages_cover_ties_and_nulls_exactly_once(server, direction):
+    collection = server.db.rows
+    dates = ["2024-03-01", "2024-03-01", "2024-03-01", None, "2024-03-02", None, "2024-02-28", "2024-03-01"]
+    run(collection.insert_many([{"id": f"r{n}", "date": date} for n, date in enumerate(dates)]))
+
+    ids = all_pages(server, collection, "date", direction)
+    expected = sorted(collection.documents, key=lambda doc: (doc["date"] is not None, doc["date"] or "", doc["id"]))
+    if direction < 0:
+        expected.reverse()
+    assert ids == [doc["id"] for doc in expected]
+
+
+def test_id_sort_pages_by_id_alone(server):
+    collection = server.db.rows
+    run(collection.insert_many([{"id": f"r{n:02d}"} for n in range(7)]))
+    assert all_pages(server, collection, "id", -1) == [f"r{n:02d}" for n in reversed(range(7))]
+
+
+def test_last_page_has_no_cursor_and_page_size_is_clamped(server):
+    collection = server.db.rows
+    run(collection.insert_many([{"id": f"r{n}"} for n in range(3)]))
+    response = SimpleNamespace(headers={})
+    assert len(run(server.paginate(response, collection, {}, page_size=0))) == 1
+    assert server.clamp_page_size(10 ** 6) == server.MAX_PAGE_SIZE
+    response = SimpleNamespace(headers={})
+    run(server.paginate(response, collection, {}, page_size=3))
+    assert "X-Next-Cursor" not in response.headers
+
+
+def test_cursor_round_trips_and_rejects_garbage(server):
+    assert server.decode_cursor(server.encode_cursor("2024-03-01", "r1")) == ("2024-03-01", "r1")
+    assert server.decode_cursor(server.encode_cursor(None, "r1")) == (None, "r1")
+    with pytest.raises(HTTPException) as error:
+        server.decode_cursor("not a cursor")
+    assert error.value.status_code == 400
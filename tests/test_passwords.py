@@ -0,0 +1,81 @@
+"""
+Password hashing on a bounded thread pool instead of the event loop.
+"""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from tests.harness import load_server, run
+
+PASSWORDS = (
+    "password_executor", "password_slots", "password_stats", "_run_password_job", "hash_password",
+    "verify_password", "password_needs_rehash",
+)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setenv("BCRYPT_MAX_CONCURRENCY", "2")
+    server = load_server(*PASSWORDS, ThreadPoolExecutor=ThreadPoolExecutor)
+    yield server
+    server.password_executor.shutdown()
+
+
+def slow_hash(record):
+    """Stand-in for bcrypt: blocks its thread for a while and records the concurrency"""
+    lock = threading.Lock()
+    state = {"running": 0}
+
+    def hash_sync(password):
+        with lock:
+            state["running"] += 1
+            record["peak"] = max(record.get("peak", 0), state["running"])
+            record.setdefault("threads", set()).add(threading.current_thread().name)
+        time.sleep(0.05)
+        with lock:
+            state["running"] -= 1
+        return f"hashed:{password}"
+    return hash_sync
+
+
+def test_hashing_runs_on_the_pool_and_the_loop_stays_free(server):
+    record = {}
+    server._hash_password_sync = slow_hash(record)
+
+    async def ticker(ticks):
+        while True:
+            ticks.append(1)
+            await asyncio.sleep(0.005)
+
+    async def scenario():
+        ticks = []
+        task = asyncio.create_task(ticker(ticks))
+        hashes = await asyncio.gather(*(server.hash_password(f"p{n}") for n in range(6)))
+        task.cancel()
+        return hashes, ticks
+
+    hashes, ticks = run(scenario())
+    assert hashes == [f"hashed:p{n}" for n in range(6)]
+    # Six jobs of 50 ms, two at a time: the loop ticked throughout
+    assert len(ticks) > 10
+    assert record["peak"] == 2
+    assert all(name.startswith("bcrypt") for name in record["threads"])
+    assert server.password_stats == {"in_flight": 0, "queued": 0, "completed": 6, "rehashed": 0}
+
+
+def test_verify_goes_through_the_same_pool(server):
+    record = {}
+    server._verify_password_sync = lambda plain, hashed: (record.setdefault("thread", threading.current_thread().name), plain == hashed)[1]
+    assert run(server.verify_password("secret", "secret")) is True
+    assert record["thread"].startswith("bcrypt")
+
+
+def test_rehash_is_needed_only_for_another_cost_factor(server):
+    server.BCRYPT_ROUNDS = 12
+    assert not server.password_needs_rehash("$2b$12$" + "x" * 53)
+    assert server.password_needs_rehash("$2b$10$" + "x" * 53)
+    assert not server.password_needs_rehash("not a bcrypt hash")
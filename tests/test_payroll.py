@@ -0,0 +1,119 @@
+"""
+Payroll from grouped attendance counts, and incremental recalculation of the
+employees whose inputs changed.
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+from tests.harness import load_server, run
+
+pydantic = pytest.importorskip("pydantic")
+
+PAYROLL = (
+    "PayrollRecord", "attendance_status_groups", "index_status_groups", "build_payroll_record",
+    "calculate_payroll", "recalculate_payroll", "mark_payroll_dirty",
+)
+USER = {"id": "u1", "full_name": "Admin"}
+PERIOD = {"id": "p1", "name": "March", "start_date": "2024-03-01", "end_date": "2024-03-30"}
+
+
+@pytest.fixture
+def server():
+    async def log_activity(**kwargs):
+        pass
+
+    router = SimpleNamespace(post=lambda *args, **kwargs: (lambda function: function))
+    server = load_server(
+        *PAYROLL,
+        BaseModel=pydantic.BaseModel, Field=pydantic.Field, ConfigDict=pydantic.ConfigDict,
+        api_router=router, Depends=lambda dependency=None: None, get_current_user=None, log_activity=log_activity,
+    )
+    server.PayrollRecord.model_rebuild(_types_namespace=dict(server))
+    run(server.db.payroll_periods.insert_one(dict(PERIOD)))
+    return server
+
+
+def attendance(employee_id, employee_name, statuses, first_day=1):
+    return [
+        {"id": f"{employee_name}-{day}", "employee_id": employee_id, "employee_name": employee_name,
+         "date": f"2024-03-{day:02d}", "status": status}
+        for day, status in enumerate(statuses, start=first_day)
+    ]
+
+
+def seed(server):
+    db = server.db
+
+    async def scenario():
+        await db.hr_employees.insert_many([
+            {"id": "e1", "name": "Ali", "salary": 300.0, "is_active": True},
+            {"id": "e2", "name": "Huda", "salary": 600.0, "is_active": True},
+            {"id": "e3", "name": "Gone", "salary": 900.0, "is_active": False},
+        ])
+        await db.hr_attendance.insert_many(
+            attendance("e1", "Ali", ["present"] * 20 + ["sick_leave", "absent", "unknown"])
+            # Imported device rows carry only the name
+            + attendance(None, "Huda", ["present"] * 10 + ["unpaid_leave"] * 2)
+            # Outside the period
+            + [{"id": "late", "employee_id": "e1", "employee_name": "Ali", "date": "2024-04-01", "status": "present"}]
+        )
+    run(scenario())
+
+
+def records(server):
+    return {record["employee_id"]: record for record in server.db.payroll_records.documents}
+
+
+def test_payroll_is_built_from_grouped_attendance(server):
+    seed(server)
+    assert run(server.calculate_payroll("p1", USER))["records_count"] == 2
+    ali, huda = records(server)["e1"], records(server)["e2"]
+    assert (ali["working_days"], ali["sick_leave"], ali["absent_days"], ali["total_pay_days"]) == (20, 1, 1, 21)
+    assert (ali["gross_salary"], ali["deductions"], ali["net_salary"]) == (210.0, 10.0, 200.0)
+    assert (huda["working_days"], huda["unpaid_leave"], huda["net_salary"]) == (10, 2, 160.0)
+
+
+def test_attendance_matching_by_id_and_name_is_counted_once(server):
+    groups = [{"_id": {"employee_id": "e1", "employee_name": "Ali", "status": "present"}, "count": 5}]
+    by_id, by_name = server.index_status_groups(groups)
+    record = server.build_payroll_record("p1", {"id": "e1", "name": "Ali", "salary": 300.0}, groups, by_id, by_name)
+    assert record["working_days"] == 5
+
+
+def test_incremental_recalculation_touches_only_dirty_employees(server):
+    seed(server)
+    db = server.db
+    run(server.calculate_payroll("p1", USER))
+    record_ids = {employee_id: record["id"] for employee_id, record in records(server).items()}
+
+    async def change():
+        await db.hr_attendance.insert_many(attendance("e1", "Ali", ["present"] * 3, first_day=24))
+        # Edited behind the dirty tracking: incremental mode must not notice
+        await db.hr_employees.update_one({"id": "e2"}, {"$set": {"salary": 1200.0}})
+        await server.mark_payroll_dirty("e1", None, reason="attendance")
+        return await server.recalculate_payroll("p1", "incremental", USER)
+
+    result = run(change())
+    assert (result["recalculated"], result["removed"]) == (1, 0)
+    assert records(server)["e1"]["working_days"] == 23
+    assert records(server)["e2"]["net_salary"] == 160.0
+    assert {employee_id: record["id"] for employee_id, record in records(server).items()} == record_ids
+
+    run(server.recalculate_payroll("p1", "full", USER))
+    assert records(server)["e2"]["net_salary"] == 320.0
+
+
+def test_deactivated_employee_is_removed_incrementally(server):
+    seed(server)
+    db = server.db
+    run(server.calculate_payroll("p1", USER))
+
+    async def deactivate():
+        await db.hr_employees.update_one({"id": "e2"}, {"$set": {"is_active": False}})
+        await server.mark_payroll_dirty("e2", reason="employee")
+        return await server.recalculate_payroll("p1", "incremental", USER)
+
+    assert run(deactivate())["removed"] == 1
+    assert set(records(server)) == {"e1"}
@@ -0,0 +1,45 @@
+"""
+PDF rendering in a process pool: renderers get plain data and return bytes.
+"""
+
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from tests.harness import HTTPException, SERVER_PATH, load_server, run
+
+pytest.importorskip("reportlab")
+pytest.importorskip("arabic_reshaper")
+pytest.importorskip("bidi")
+sys.path.insert(0, str(SERVER_PATH.parent))
+import pdf_renderer  # noqa: E402
+
+SUPPLIERS = [{"code": "S1", "name": "Ali", "phone": "9000", "balance": 12.5, "total_supplied": 300.0, "center_name": "Main"}]
+
+
+@pytest.fixture
+def server():
+    server = load_server(
+        "pdf_executor", "pdf_stats", "get_pdf_executor", "render_pdf",
+        ProcessPoolExecutor=ProcessPoolExecutor, multiprocessing=multiprocessing, pdf_renderer=pdf_renderer, PDF_WORKERS=1,
+    )
+    yield server
+    if server.pdf_executor is not None:
+        server.pdf_executor.shutdown()
+
+
+def test_report_is_rendered_in_a_worker_process(server):
+    pdf = run(server.render_pdf(pdf_renderer.render_suppliers_report, SUPPLIERS, "2024-03-01"))
+    assert pdf.startswith(b"%PDF")
+    assert server.pdf_stats == {"in_flight": 0, "rendered": 1, "failed": 0}
+    # Spawned once, then reused
+    assert server.get_pdf_executor() is server.get_pdf_executor()
+
+
+def test_failed_render_is_a_500(server):
+    with pytest.raises(HTTPException) as error:
+        run(server.render_pdf(pdf_renderer.render_suppliers_report, [{"balance": "not a number"}], "2024-03-01"))
+    assert error.value.status_code == 500
+    assert server.pdf_stats == {"in_flight": 0, "rendered": 0, "failed": 1}
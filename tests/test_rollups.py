@@ -0,0 +1,108 @@
+"""
+Daily rollups and the rebuild gate that keeps rebuilt totals exact while live
+writes keep $inc'ing them.
+"""
+
+import asyncio
+
+import pytest
+
+from tests.harness import HTTPException, load_server, run
+
+REBUILD = (
+    "rollup_key", "checked_rollup_key", "totals_writer", "totals_rebuild", "replace_rebuilt",
+    "stock_movement", "record_stock_movements", "insert_stock_movements", "apply_stock_movements",
+    "rebuild_inventory_stock",
+)
+
+
+@pytest.fixture
+def server():
+    return load_server(*REBUILD)
+
+
+def test_rollup_key_splits_local_days_into_shifts(server):
+    # Muscat is UTC+4: 07:59Z is 11:59 local, 08:00Z is noon
+    assert server.rollup_key("2024-03-01T07:59:00+00:00", "c1") == {"center_id": "c1", "date": "2024-03-01", "shift": "morning"}
+    assert server.rollup_key("2024-03-01T08:00:00+00:00", "c1")["shift"] == "evening"
+    assert server.rollup_key("2024-03-01T21:00:00+00:00", None)["date"] == "2024-03-02"
+
+
+def test_checked_rollup_key_rejects_bad_dates_before_any_write(server):
+    with pytest.raises(HTTPException) as error:
+        server.checked_rollup_key("01/03/2024", "c1")
+    assert error.value.status_code == 400
+
+
+def test_rebuild_during_live_writes_matches_the_ledger(server):
+    db = server.db
+
+    async def writer(n):
+        for i in range(20):
+            async with server.totals_writer():
+                await server.record_stock_movements([server.stock_movement(f"c{n % 3}", 1.0 + i, "reception", f"r{n}-{i}")])
+            await asyncio.sleep(0)
+
+    async def rebuild():
+        await asyncio.sleep(0.01)
+        await server.rebuild_inventory_stock()
+
+    async def scenario():
+        # Stale totals the rebuild has to correct
+        await db.inventory_stock.insert_one({"center_id": "c0", "product_type": "raw_milk", "quantity": 999.0, "updated_at": ""})
+        await asyncio.gather(*(writer(n) for n in range(6)), rebuild())
+
+    server.TOTALS_WRITER_WAIT_SECONDS = 5
+    run(scenario())
+    expected = {}
+    for movement in db.inventory_movements.documents:
+        expected[movement["center_id"]] = expected.get(movement["center_id"], 0) + movement["quantity"]
+    assert {stock["center_id"]: stock["quantity"] for stock in db.inventory_stock.documents} == pytest.approx(expected)
+    assert db.totals_writers.documents == []
+
+
+def test_writers_wait_for_a_running_rebuild(server):
+    server.TOTALS_WRITER_WAIT_SECONDS = 5
+    order = []
+
+    async def rebuild():
+        async with server.totals_rebuild():
+            order.append("rebuild started")
+            await asyncio.sleep(0.3)
+            order.append("rebuild finished")
+
+    async def write():
+        await asyncio.sleep(0.05)
+        async with server.totals_writer() as generation:
+            order.append(f"write under generation {generation}")
+
+    async def scenario():
+        await asyncio.gather(rebuild(), write())
+
+    run(scenario())
+    assert order == ["rebuild started", "rebuild finished", "write under generation 1"]
+
+
+def test_writer_gives_up_with_503_while_the_gate_stays_closed(server):
+    server.TOTALS_WRITER_WAIT_SECONDS = 0.3
+
+    async def scenario():
+        async with server.totals_rebuild():
+            async with server.totals_writer():
+                pass
+
+    with pytest.raises(HTTPException) as error:
+        run(scenario())
+    assert error.value.status_code == 503
+    assert server.db.totals_writers.documents == []
+
+
+def test_second_rebuild_conflicts_while_one_is_running(server):
+    async def scenario():
+        async with server.totals_rebuild():
+            async with server.totals_rebuild():
+                pass
+
+    with pytest.raises(HTTPException) as error:
+        run(scenario())
+    assert error.value.status_code == 409
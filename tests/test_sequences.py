@@ -0,0 +1,60 @@
+"""
+Document numbering from atomic per-(prefix, year) counters.
+"""
+
+import asyncio
+
+from tests.harness import load_server, run
+
+SEQUENCES = ("sequence_blocks", "sequence_locks", "seeded_sequences", "_seed_sequence", "_reserve_sequence", "next_sequence")
+
+
+def worker(db=None, block_size=1):
+    """One server process; workers given the same db share its counters"""
+    server = load_server(*SEQUENCES)
+    server.SEQUENCE_BLOCK_SIZE = block_size
+    if db is not None:
+        server.db = db
+    return server
+
+
+def numbers(server, prefix, count, year=None):
+    async def scenario():
+        return await asyncio.gather(*(server.next_sequence(prefix, year) for _ in range(count)))
+    return run(scenario())
+
+
+def test_concurrent_numbers_are_unique_and_gap_free():
+    assert sorted(numbers(worker(), "FP", 50, 2024)) == list(range(1, 51))
+
+
+def test_counter_is_seeded_numerically_from_issued_numbers():
+    server = worker()
+    run(server.db.hr_employees.insert_many([
+        {"id": "a", "employee_code": "EMP9999"}, {"id": "b", "employee_code": "EMP10000"},
+        {"id": "c", "employee_code": "EMP-legacy"},
+    ]))
+    assert numbers(server, "EMP", 2) == [10001, 10002]
+
+
+def test_years_are_numbered_separately():
+    server = worker()
+    run(server.db.feed_purchases.insert_one({"id": "a", "invoice_number": "FP-2023-0041"}))
+    assert numbers(server, "FP", 1, 2023) == [42]
+    assert numbers(server, "FP", 1, 2024) == [1]
+
+
+def test_workers_with_blocks_never_hand_out_the_same_number():
+    first = worker(block_size=10)
+    second = worker(first.db, block_size=10)
+
+    async def scenario():
+        return await asyncio.gather(
+            *(first.next_sequence("INC", 2024) for _ in range(15)),
+            *(second.next_sequence("INC", 2024) for _ in range(15)),
+        )
+
+    issued = run(scenario())
+    assert len(set(issued)) == 30
+    # Four blocks of ten were reserved between them
+    assert first.db.counters.documents[0]["seq"] == 40
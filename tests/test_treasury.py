@@ -0,0 +1,190 @@
+"""
+Daily treasury closings: late postings on a closed day, balances across page
+boundaries, and edits that move the closings forward.
+"""
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from tests.harness import HTTPException, load_server, run
+from tests.live import BACKEND_URL, LOCAL_TZ, deposit
+
+TREASURY = (
+    "treasury_closing_lock", "signed_amount", "close_treasury_days", "_close_pending_days",
+    "settle_late_treasury_transactions", "shift_treasury_closings", "treasury_balance_at",
+    "get_treasury_transactions", "encode_cursor", "decode_cursor", "_after_cursor", "paginate",
+    "clamp_page_size", "fetch_page", "finish_page", "local_today", "local_date", "local_day_bounds",
+    "apply_treasury_delta",
+)
+
+# Noon in Muscat on 2024-03-01 and 2024-03-02
+DAY_ONE = "2024-03-01T08:00:00+00:00"
+DAY_TWO = "2024-03-02T08:00:00+00:00"
+
+
+@pytest.fixture
+def server():
+    router = SimpleNamespace(get=lambda *args, **kwargs: (lambda function: function))
+    return load_server(*TREASURY, api_router=router, Depends=lambda dependency=None: None, get_current_user=None)
+
+
+def transaction(transaction_id, amount, created_at=DAY_ONE, transaction_type="deposit"):
+    return {
+        "id": transaction_id, "transaction_type": transaction_type, "amount": amount,
+        "created_at": created_at, "closing_pending": True,
+    }
+
+
+def closings_by_date(db):
+    return {closing["date"]: closing for closing in db.treasury_daily_closings.documents}
+
+
+def test_closing_run_writes_every_day_with_running_balances(server):
+    db = server.db
+
+    async def scenario():
+        await db.treasury_transactions.insert_many([
+            transaction("t1", 100), transaction("t2", 30, transaction_type="withdrawal"), transaction("t3", 50, DAY_TWO),
+        ])
+        return await server.close_treasury_days("2024-03-03")
+
+    assert run(scenario()) == {"closed": 3, "through": "2024-03-03"}
+    closings = closings_by_date(db)
+    assert (closings["2024-03-01"]["closing"], closings["2024-03-02"]["closing"], closings["2024-03-03"]["closing"]) == (70, 120, 120)
+    assert closings["2024-03-02"]["opening"] == 70
+    assert closings["2024-03-01"]["transactions_count"] == 2
+    assert not any(row.get("closing_pending") for row in db.treasury_transactions.documents)
+
+
+def test_posting_that_lands_after_its_day_was_closed_shifts_the_closings(server):
+    db = server.db
+
+    async def scenario():
+        await db.treasury_transactions.insert_one(transaction("t1", 100))
+        await server.close_treasury_days("2024-03-02")
+        # Stamped on the first day, inserted after it was closed
+        await db.treasury_transactions.insert_one(transaction("late", 40))
+        async with server.treasury_closing_lock():
+            assert await server.settle_late_treasury_transactions({"id": "late"}) == 1
+            assert await server.settle_late_treasury_transactions({"id": "late"}) == 0
+
+    run(scenario())
+    closings = closings_by_date(db)
+    assert closings["2024-03-01"]["deposits"] == 140 and closings["2024-03-01"]["transactions_count"] == 2
+    assert closings["2024-03-02"]["opening"] == 140 and closings["2024-03-02"]["closing"] == 140
+
+
+def test_postings_racing_a_closing_run_are_each_counted_once(server):
+    db = server.db
+
+    async def post(n):
+        await asyncio.sleep(0.001 * n)
+        await db.treasury_transactions.insert_one(transaction(f"t{n}", 10.0 + n))
+        async with server.treasury_closing_lock():
+            await server.settle_late_treasury_transactions({"id": f"t{n}"})
+
+    async def scenario():
+        await asyncio.gather(server.close_treasury_days("2024-03-01"), *(post(n) for n in range(20)))
+        # Whatever the poster could not settle, the next run does
+        await server.close_treasury_days("2024-03-01")
+
+    server.TREASURY_LOCK_WAIT_SECONDS = 30
+    run(scenario())
+    closing = closings_by_date(db)["2024-03-01"]
+    assert closing["deposits"] == pytest.approx(sum(10.0 + n for n in range(20)))
+    assert closing["transactions_count"] == 20
+
+
+def test_balance_seed_breaks_timestamp_ties_by_id(server):
+    db = server.db
+    response = SimpleNamespace(headers={})
+
+    async def scenario():
+        await db.treasury_transactions.insert_many([transaction(f"t{n}", 10.0 * (n + 1), DAY_ONE) for n in range(4)])
+        # t3 and t2 fill the first page, t1 and t0 the second
+        first = await server.get_treasury_transactions(response, page_size=2, current_user=None)
+        second = await server.get_treasury_transactions(
+            SimpleNamespace(headers={}), page_size=2, cursor=response.headers["X-Next-Cursor"], current_user=None
+        )
+        return first + second
+
+    rows = run(scenario())
+    assert [row["id"] for row in rows] == ["t3", "t2", "t1", "t0"]
+    assert [row["balance_after"] for row in rows] == [100.0, 60.0, 30.0, 10.0]
+    assert not any("closing_pending" in row for row in rows)
+
+
+def test_guarded_withdrawal_is_refused_without_funds(server):
+    async def scenario():
+        await server.apply_treasury_delta(50.0, deposits_delta=50.0)
+        await server.apply_treasury_delta(-80.0, withdrawals_delta=80.0, require_funds=True)
+
+    with pytest.raises(HTTPException) as error:
+        run(scenario())
+    assert error.value.status_code == 400
+    treasury, = server.db.treasury.documents
+    assert (treasury["current_balance"], treasury["total_withdrawals"]) == (50.0, 0)
+
+
+def test_concurrent_guarded_withdrawals_never_overdraw(server):
+    async def withdraw():
+        try:
+            await server.apply_treasury_delta(-30.0, withdrawals_delta=30.0, require_funds=True)
+            return True
+        except HTTPException:
+            return False
+
+    async def scenario():
+        await server.apply_treasury_delta(100.0, deposits_delta=100.0)
+        return await asyncio.gather(*(withdraw() for _ in range(10)))
+
+    assert sum(run(scenario())) == 3
+    assert server.db.treasury.documents[0]["current_balance"] == 10.0
+
+
+# ==================== LIVE ====================
+
+def test_editing_past_transaction_moves_closings_forward(api, db):
+    # Post through the API so the treasury totals stay consistent, then move the
+    # transaction two local days back and rebuild the closings from that day on
+    posted = deposit(api, 100)
+    day = (datetime.now(LOCAL_TZ) - timedelta(days=2)).date()
+    moment = datetime.combine(day, datetime.min.time(), LOCAL_TZ) + timedelta(hours=12)
+    created_at = moment.astimezone(timezone.utc).isoformat()
+    end_of_day = (moment + timedelta(hours=11, minutes=59)).astimezone(timezone.utc).isoformat()
+    db.treasury_transactions.update_one({"id": posted["id"]}, {"$set": {"created_at": created_at}})
+    db.treasury_daily_closings.delete_many({"date": {"$gte": day.isoformat()}})
+    assert api.post(f"{BACKEND_URL}/treasury/closings/run").status_code == 200
+
+    before = closings_by_date_live(db)
+    balance_before = api.get(f"{BACKEND_URL}/treasury/balance-at", params={"at": end_of_day}).json()["balance"]
+    assert balance_before == pytest.approx(before[day.isoformat()]["closing"])
+    affected = sorted(date for date in before if date >= day.isoformat())
+    assert affected[0] == day.isoformat() and len(affected) == 2
+
+    response = api.put(f"{BACKEND_URL}/treasury/transaction/{posted['id']}", params={"amount": 150})
+    assert response.status_code == 200, response.text
+    after = closings_by_date_live(db)
+    assert after[day.isoformat()]["deposits"] == pytest.approx(before[day.isoformat()]["deposits"] + 50)
+    for date in affected:
+        assert after[date]["closing"] == pytest.approx(before[date]["closing"] + 50)
+    for date in affected[1:]:
+        assert after[date]["opening"] == pytest.approx(before[date]["opening"] + 50)
+    for date in set(before) - set(affected):
+        assert after[date] == before[date]
+    balance_after = api.get(f"{BACKEND_URL}/treasury/balance-at", params={"at": end_of_day}).json()["balance"]
+    assert balance_after == pytest.approx(balance_before + 50)
+
+    response = api.delete(f"{BACKEND_URL}/treasury/transaction/{posted['id']}")
+    assert response.status_code == 200, response.text
+    final = closings_by_date_live(db)
+    assert final[day.isoformat()]["transactions_count"] == before[day.isoformat()]["transactions_count"] - 1
+    for date in affected:
+        assert final[date]["closing"] == pytest.approx(before[date]["closing"] - 100)
+
+
+def closings_by_date_live(db):
+    return {closing["date"]: closing for closing in db.treasury_daily_closings.find({}, {"_id": 0})}
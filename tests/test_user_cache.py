@@ -0,0 +1,94 @@
+"""
+Authenticated-user cache: TTL, LRU bound, invalidation, and get_current_user reading through it.
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+from tests.harness import HTTPException, load_server, run
+
+
+class TokenError(Exception):
+    pass
+
+
+def fake_jwt():
+    """Tokens are the user id itself; "expired" and "bad" fail the way PyJWT does"""
+    def decode(token, key, algorithms):
+        if token == "expired":
+            raise jwt.ExpiredSignatureError()
+        if token == "bad":
+            raise jwt.InvalidTokenError()
+        return {"sub": token}
+    jwt = SimpleNamespace(decode=decode, ExpiredSignatureError=type("ExpiredSignatureError", (TokenError,), {}),
+                          InvalidTokenError=TokenError)
+    return jwt
+
+
+@pytest.fixture
+def server():
+    server = load_server(
+        "UserCache", "user_cache", "get_current_user",
+        Depends=lambda dependency=None: None, security=None, jwt=fake_jwt(),
+    )
+    run(server.db.users.insert_one({"id": "u1", "full_name": "Ali", "role": "admin", "password": "hash"}))
+    return server
+
+
+def current_user(server, token="u1"):
+    return run(server.get_current_user(SimpleNamespace(credentials=token)))
+
+
+def test_user_is_read_once_and_then_served_from_the_cache(server):
+    reads = []
+    find_one = server.db.users.find_one
+
+    async def counting(*args, **kwargs):
+        reads.append(args)
+        return await find_one(*args, **kwargs)
+
+    server.db.users.find_one = counting
+    assert current_user(server) == {"id": "u1", "full_name": "Ali", "role": "admin"}
+    assert current_user(server)["role"] == "admin"
+    assert len(reads) == 1
+    assert server.user_cache.stats()["hits"] == 1
+
+
+def test_invalidated_user_is_read_again(server):
+    current_user(server)
+    run(server.db.users.update_one({"id": "u1"}, {"$set": {"role": "viewer"}}))
+    assert current_user(server)["role"] == "admin"
+    server.user_cache.invalidate("u1")
+    assert current_user(server)["role"] == "viewer"
+
+
+def test_cached_copies_cannot_be_changed_by_callers(server):
+    current_user(server)["role"] = "changed"
+    assert current_user(server)["role"] == "admin"
+
+
+def test_entries_expire_and_the_oldest_is_evicted(server, monkeypatch):
+    clock = {"now": 100.0}
+    monkeypatch.setattr(server["time"], "monotonic", lambda: clock["now"])
+    cache = server.UserCache(ttl=30, max_size=2)
+    cache.put("a", {"id": "a"})
+    cache.put("b", {"id": "b"})
+    cache.get("a")
+    cache.put("c", {"id": "c"})
+    assert cache.get("b") is None and cache.get("a") == {"id": "a"}
+    clock["now"] += 31
+    assert cache.get("a") is None and cache.stats()["size"] == 1
+
+
+def test_zero_ttl_disables_the_cache(server):
+    cache = server.UserCache(ttl=0, max_size=10)
+    cache.put("a", {"id": "a"})
+    assert cache.get("a") is None
+
+
+@pytest.mark.parametrize("token, detail", [("expired", "Token expired"), ("bad", "Invalid token"), ("ghost", "User not found")])
+def test_rejected_tokens_are_401(server, token, detail):
+    with pytest.raises(HTTPException) as error:
+        current_user(server, token)
+    assert (error.value.status_code, error.value.detail) == (401, detail)
@@ -0,0 +1,85 @@
+"""
+Approval workflows: every status change is one conditional update, so a document
+moves along its workflow exactly once however many approvers race for it.
+"""
+
+import asyncio
+
+import pytest
+
+from tests.harness import HTTPException, load_server, run
+from tests.live import BACKEND_URL, CONCURRENCY, deposit, make_supplier, payment_request, run_concurrently
+
+ADMIN = {"id": "u1", "full_name": "Admin"}
+
+
+@pytest.fixture
+def server():
+    server = load_server("workflow_transition", "decision_fields", "transition_status", "transition_many")
+    server.db.payments.documents.extend([
+        {"id": "p1", "status": "pending"},
+        {"id": "p2", "status": "pending"},
+        {"id": "p3", "status": "approved"},
+    ])
+    return server
+
+
+def test_concurrent_approvals_have_a_single_winner_offline(server):
+    async def approve():
+        try:
+            return await server.transition_status("payment", "p1", "approve", ADMIN)
+        except HTTPException as e:
+            return e.status_code
+
+    async def scenario():
+        return await asyncio.gather(*(approve() for _ in range(CONCURRENCY)))
+
+    outcomes = run(scenario())
+    winners = [outcome for outcome in outcomes if isinstance(outcome, dict)]
+    assert len(winners) == 1 and winners[0]["status"] == "approved" and winners[0]["approved_by"] == "u1"
+    assert outcomes.count(400) == CONCURRENCY - 1
+
+
+def test_missing_document_and_unknown_action(server):
+    async def scenario(doc_id, action):
+        await server.transition_status("payment", doc_id, action, ADMIN)
+
+    with pytest.raises(HTTPException) as error:
+        run(scenario("nope", "approve"))
+    assert error.value.status_code == 404
+    with pytest.raises(HTTPException) as error:
+        run(scenario("p1", "archive"))
+    assert error.value.status_code == 400
+
+
+def test_bulk_transition_returns_only_what_it_changed(server):
+    async def scenario():
+        return await asyncio.gather(
+            server.transition_many("payment", ["p1", "p2", "p3"], "reject", ADMIN, reason="duplicate"),
+            server.transition_many("payment", ["p1", "p2"], "approve", ADMIN),
+        )
+
+    rejected, approved = run(scenario())
+    assert sorted(doc["id"] for doc in rejected + approved) == ["p1", "p2"]
+    statuses = {doc["id"]: doc["status"] for doc in server.db.payments.documents}
+    assert statuses["p3"] == "approved"
+    assert all(doc.get("rejection_reason") == "duplicate" for doc in rejected)
+
+
+# ==================== LIVE ====================
+
+def test_concurrent_approvals_have_a_single_winner(api, db):
+    supplier = make_supplier(api)
+    deposit(api, 5)
+    payment = api.post(f"{BACKEND_URL}/payments", json=payment_request(supplier, amount=1.0)).json()
+
+    responses = run_concurrently([
+        lambda: api.post(f"{BACKEND_URL}/payments/{payment['id']}/approve", json={"action": "approve"})
+        for _ in range(CONCURRENCY)
+    ])
+    statuses = sorted(response.status_code for response in responses)
+    assert statuses == [200] + [400] * (CONCURRENCY - 1), [r.text for r in responses]
+    assert db.treasury_transactions.count_documents({"source_id": payment["id"]}) == 1
+    assert db.payments.find_one({"id": payment["id"]})["status"] == "approved"
+
+
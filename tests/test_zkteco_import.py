@@ -0,0 +1,56 @@
+"""
+ZKTeco import: streaming Access tables out of a mdb-export subprocess.
+"""
+
+import os
+import stat
+
+import pytest
+
+from tests.harness import load_server, run
+
+
+@pytest.fixture
+def server():
+    return load_server("iter_mdb_table")
+
+
+@pytest.fixture
+def mdb_export(tmp_path, monkeypatch):
+    """Install a fake mdb-export running the given shell script"""
+    def install(script):
+        path = tmp_path / "mdb-export"
+        path.write_text(f"#!/bin/sh\n{script}\n")
+        path.chmod(path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    return install
+
+
+def read_table(server):
+    async def scenario():
+        return [row async for row in server.iter_mdb_table("device.mdb", "USERINFO")]
+    return run(scenario())
+
+
+def test_rows_are_parsed_across_quoted_line_breaks(server, mdb_export):
+    mdb_export("""printf 'USERID,Name\\n1,"Ali\\nSaid"\\n2,Huda\\n'; head -c 200000 /dev/zero >&2""")
+    assert read_table(server) == [{"USERID": "1", "Name": "Ali\nSaid"}, {"USERID": "2", "Name": "Huda"}]
+
+
+def test_export_still_exiting_after_its_output_is_not_killed(server, mdb_export):
+    # Closes stdout first and exits cleanly a moment later
+    mdb_export("printf 'USERID\\n1\\n'; exec >&-; sleep 0.3; exit 0")
+    assert read_table(server) == [{"USERID": "1"}]
+
+
+def test_failed_export_raises_with_its_stderr(server, mdb_export):
+    mdb_export("echo 'no such table' >&2; exit 1")
+    with pytest.raises(RuntimeError, match="no such table"):
+        read_table(server)
+
+
+def test_export_hanging_after_its_output_is_killed(server, mdb_export):
+    server.MDB_EXPORT_EXIT_SECONDS = 0.2
+    mdb_export("printf 'USERID\\n1\\n'; exec >&-; exec sleep 30")
+    with pytest.raises(RuntimeError):
+        read_table(server)